@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Copyright 2011 Dan McDougall <YouKnowWho@YouKnowWhat.com>
+#       Copyright 2015 Jonghak Choi <haginara@gmail.com>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; Version 3 of the License
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, the license can be downloaded here:
+#
+#       http://www.gnu.org/licenses/gpl.html
+
+"""
+Simulated SSH hosts for benchmarking sshpt: paramiko ServerInterface stand-ins listening on loopback ports.
+
+Every simulated host accepts any username/password/key and answers every command, after 'command_latency'
+seconds, with 'output_size' bytes of output.  'handshake_latency' seconds pass between accepting a connection
+and starting the SSH handshake, standing in for network round trips.
+"""
+
+import time
+import struct
+import socket
+import selectors
+import threading
+import logging
+import multiprocessing
+
+import paramiko
+
+logger = logging.getLogger("sshpt.benchmarks")
+
+
+class SimulatedHost(paramiko.ServerInterface):
+    def __init__(self, command_latency, output):
+        self.command_latency = command_latency
+        self.output = output
+
+    def get_allowed_auths(self, username):
+        return 'password,publickey'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        replied = channel.transport.expectReply(channel.remote_chanid)
+        thread = threading.Thread(target=self.runCommand, args=(channel, replied), name="SimulatedCommand")
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def runCommand(self, channel, replied):
+        try:
+            # The transport only answers the exec request once we return from check_channel_exec_request(): a close
+            # sent before that answer would fail the client's exec_command()
+            replied.wait(5)
+            time.sleep(self.command_latency)
+            channel.sendall(self.output)
+            channel.send_exit_status(0)
+        except (EOFError, OSError, paramiko.SSHException):
+            pass
+        finally:
+            channel.close()
+
+
+class SimulatedTransport(paramiko.Transport):
+    """Transport that tells SimulatedHost when its reply to a channel request has gone out"""
+    def __init__(self, sock):
+        super(SimulatedTransport, self).__init__(sock)
+        self.pending_replies = {}
+
+    def expectReply(self, remote_chanid):
+        """Returns an Event set once the next reply to a request on channel 'remote_chanid' is sent"""
+        event = self.pending_replies[remote_chanid] = threading.Event()
+        return event
+
+    def _send_user_message(self, data):
+        super(SimulatedTransport, self)._send_user_message(data)
+        message = data.asbytes()
+        if message[:1] in (bytes([paramiko.common.MSG_CHANNEL_SUCCESS]), bytes([paramiko.common.MSG_CHANNEL_FAILURE])):
+            event = self.pending_replies.pop(struct.unpack(">I", message[1:5])[0], None)
+            if event is not None:
+                event.set()
+
+
+class SimulatedFleet(object):
+    """
+    'count' simulated hosts, each listening on its own loopback port (see ports once started).
+    All of them share one accept loop; each connection gets its own paramiko Transport thread.
+    """
+    def __init__(self, count, handshake_latency=0.0, command_latency=0.0, output_size=64):
+        self.count = count
+        self.handshake_latency = handshake_latency
+        self.command_latency = command_latency
+        # Output made of 64 byte lines, like a typical command's
+        line = b"x" * 63 + b"\n"
+        self.output = (line * (output_size // len(line) + 1))[:output_size]
+        self.host_key = paramiko.ECDSAKey.generate()
+        self.selector = selectors.DefaultSelector()
+        self.ports = []
+
+    def start(self):
+        for _ in range(self.count):
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(128)
+            listener.setblocking(False)
+            self.selector.register(listener, selectors.EVENT_READ)
+            self.ports.append(listener.getsockname()[1])
+        thread = threading.Thread(target=self.acceptLoop, name="SimulatedFleet")
+        thread.daemon = True
+        thread.start()
+        return self.ports
+
+    def acceptLoop(self):
+        while True:
+            for key, _ in self.selector.select():
+                try:
+                    client, _ = key.fileobj.accept()
+                except BlockingIOError:
+                    continue
+                client.setblocking(True)
+                # start_server() waits for the handshake to finish: never let one host hold up the accept loop
+                timer = threading.Timer(self.handshake_latency, self.serve, args=(client,))
+                timer.daemon = True
+                timer.start()
+
+    def serve(self, client):
+        try:
+            transport = SimulatedTransport(client)
+            transport.add_server_key(self.host_key)
+            transport.start_server(server=SimulatedHost(self.command_latency, self.output))
+        except (EOFError, OSError, paramiko.SSHException) as detail:
+            logger.debug("Simulated host failed to start: %s", detail)
+            client.close()
+
+
+def _runFleet(count, handshake_latency, command_latency, output_size, connection):
+    # Clients hanging up without a goodbye is business as usual here
+    logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+    fleet = SimulatedFleet(count, handshake_latency, command_latency, output_size)
+    connection.send(fleet.start())
+    # Serve until the parent says to stop (or goes away)
+    try:
+        connection.recv()
+    except (EOFError, OSError):
+        pass
+
+
+class FleetProcess(object):
+    """Runs a SimulatedFleet in a process of its own, so that the fleet's work doesn't compete with the sshpt
+    run being measured for the same GIL.  Use as a context manager; 'ports' lists the simulated hosts."""
+    def __init__(self, count, handshake_latency=0.0, command_latency=0.0, output_size=64):
+        self.connection, child_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_runFleet, name="SimulatedFleet",
+                                               args=(count, handshake_latency, command_latency, output_size, child_connection))
+        self.process.daemon = True
+        self.process.start()
+        self.ports = self.connection.recv()
+
+    def stop(self):
+        try:
+            self.connection.send('stop')
+        except (EOFError, OSError):
+            pass
+        self.connection.close()
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Copyright 2011 Dan McDougall <YouKnowWho@YouKnowWhat.com>
+#       Copyright 2015 Jonghak Choi <haginara@gmail.com>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; Version 3 of the License
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, the license can be downloaded here:
+#
+#       http://www.gnu.org/licenses/gpl.html
+
+"""
+Benchmarks sshpt against simulated hosts (see SimulatedHosts.py).
+
+For every combination of -T, output format, engine and process count it runs the real SSHPowerTool against the
+same fleet, each run in a fresh interpreter, and reports hosts/sec, peak RSS and the p50/p95/p99 time per host:
+
+    python benchmarks/run_benchmark.py --hosts 500 --threads 10,50,100 --formats csv,json,sqlite
+    python benchmarks/run_benchmark.py --engines thread,asyncio --processes 1,4 --handshake-latency 0.05
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import resource
+import tempfile
+import itertools
+import subprocess
+from argparse import ArgumentParser, SUPPRESS
+
+from os.path import dirname, abspath
+root_path = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, root_path)
+sys.path.insert(0, dirname(abspath(__file__)))
+
+
+def _list(cast):
+    return lambda value: [cast(item) for item in value.split(",") if item]
+
+
+def runOnce(config):
+    """Runs sshpt once (in this process) as described by 'config' and returns its measurements"""
+    from sshpt.main import create_argument
+    from sshpt.sshpt import SSHPowerTool
+
+    outfile = os.path.join(config['directory'], f"out.{config['format']}")
+    argv = ['--hosts', 'benchmark', '-p', 'benchmark', '-q', '-o', outfile, '-O', config['format'],
+            '-T', str(config['threads']), '--engine', config['engine'], '--processes', str(config['processes']),
+            '--summary'] + config['extra_args'] + ['benchmark']
+    options = create_argument(argv)
+    options.hosts = [{'host': '127.0.0.1', 'port': port} for port in config['ports']]
+    tool = SSHPowerTool(options)
+    started = time.monotonic()
+    output_queue = tool()
+    output_queue.join()
+    elapsed = time.monotonic() - started
+    results = dict(tool.summary.results)
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform != 'darwin':
+        rss *= 1024 # ru_maxrss is in KiB everywhere but macOS
+    return dict(elapsed=elapsed, hosts_per_second=len(config['ports']) / elapsed, peak_rss=rss,
+                succeeded=results.get('SUCCESS', 0), failed=sum(results.values()) - results.get('SUCCESS', 0),
+                latency=tool.summary.percentiles('total'))
+
+
+def runIsolated(config):
+    """Runs 'config' in a fresh interpreter, so that peak RSS and warm caches don't leak between runs"""
+    process = subprocess.run([sys.executable, abspath(__file__), '--run-once', json.dumps(config)],
+                             stdout=subprocess.PIPE, universal_newlines=True)
+    if process.returncode != 0:
+        raise RuntimeError(f"benchmark run failed (exit status {process.returncode}): {config}")
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def create_argument():
+    parser = ArgumentParser(usage='python benchmarks/run_benchmark.py [options]')
+    parser.add_argument("--hosts", type=int, default=200, help="Number of simulated hosts [default: 200].")
+    parser.add_argument("--threads", type=_list(int), default=[10, 50, 100], help="-T values to compare [default: 10,50,100].")
+    parser.add_argument("--formats", type=_list(str), default=['csv', 'json', 'sqlite'], help="-O values to compare [default: csv,json,sqlite].")
+    parser.add_argument("--engines", type=_list(str), default=['thread'], help="--engine values to compare [default: thread].")
+    parser.add_argument("--processes", type=_list(int), default=[1], help="--processes values to compare [default: 1].")
+    parser.add_argument("--handshake-latency", type=float, default=0.0, help="Seconds each simulated host waits before its handshake [default: 0].")
+    parser.add_argument("--command-latency", type=float, default=0.0, help="Seconds each command takes on a simulated host [default: 0].")
+    parser.add_argument("--output-size", type=int, default=64, help="Bytes of output per command [default: 64].")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per combination (the fastest one is reported) [default: 1].")
+    parser.add_argument("--json", action="store_true", default=False, help="Print the results as JSON instead of a table.")
+    parser.add_argument("--sshpt-args", default="", help="Extra sshpt arguments for every run, e.g. '--parallel-commands 4'.")
+    parser.add_argument("--run-once", default=None, help=SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    options = create_argument()
+    if options.run_once:
+        # Child mode: one run, measurements printed as JSON on the last line
+        print(json.dumps(runOnce(json.loads(options.run_once))))
+        return 0
+
+    from SimulatedHosts import FleetProcess
+    rows = []
+    with FleetProcess(options.hosts, options.handshake_latency, options.command_latency, options.output_size) as fleet, \
+            tempfile.TemporaryDirectory(prefix='sshpt-benchmark-') as directory:
+        for engine, processes, threads, output_format in itertools.product(options.engines, options.processes, options.threads, options.formats):
+            config = dict(ports=fleet.ports, directory=directory, engine=engine, processes=processes, threads=threads,
+                          format=output_format, extra_args=options.sshpt_args.split())
+            runs = [runIsolated(config) for _ in range(options.repeat)]
+            best = max(runs, key=lambda run: run['hosts_per_second'])
+            best.update(engine=engine, processes=processes, threads=threads, format=output_format)
+            rows.append(best)
+            if not options.json:
+                printRow(best, header=len(rows) == 1)
+    if options.json:
+        print(json.dumps(rows, indent=2))
+    return 0
+
+
+def printRow(row, header=False):
+    if header:
+        print(f"{'engine':<8} {'procs':>5} {'-T':>5} {'format':<7} {'hosts/s':>9} {'peak RSS':>10} {'p50':>8} {'p95':>8} {'p99':>8} {'failed':>7}")
+    p50, p95, p99 = row['latency'] or (0, 0, 0)
+    print(f"{row['engine']:<8} {row['processes']:>5} {row['threads']:>5} {row['format']:<7} {row['hosts_per_second']:>9.1f} "
+          f"{row['peak_rss'] / 1048576.0:>8.1f}MB {p50:>8.4f} {p95:>8.4f} {p99:>8.4f} {row['failed']:>7}")
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
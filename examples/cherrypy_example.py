@@ -9,7 +9,6 @@ try:
 except ImportError:
     print("Install cheryypy first")
     sys.exit(2)
-import Queue
 import sshpt
 
 
@@ -43,21 +42,18 @@ class SSHPTClass(object):
 
     def doSSHPT(self, hosts, username, password, command):
         """The results page"""
-        # Give ourselves an output queue to save results into
-        results_queue = Queue.Queue()
+        if isinstance(hosts, str):
+            hosts = [hosts] # Only one was selected
         commands = [command, ] # Has to be a list
-        ssh = sshpt.SSHPowerTool(
-            hosts=hosts, username=username, password=password,
-            commands=commands, output_queue=results_queue)
-        ssh.run()
+        results = sshpt.run(hosts, commands, username=username, password=password)
         page = "<html><head><title>SSHPT Via Web Example</title></head><body>"
         # Print a table header
         page += "<table border='1'><tr><td><b>Host</b></td><td><b>Command</b></td><td><b>Command Output</b></td></tr>"
-        for host in results_queue.queue:
+        for host in results:
             page += "<tr>"
             page += "<td>%s</td>" % host['host']
-            page += "<td>%s</td>" % "".join(host['commands'])
-            page += "<td><pre>%s</pre></td>" % "".join(host['command_output'])
+            page += "<td>%s</td>" % host['commands']
+            page += "<td><pre>%s</pre></td>" % host['command_output']
             page += "</tr>"
 
         page += "</table>"
@@ -7,7 +7,6 @@ This script is demonstrates how to import and use the SSH Power Tool (sshpt) in
 
 # Import some basic built-in modules
 import getpass
-from queue import Queue
 
 # Import the module du jour
 import sshpt
@@ -20,28 +19,27 @@ command = input('Command: ')
 # 'commands' has to be a list
 commands = [command, ]
 
+# Results come back as each host finishes.  Any other command line option can be passed by its name,
+# e.g. max_threads=50, timeout=10.0, keyfile='~/.ssh/id_rsa', command_timeout=60.0
+results = sshpt.run(hostlist, commands, username=username, password=password)
 
-# Give ourselves an output queue to store results
-results_queue = Queue.Queue()
-
-ssh = sshpt.SSHPowerTool(
-    hosts=hostlist, username=username, password=password,
-    commands=commands, output_queue=results_queue)
-ssh.run()
-
-# This is the simplest way of grabbing the data that sshpt returns.  The other way would be to write your own version of the OutputThread
-for host in results_queue.queue:
+for host in results:
     print("host: %s" % host['host'])
-    print("command_output: %s" % host['command_output'])
+    print("connection_result: %s" % host['connection_result'])
     print("commands: %s" % host['commands'])
+    print("command_output: %s" % host['command_output'])
     # ...and here's the rest of what you can use
-    #print("username: %s" % host['username'])
-    #print ("password: %s" % host['password'] # Do you REALLY this output to the console?)
-    #print ("timeout: %s" % host['timeout'])
-    #print ("local_filepath: %s" % host['local_filepath'])
-    #print ("remote_filepath: %s" % host['remote_filepath'])
-    #print ("execute: %s" % host['execute'])
-    #print ("remove: %s" % host['remove'])
-    #print ("sudo: %s" % host['sudo'])
-    #print ("port: %s" % host['port'])
-    print
+    #print("failure_reason: %s" % host.get('failure_reason')) # dns, refused, auth, timeout, command_timeout...
+    #print("timings: %s" % host.get('timings'))
+    #print("port: %s" % host['port'])
+    #print("sudo: %s" % host['sudo'])
+    print()
+    if host['connection_result'] != 'SUCCESS' and input('Keep going? [Y/n] ').lower().startswith('n'):
+        # Hosts that were not started yet are skipped
+        results.cancel()
+
+# The same results can be had from a coroutine:
+#
+#   async def main():
+#       async for host in sshpt.run(hostlist, commands, username=username, password=password):
+#           print(host['host'], host['command_output'])
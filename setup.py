@@ -18,7 +18,12 @@ __license__ = "GNU General Public License (GPL) Version 3"
 __author__ = 'Dan McDougall <YouKnowWho@YouKnowWhat.com>'
 __second_author__ = 'Jonghak Choi <haginara@gmail.com>'
 
-install_requires = ['paramiko>=2.4.2']
+# paramiko: SSHConfig._pattern_matches() (2.7) and SSHClient._auth() are overridden, so stay below the next major.
+# asyncssh: create_connection(sock=...) is 2.12+.
+install_requires = ['paramiko>=2.7.0,<6']
+extras_require = {
+    'asyncio': ['asyncssh>=2.12.0,<3'],
+}
 
 setup(
     name='sshpt',
@@ -43,6 +48,7 @@ setup(
     ],  # Get strings from http://pypi.python.org/pypi?%3Aaction=list_classifiers
     packages=find_packages(exclude=EXCLUDE_FROM_PACKAGES),
     install_requires=install_requires,
+    extras_require=extras_require,
     entry_points={
         'console_scripts': [
             'sshpt = sshpt.main:main',
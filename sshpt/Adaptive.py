@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Copyright 2011 Dan McDougall <YouKnowWho@YouKnowWhat.com>
+#       Copyright 2015 Jonghak Choi <haginara@gmail.com>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; Version 3 of the License
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, the license can be downloaded here:
+#
+#       http://www.gnu.org/licenses/gpl.html
+
+import time
+import threading
+import logging
+
+logger = logging.getLogger("sshpt")
+
+# Failure reasons that mean "too many of us at once" (e.g. sshd's MaxStartups or a jump host's limits kicking in)
+CONGESTION_REASONS = ('timeout', 'refused', 'network')
+# The handshake time is congested once its moving average is this many times the quickest one seen...
+LATENCY_FACTOR = 3.0
+# ...and at least this many seconds slower than it, so that jitter on sub-millisecond handshakes isn't congestion
+LATENCY_SLACK = 0.05
+# Weight of each new handshake time in the moving average
+LATENCY_WEIGHT = 0.2
+# What the limit is multiplied by on congestion
+BACKOFF = 0.5
+
+
+class AdaptiveLimiter(object):
+    """
+    Decides how many hosts may be in flight at once, between 'minimum' and 'maximum' (AIMD, like TCP's congestion control).
+
+    The scheduler calls acquire() before dispatching a host; every result is fed back through observe() (it is an
+    output observer).  Starting from 'minimum', the limit grows by one per success until the first sign of congestion
+    (slow start), then by one per limit's worth of successes.  Timeouts, refusals, resets and handshakes much slower
+    than the quickest one seen halve it, at most once per limit's worth of results.
+
+    history - List: (seconds since the start, limit) every time the limit changed
+    """
+    def __init__(self, minimum, maximum):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(self.minimum)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.slow_start = True
+        self.since_backoff = self.maximum # Results since the limit was last cut
+        self.baseline = None # Quickest handshake seen
+        self.latency = None # Moving average of the handshake time
+        self.started = time.monotonic()
+        self.history = [(0.0, self.minimum)]
+
+    def acquire(self):
+        """Blocks until one more host may be dispatched"""
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def observe(self, queueObj):
+        if 'event' in queueObj or queueObj.get('settled'):
+            return # Hosts settled without being dispatched (see Preflight, Resolver, Rollout) never took a slot
+        with self.condition:
+            self.in_flight -= 1
+            self.adjust(queueObj)
+            self.condition.notify_all()
+
+    def adjust(self, queueObj):
+        success = queueObj.get('connection_result') == 'SUCCESS'
+        congested = not success and queueObj.get('failure_reason') in CONGESTION_REASONS
+        timings = queueObj.get('timings') or {}
+        if 'kex' in timings and not congested:
+            handshake = timings.get('connect', 0) + timings['kex'] + timings.get('auth', 0)
+            self.baseline = handshake if self.baseline is None else min(self.baseline, handshake)
+            self.latency = handshake if self.latency is None else (1 - LATENCY_WEIGHT) * self.latency + LATENCY_WEIGHT * handshake
+            congested = self.latency > LATENCY_FACTOR * self.baseline and self.latency - self.baseline > LATENCY_SLACK
+        self.since_backoff += 1
+        previous = int(self.limit)
+        if congested:
+            if self.since_backoff >= self.limit:
+                self.limit = max(self.minimum, self.limit * BACKOFF)
+                self.slow_start = False
+                self.since_backoff = 0
+        elif success:
+            self.limit = min(self.maximum, self.limit + (1 if self.slow_start else 1 / self.limit))
+        if int(self.limit) != previous:
+            logger.debug("Concurrency limit %d -> %d", previous, int(self.limit))
+            self.history.append((round(time.monotonic() - self.started, 3), int(self.limit)))
+
+    def report(self, points=12):
+        """Returns how the limit moved over the run as text, with at most 'points' (evenly spread) changes"""
+        with self.condition:
+            history = list(self.history)
+        if len(history) > points:
+            step = (len(history) - 1) / float(points - 1)
+            history = [history[int(round(index * step))] for index in range(points)]
+        limits = [limit for _, limit in self.history]
+        return (f"Concurrency (adaptive, {self.minimum}-{self.maximum}): min {min(limits)}, max {max(limits)}, final {int(self.limit)}\n"
+                "  " + " ".join(f"{elapsed:.1f}s={limit}" for elapsed, limit in history))
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Copyright 2011 Dan McDougall <YouKnowWho@YouKnowWhat.com>
+#       Copyright 2015 Jonghak Choi <haginara@gmail.com>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; Version 3 of the License
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, the license can be downloaded here:
+#
+#       http://www.gnu.org/licenses/gpl.html
+
+import re
+import hashlib
+import threading
+
+# A host name's last number, with what comes before and after it
+NUMBERED_HOST = re.compile(r'^(.*?)(\d+)(\D*)$')
+
+
+def _ranges(numbers):
+    """Yields (first, last) for each run of consecutive numbers of a sorted list"""
+    first = last = numbers[0]
+    for number in numbers[1:]:
+        if number != last + 1:
+            yield first, last
+            first = number
+        last = number
+    yield first, last
+
+
+def hostRanges(hosts):
+    """
+    Folds host names into pdsh style ranges: web01, web02, web03, web07 and db1 become "db1,web[01-03,07]".
+    Names are grouped by what surrounds their last number; zero padded numbers keep their width.
+    """
+    groups = {}
+    others = []
+    for host in set(hosts):
+        match = NUMBERED_HOST.match(host)
+        if not match:
+            others.append(host)
+            continue
+        prefix, digits, suffix = match.groups()
+        groups.setdefault((prefix, suffix), []).append(digits)
+    folded = []
+    for (prefix, suffix), digits in groups.items():
+        # Numbers as wide as a zero padded one share its range (web09, web10), the others one unpadded range (n9, n10)
+        padded = set(len(number) for number in digits if len(number) > 1 and number.startswith('0'))
+        if len(set(map(len, digits))) == 1:
+            padded.add(len(digits[0]))
+        widths = {}
+        for number in digits:
+            widths.setdefault(len(number) if len(number) in padded else 0, []).append(int(number))
+        for width, numbers in sorted(widths.items()):
+            numbers = sorted(set(numbers))
+            if len(numbers) == 1:
+                folded.append(f"{prefix}{str(numbers[0]).zfill(width)}{suffix}")
+                continue
+            spans = ",".join(str(first).zfill(width) if first == last else f"{str(first).zfill(width)}-{str(last).zfill(width)}"
+                             for first, last in _ranges(numbers))
+            folded.append(f"{prefix}[{spans}]{suffix}")
+    return ",".join(sorted(folded + others))
+
+
+class OutputAggregator(object):
+    """
+    Output observer that groups hosts by their result (status and command output), keeping each distinct output
+    once, for --aggregate.  report() then lists every distinct output once with the hosts that returned it,
+    fewest hosts (the outliers) first, like dshbak -c.
+
+    With --output-budget, outputs that went over it are grouped by their head/tail excerpt.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.groups = {} # digest: [status, output, hosts]
+
+    def observe(self, queueObj):
+        if 'event' in queueObj:
+            return
+        status, output = queueObj['connection_result'], queueObj['command_output']
+        if not isinstance(output, str):
+            output = "\n".join(output)
+        digest = hashlib.sha1(f"{status}\0{output}".encode('utf-8', 'replace')).digest()
+        with self.lock:
+            group = self.groups.get(digest)
+            if group is None:
+                group = self.groups[digest] = [status, output, []]
+            group[2].append(queueObj['host'])
+
+    def report(self):
+        """Returns the grouped results as text"""
+        with self.lock:
+            groups = sorted(self.groups.values(), key=lambda group: (len(group[2]), group[0], group[1]))
+        lines = []
+        for status, output, hosts in groups:
+            header = f"{hostRanges(hosts)} ({len(hosts)} host{'s' if len(hosts) != 1 else ''}, {status})"
+            lines.extend(["-" * 16, header, "-" * 16, output])
+        return "\n".join(lines)
@@ -0,0 +1,483 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Copyright 2011 Dan McDougall <YouKnowWho@YouKnowWhat.com>
+#       Copyright 2015 Jonghak Choi <haginara@gmail.com>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; Version 3 of the License
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, the license can be downloaded here:
+#
+#       http://www.gnu.org/licenses/gpl.html
+
+from .Generic import StreamSplitter, ConnectionFailure, CommandTimeout, HostKeyRejected, commandDeadline, failureReason, normalizeString
+from .Spool import OutputSpool, removeSpool
+from .KeyCache import KeyCache
+from .KnownHosts import knownHostsIndex, hostKeyName
+from .Timing import PhaseTimer
+
+import os
+import time
+import base64
+import socket
+import asyncio
+import threading
+import logging
+
+logger = logging.getLogger("sshpt")
+
+# Import 3rd party modules
+try:
+    import asyncssh
+    logging.getLogger("asyncssh").setLevel(logging.WARNING)
+except ImportError:
+    # Library callers get the error (see ResultIterator), the command line prints it (see main())
+    raise ImportError("The asyncssh module is required to use the asyncio engine.  Install it with: pip install sshpt[asyncio]")
+
+
+def loadAsyncsshKey(key_file, key_pass=None):
+    return asyncssh.read_private_key(key_file, key_pass)
+
+
+# Keys are read (and decrypted) once per process and shared by every connection
+async_key_cache = KeyCache(loadAsyncsshKey)
+
+# How much channel data is read at a time when streaming output
+STREAM_CHUNK_SIZE = 32768
+
+
+class TimedClient(asyncssh.SSHClient):
+    """asyncssh client noting when authentication starts and ends, so that connecting can be split into key exchange and auth"""
+    def __init__(self):
+        self.auth_started = None
+        self.auth_finished = None
+
+    def begin_auth(self, username):
+        self.auth_started = time.monotonic()
+
+    def auth_completed(self):
+        self.auth_finished = time.monotonic()
+
+
+class AsyncCredit(object):
+    """Per-host budget of streamed events waiting on the output_queue.
+    Acquired from the event loop, released (via release()) from the OutputThread once an event is written."""
+    def __init__(self, loop, stream_buffer):
+        self.loop = loop
+        self.semaphore = asyncio.Semaphore(stream_buffer)
+
+    async def acquire(self):
+        await self.semaphore.acquire()
+
+    def release(self):
+        self.loop.call_soon_threadsafe(self.semaphore.release)
+
+
+class AsyncSSHQueue(object):
+    """Runs SSH jobs as coroutines on a single event loop instead of one SSHThread per slot.
+    It quacks like the Queue.Queue() returned by startSSHQueue (put/qsize/join) so SSHPowerTool can feed either one.
+    Results are put() on output_queue in exactly the same shape as SSHThread produces them.
+
+    output_queue          Queue.Queue() to output results
+    max_concurrency       Number of hosts that may be connecting/running commands at the same time
+    """
+    def __init__(self, output_queue, max_concurrency):
+        self.output_queue = output_queue
+        self.max_concurrency = max_concurrency
+        self.pending = 0 # Jobs put() but not finished yet
+        self.waiting = 0 # Jobs put() but still waiting for a free slot
+        self.condition = threading.Condition()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="AsyncSSHQueue")
+        self.thread.daemon = True
+        self.thread.start()
+        # The semaphore has to be created from within the loop for older Pythons
+        self.semaphore = asyncio.run_coroutine_threadsafe(self._createSemaphore(), self.loop).result()
+
+    async def _createSemaphore(self):
+        return asyncio.Semaphore(self.max_concurrency)
+
+    def put(self, queueObj):
+        """Hands a job to the event loop, blocking while max_concurrency jobs are already waiting for a slot"""
+        with self.condition:
+            while self.waiting >= self.max_concurrency:
+                self.condition.wait()
+            self.pending += 1
+            self.waiting += 1
+        asyncio.run_coroutine_threadsafe(self.runJob(queueObj), self.loop)
+
+    def qsize(self):
+        return self.waiting
+
+    def join(self):
+        with self.condition:
+            while self.pending:
+                self.condition.wait()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def runJob(self, queueObj):
+        try:
+            async with self.semaphore:
+                with self.condition:
+                    self.waiting -= 1
+                    self.condition.notify_all()
+                details = {}
+                timer = PhaseTimer()
+                success, command_output = await self.attemptConnection(details=details, timer=timer, **queueObj)
+                queueObj.update(details)
+            queueObj['connection_result'] = "SUCCESS" if success else details.get('connection_result', "FAILED")
+            queueObj['command_output'] = command_output
+            queueObj['timings'] = timer.stop()
+            self.output_queue.put(queueObj)
+        except Exception as e:
+            logger.error("Failed to run SSH job reason: %s" % e)
+            # Still a result: the output, the journal and whatever counts hosts in flight (--adaptive, batches) need one
+            queueObj.update(connection_result="FAILED", command_output=f"sshpt error: {e}", failure_reason=failureReason(e))
+            queueObj.setdefault('timings', {})
+            self.output_queue.put(queueObj)
+        finally:
+            with self.condition:
+                self.pending -= 1
+                self.condition.notify_all()
+
+    async def openSocket(self, host, port, timer, addresses=None, dns_time=None):
+        """Resolves 'host' (unless its 'addresses' were resolved ahead of dispatch, in 'dns_time' seconds) and opens
+        a (non-blocking) TCP connection to the first of its addresses that accepts one"""
+        if addresses:
+            timer.add('dns', dns_time or 0.0)
+        else:
+            with timer.phase('dns'):
+                addresses = await self.loop.getaddrinfo(host, port, family=socket.AF_UNSPEC, type=socket.SOCK_STREAM)
+        with timer.phase('connect'):
+            error = None
+            for family, socktype, proto, canonname, address in addresses:
+                sock = socket.socket(family, socktype, proto)
+                sock.setblocking(False)
+                try:
+                    await self.loop.sock_connect(sock, address)
+                    return sock
+                except OSError as detail:
+                    sock.close()
+                    error = detail
+                except BaseException:
+                    # e.g. cancelled by the connect timeout
+                    sock.close()
+                    raise
+            raise error
+
+    async def handshake(self, host, kwargs, timer, addresses=None, dns_time=None):
+        """Opens the connection and runs asyncssh's key exchange and auth over it, timing each phase"""
+        client = TimedClient()
+        if 'proxy_command' not in kwargs:
+            kwargs['sock'] = await self.openSocket(host, kwargs['port'], timer, addresses, dns_time)
+        started = time.monotonic()
+        try:
+            conn, _ = await asyncssh.create_connection(lambda: client, host, **kwargs)
+        finally:
+            if client.auth_started is None:
+                timer.add('kex', time.monotonic() - started)
+            else:
+                timer.add('kex', client.auth_started - started)
+                timer.add('auth', (client.auth_finished or time.monotonic()) - client.auth_started)
+        return conn
+
+    def hostKeyCheck(self, host, port, host_key_policy, known_hosts, known_keys):
+        """Returns (KnownHostsIndex, name of the host's key, asyncssh known_hosts argument) for 'host_key_policy':
+        no index when it is 'off', no known_hosts argument when accept-new is to learn the host's key"""
+        if host_key_policy == 'off':
+            return None, None, None
+        index = knownHostsIndex(known_hosts)
+        name = hostKeyName(host, port)
+        known = index.lookup(name) if known_keys is None else known_keys
+        if not known and host_key_policy != 'strict':
+            return index, name, None
+        # Trusted keys (none: asyncssh rejects whatever the host shows), no CAs, revoked ones already left out
+        trusted = [asyncssh.import_public_key(f"{keytype} {base64.b64encode(blob).decode()}") for keytype, blobs in known.items() for blob in blobs]
+        return index, name, (trusted, [], [])
+
+    def learnHostKey(self, conn, index, name):
+        """accept-new and a host we didn't know: keep its key, unless it is a revoked one"""
+        key = conn.get_server_host_key()
+        if index.isRevoked(key.public_data):
+            conn.close()
+            raise HostKeyRejected(f"Host key of {name} ({key.get_algorithm()}) is revoked")
+        index.learn(name, key.get_algorithm(), key.public_data)
+
+    async def clientKeys(self, key_file, key_pass, password):
+        """Returns the asyncssh client_keys argument for 'key_file' (decrypted off the event loop, once per process).
+        Returns no argument at all when the key can't be read but there's a 'password' to fall back to."""
+        try:
+            key = async_key_cache.cached(key_file)
+            if key is None:
+                # Decrypting runs the key's KDF: keep it off the event loop
+                key = await self.loop.run_in_executor(None, async_key_cache.load, key_file, key_pass)
+            return dict(client_keys=[key])
+        except (asyncssh.KeyImportError, OSError) as detail:
+            # e.g. an ssh_config IdentityFile we can't read: fall back to the password if we have one
+            if not password:
+                raise
+            logger.warning("Could not use private key %s, using the password instead: %s", key_file, detail)
+            return {}
+
+    async def asyncConnect(self, host, username, password, timeout, port=22, key_file="", key_pass="", passwordless=False, proxycommand=None, timer=None,
+                           addresses=None, dns_time=None, host_key_policy='off', known_hosts=None, known_keys=None):
+        """Connects to 'host' and returns an asyncssh connection, or a string describing why it failed.
+        The time spent in each phase of the connection is added to 'timer' (a PhaseTimer) if one is given.
+        Unless 'host_key_policy' is 'off', the host key is checked against the 'known_hosts' file's KnownHostsIndex
+        (or the 'known_keys' looked up in it ahead, see lookupAhead())."""
+        logger.debug(f"asyncConnect:connect, {username}@{host}")
+        timer = timer or PhaseTimer()
+        index, name, trusted = self.hostKeyCheck(host, port, host_key_policy, known_hosts, known_keys)
+        kwargs = dict(port=port, username=username, known_hosts=trusted)
+        if password:
+            kwargs['password'] = password
+        if proxycommand:
+            kwargs['proxy_command'] = proxycommand
+        try:
+            if key_file:
+                kwargs.update(await self.clientKeys(key_file, None if passwordless else key_pass, password))
+            conn = await asyncio.wait_for(self.handshake(host, kwargs, timer, addresses, dns_time), float(timeout))
+            if index is not None and trusted is None:
+                self.learnHostKey(conn, index, name)
+        except (asyncssh.HostKeyNotVerifiable, HostKeyRejected) as detail:
+            logger.error('Host key verification failed: %s', detail)
+            conn = ConnectionFailure(str(detail), 'hostkey')
+        except asyncio.TimeoutError:
+            logger.error('Connecting failed (timed out after %ss)', timeout)
+            conn = ConnectionFailure("timed out", 'timeout')
+        except (asyncssh.Error, asyncssh.KeyImportError) as detail:
+            logger.error('Could not read private key; bad password?, %s', detail)
+            conn = ConnectionFailure(str(detail), failureReason(detail, asyncssh.PermissionDenied))
+        except Exception as detail:
+            logger.error('Connecting failed (for whatever reason: %s)', detail)
+            conn = ConnectionFailure(str(detail), failureReason(detail))
+        return conn
+
+    async def sftpPut(self, conn, local_filepath, remote_filepath):
+        """Uses SFTP to transfer a local file (local_filepath) to a remote server at the specified path (remote_filepath)."""
+        logger.info("Put file from %s to %s", local_filepath, remote_filepath)
+        async with conn.start_sftp_client() as sftp:
+            await sftp.put(local_filepath, remote_filepath)
+
+    async def executeCommand(self, conn, command, sudo, password=None, emit=None, stream_mode='line', command_timeout=None, run_deadline=None):
+        """Executes the given command over 'conn', via sudo when 'sudo' is set.
+        If 'emit' is given the output is awaited into it in line (or chunk) sized pieces as it arrives.
+        Raises CommandTimeout once it ran for 'command_timeout' seconds or past 'run_deadline' (see commandDeadline()).
+        Returns stdout (after command execution), or a '[streamed N bytes]' marker when streaming"""
+        stdin = None
+        if sudo:
+            logger.debug("Run sudoExecute: %s, %s", sudo, command)
+            command = f"sudo -S -u {sudo} {command}"
+            stdin = '%s\n' % password
+        deadline = commandDeadline(command_timeout, run_deadline)
+        if emit is None and deadline is None:
+            result = await conn.run(command, input=stdin)
+            return result.stdout or ""
+        pieces = None
+        if emit is None:
+            pieces = []
+
+            async def emit(data):
+                pieces.append(data)
+            stream_mode = 'chunk'
+        splitter = StreamSplitter(stream_mode)
+        started = time.monotonic()
+        process = await conn.create_process(command, encoding=None)
+        if stdin:
+            process.stdin.write(stdin.encode())
+        try:
+            while True:
+                read = process.stdout.read(STREAM_CHUNK_SIZE)
+                data = await (asyncio.wait_for(read, deadline - time.monotonic()) if deadline is not None else read)
+                if not data:
+                    break
+                for event in splitter.feed(data):
+                    await emit(event)
+            wait = process.wait()
+            await (asyncio.wait_for(wait, deadline - time.monotonic()) if deadline is not None else wait)
+        except asyncio.TimeoutError:
+            process.close()
+            for event in splitter.close():
+                await emit(event)
+            output = "".join(pieces) if pieces is not None else f"[streamed {splitter.total_bytes} bytes]"
+            raise CommandTimeout(output, round(time.monotonic() - started, 3))
+        for event in splitter.close():
+            await emit(event)
+        if pieces is not None:
+            return "".join(pieces)
+        return f"[streamed {splitter.total_bytes} bytes]"
+
+    async def executeCommands(self, conn, commands, sudo, password=None, max_channels=1, stream=None, stream_mode='line', command_timeout=None, run_deadline=None):
+        """Executes 'commands' with up to 'max_channels' of them running at once on 'conn'.
+        'stream' is an optional callable(index, command) returning the coroutine function to stream that command's output to.
+        Each command gets 'command_timeout' seconds from when it starts, none of them past 'run_deadline'.
+        Returns the output of each command, in the same order as 'commands'"""
+        channels = asyncio.Semaphore(max_channels)
+        outputs = {}
+
+        async def run(index, command):
+            async with channels:
+                emit = stream(index, command) if stream else None
+                try:
+                    outputs[index] = await self.executeCommand(conn, command=command, sudo=sudo, password=password, emit=emit, stream_mode=stream_mode,
+                                                               command_timeout=command_timeout, run_deadline=run_deadline)
+                except CommandTimeout as detail:
+                    outputs[index] = detail.output
+                    raise
+        try:
+            await asyncio.gather(*[run(index, command) for index, command in enumerate(commands)])
+        except CommandTimeout as detail:
+            # Everything that finished (or got cut short) until then, in order
+            detail.outputs = [outputs[index] for index in sorted(outputs)]
+            raise
+        return [outputs[index] for index in range(len(commands))]
+
+    def streamTo(self, host, port, stream_buffer):
+        """Returns a stream callable for executeCommands() that forwards output events to the output_queue,
+        with at most 'stream_buffer' of this host's events waiting on the OutputThread at a time."""
+        credit = AsyncCredit(self.loop, stream_buffer)
+
+        def stream(index, command):
+            async def emit(data):
+                await credit.acquire()
+                self.output_queue.put(dict(event='output', host=host, port=port, index=index, command=command,
+                                           data=data, credit=credit))
+            return emit
+        return stream
+
+    async def copyFile(self, conn, local_filepath, remote_filepath, commands, sudo, password, execute, timer, limits):
+        """Copies 'local_filepath' into the 'remote_filepath' directory (by way of /tmp with 'sudo'), making it executable if 'execute' is set.
+        Returns the commands to run next (the copy itself when executing, an 'ls -l' of it otherwise) and the output so far."""
+        logger.info("sudo: %s, local_filepath: %s, remote_filepath: %s", sudo, local_filepath, remote_filepath)
+        command_output = []
+        local_short_filename = os.path.basename(local_filepath)
+        remote_fullpath = os.path.join(remote_filepath, local_short_filename)
+        try:
+            if sudo:
+                temp_path = os.path.join('/tmp', local_short_filename)
+                with timer.phase('sftp'):
+                    await self.sftpPut(conn, local_filepath, temp_path)
+                command = f"mv {temp_path} {remote_fullpath}"
+                with timer.phase('exec'):
+                    command_output.append(await self.executeCommand(conn, command=command, sudo=sudo, password=password, **limits))
+            else:
+                with timer.phase('sftp'):
+                    await self.sftpPut(conn, local_filepath, remote_fullpath)
+
+            if execute:
+                chmod_command = f"chmod a+x {remote_fullpath}"
+                with timer.phase('exec'):
+                    await self.executeCommand(conn, command=chmod_command, sudo=sudo, password=password, **limits)
+                commands = [remote_fullpath, ]
+            else:
+                commands = [f"ls -l {remote_fullpath}", ]
+        except (IOError, asyncssh.SFTPError) as details:
+            command_output.append(str(details))
+        return commands, command_output
+
+    async def spoolCommands(self, conn, commands, sudo, password, parallel_commands, output_budget, limits):
+        """Runs 'commands', keeping at most 'output_budget' bytes of their output in memory (see OutputSpool).
+        Returns their outputs, the files holding whatever went past the budget and the total number of bytes"""
+        spool = OutputSpool(output_budget)
+
+        def spoolTo(index, command):
+            async def emit(data):
+                spool.section(index).write(data)
+            return emit
+        try:
+            await self.executeCommands(conn, commands=commands, sudo=sudo, password=password, max_channels=parallel_commands,
+                stream=spoolTo, stream_mode='chunk', **limits)
+        except CommandTimeout as detail:
+            spooled_output, spooled_files = spool.results()
+            removeSpool(spooled_files)
+            detail.outputs = spooled_output
+            raise
+        except Exception:
+            removeSpool(spool.results()[1])
+            raise
+        spooled_output, spooled_files = spool.results()
+        return spooled_output, spooled_files, spool.total_bytes
+
+    async def runCommands(self, conn, host, port, commands, sudo, password, parallel_commands, stream, stream_buffer, output_budget, offset, details, limits):
+        """Runs 'commands' on 'conn', streaming (--stream), spooling (--output-budget) or collecting their output.
+        Returns their outputs; spooled ones are listed in details['command_output_files'] counting from 'offset'."""
+        if stream:
+            return await self.executeCommands(conn, commands=commands, sudo=sudo, password=password, max_channels=parallel_commands,
+                stream=self.streamTo(host, port, stream_buffer), stream_mode=stream, **limits)
+        if not output_budget:
+            return await self.executeCommands(conn, commands=commands, sudo=sudo, password=password, max_channels=parallel_commands, **limits)
+        spooled_output, spooled_files, total_bytes = await self.spoolCommands(conn, commands, sudo, password, parallel_commands, output_budget, limits)
+        if details is not None:
+            details['command_output_files'] = {offset + index: path for index, path in spooled_files.items()}
+            details['output_bytes'] = total_bytes
+        return spooled_output
+
+    async def attemptConnection(self, host, username="", password="", keyfile="", keypass="", timeout=30, commands=[],
+        local_filepath=False, remote_filepath='/tmp', execute=False, remove=False, sudo=False, passwordless=False, port=22,
+        parallel_commands=1, stream=None, stream_buffer=64, output_budget=None, proxycommand=None, addresses=None, dns_time=None,
+        work_hash=None, command_timeout=None, run_deadline=None, host_key_policy='off', known_hosts=None, known_keys=None, details=None, timer=None):
+        """Coroutine counterpart of SSHThread.attemptConnection().
+        Returns connection_result as a boolean and command_output as a string (on failure) or a list of strings."""
+        connection_result = True
+        command_output = []
+        timer = timer or PhaseTimer()
+        if run_deadline:
+            if time.time() >= run_deadline:
+                if details is not None:
+                    details.update(connection_result="SKIPPED", failure_reason='deadline')
+                return False, "Skipped: the run's --deadline passed"
+            timeout = min(float(timeout), run_deadline - time.time())
+        limits = dict(command_timeout=command_timeout, run_deadline=run_deadline)
+        conn = await self.asyncConnect(host, username, password=password, timeout=timeout, port=port, key_file=keyfile, key_pass=keypass, passwordless=passwordless,
+                                       proxycommand=proxycommand, timer=timer, addresses=addresses, dns_time=dns_time,
+                                       host_key_policy=host_key_policy, known_hosts=known_hosts, known_keys=known_keys)
+        if isinstance(conn, str):
+            # If conn is a string that means the connection failed and 'conn' is the details as to why
+            if details is not None:
+                details['failure_reason'] = getattr(conn, 'reason', 'ssh')
+            return False, str(conn)
+
+        try:
+            if local_filepath:
+                commands, command_output = await self.copyFile(conn, local_filepath, remote_filepath, commands, sudo, password, execute, timer, limits)
+            with timer.phase('exec'):
+                if commands:
+                    command_output.extend(await self.runCommands(conn, host, port, commands, sudo, password, parallel_commands, stream, stream_buffer,
+                                                                 output_budget, len(command_output), details, limits))
+                if local_filepath is False and commands is False and execute is False:
+                    command_output = [await self.executeCommand(conn, command='uptime', sudo=sudo, password=password, **limits)]
+                if local_filepath and remove:
+                    rm_command = f"rm -f {os.path.join(remote_filepath, os.path.basename(local_filepath))}"
+                    await self.executeCommand(conn, command=rm_command, sudo=sudo, password=password, **limits)
+            command_output = [normalizeString(output) for output in command_output]
+        except CommandTimeout as detail:
+            connection_result = False
+            command_output = [normalizeString(output) for output in list(command_output) + detail.outputs] or [""]
+            command_output[-1] += f"\n[{detail}]"
+            if details is not None:
+                details.update(connection_result="TIMEOUT", failure_reason='command_timeout')
+        except Exception as detail:
+            logger.error("Exception: %s", detail)
+            connection_result = False
+            command_output = str(detail)
+            if details is not None:
+                details['failure_reason'] = 'command'
+        finally:
+            conn.close()
+            await conn.wait_closed()
+        return connection_result, command_output
+
+
+def startAsyncQueue(output_queue, max_concurrency):
+    """Start the asyncio engine.  Must be passed a Queue (output_queue) for writing results."""
+    return AsyncSSHQueue(output_queue, max_concurrency)
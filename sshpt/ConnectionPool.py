@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Copyright 2011 Dan McDougall <YouKnowWho@YouKnowWhat.com>
+#       Copyright 2015 Jonghak Choi <haginara@gmail.com>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; Version 3 of the License
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, the license can be downloaded here:
+#
+#       http://www.gnu.org/licenses/gpl.html
+
+import threading
+import logging
+from collections import OrderedDict
+from time import monotonic
+
+logger = logging.getLogger("sshpt")
+
+
+class ConnectionPool(object):
+    """
+    Keeps authenticated paramiko.SSHClient objects open between runs so that repeated SSHPowerTool.run() calls
+    against the same hosts skip the TCP connect, key exchange and authentication entirely.
+
+    Connections are keyed by (host, port, username, host key policy, known_hosts file).  The credentials are not part
+    of the key: a pooled connection is handed out to any job for the same host/port/user that checks host keys the
+    same way (a connection opened with --host-key-policy off is never reused by a strict job).
+
+    max_open - Integer: Maximum number of idle connections kept open.  The least recently used one is closed to make room.
+    idle_timeout - Seconds: Idle connections older than this are closed instead of being reused.
+    health_timeout - Seconds: How long a pooled connection's peer gets to answer the health check (see isHealthy()).
+    """
+    def __init__(self, max_open=100, idle_timeout=300, health_timeout=5):
+        self.max_open = max_open
+        self.idle_timeout = idle_timeout
+        self.health_timeout = health_timeout
+        self.lock = threading.Lock()
+        self.idle = OrderedDict() # (key, id(client)) -> (client, released_at), oldest first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Returns a healthy pooled SSHClient for 'key' or None if a new connection has to be made"""
+        while True:
+            with self.lock:
+                self._evictExpired()
+                client = self._take(key)
+                if client is None:
+                    self.misses += 1
+                    return None
+            # The health check waits on the network: never while holding up every other worker
+            healthy = self.isHealthy(client)
+            with self.lock:
+                if healthy:
+                    self.hits += 1
+                    return client
+                self._close(client)
+
+    def put(self, key, client):
+        """Hands a connection back to the pool once a job is done with it"""
+        with self.lock:
+            if not self.isOpen(client):
+                self._close(client)
+                return
+            self._evictExpired()
+            while self.idle and len(self.idle) >= self.max_open:
+                oldest_key = next(iter(self.idle))
+                self._close(self.idle.pop(oldest_key)[0])
+            if self.max_open > 0:
+                self.idle[(key, id(client))] = (client, monotonic())
+            else:
+                self._close(client)
+
+    def isOpen(self, client):
+        """Checks the transport is still up (as far as paramiko knows, without asking the peer)"""
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def isHealthy(self, client):
+        """Checks the transport is still up and the peer still answers (opening and closing a session channel,
+        within health_timeout seconds) before a connection is reused"""
+        if not self.isOpen(client):
+            return False
+        try:
+            channel = client.get_transport().open_session(timeout=self.health_timeout)
+            channel.close()
+        except Exception as detail:
+            logger.debug("Pooled connection failed health check: %s", detail)
+            return False
+        return True
+
+    def stats(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, open=len(self.idle))
+
+    def close(self):
+        """Closes every idle connection"""
+        with self.lock:
+            while self.idle:
+                self._close(self.idle.popitem()[1][0])
+
+    def _take(self, key):
+        """Removes and returns the longest idle connection for 'key', if there is one"""
+        for idle_key in self.idle:
+            if idle_key[0] == key:
+                return self.idle.pop(idle_key)[0]
+        return None
+
+    def _evictExpired(self):
+        now = monotonic()
+        for idle_key, (client, released_at) in list(self.idle.items()):
+            if now - released_at > self.idle_timeout:
+                del self.idle[idle_key]
+                self._close(client)
+
+    def _close(self, client):
+        self.evictions += 1
+        try:
+            client.close()
+        except Exception:
+            pass
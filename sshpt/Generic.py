@@ -20,20 +20,131 @@
 
 import re
 import sys
+import time
+import socket
 from itertools import cycle
 import base64
+import codecs
 import threading
+if sys.version_info[0] == 3:
+    import queue as Queue
+else:
+    import Queue
 
 
 ### ---- Private Functions ----
 def normalizeString(string):
-    """Removes/fixes leading/trailing newlines/whitespace and escapes double quotes with double quotes (to comply with CSV format)"""
+    """Removes/fixes leading/trailing newlines/whitespace.
+    Quoting is left to the output encoders (see OutputWriter.formatRecord) so that JSON output isn't mangled by CSV escaping."""
     string = re.sub(r'(\r\n|\r|\n)', '\n', string) # Convert all newlines to unix newlines
     string = string.strip() # Remove leading/trailing whitespace/blank lines
-    srting = re.sub(r'(")', '""', string) # Convert double quotes to double double quotes (e.g. 'foo "bar" blah' becomes 'foo ""bar"" blah')
     return string
 
 
+def prefetch(iterable, size):
+    """Iterates over 'iterable' in a background thread, staying up to 'size' items ahead of the consumer.
+    Used to run slow per-host steps (e.g. ssh_config resolution) ahead of dispatch."""
+    queue = Queue.Queue(maxsize=size)
+    done = object()
+
+    def fill():
+        try:
+            for item in iterable:
+                queue.put((item, None))
+            queue.put((done, None))
+        except Exception as detail:
+            queue.put((done, detail))
+    thread = threading.Thread(target=fill, name="Prefetch")
+    thread.daemon = True
+    thread.start()
+    while True:
+        item, error = queue.get()
+        if item is done:
+            if error is not None:
+                raise error
+            return
+        yield item
+
+
+class ConnectionFailure(str):
+    """What a failed connection attempt returns instead of a connection: the error message (as before) plus a
+    short 'reason' ('dns', 'refused', 'timeout', 'network', 'auth', 'hostkey' or 'ssh') that can be counted"""
+    def __new__(cls, message, reason='ssh'):
+        failure = str.__new__(cls, message)
+        failure.reason = reason
+        return failure
+
+
+class HostKeyRejected(Exception):
+    """The host's key isn't one the --host-key-policy accepts (unknown with strict, revoked)"""
+
+
+class CommandTimeout(Exception):
+    """A command ran past its deadline.  'output' is what it printed until then (or a '[streamed N bytes]' marker);
+    executeCommands() adds 'outputs': that of every command of the host up to this one."""
+    def __init__(self, output, seconds):
+        super(CommandTimeout, self).__init__(f"timed out after {seconds:g}s")
+        self.output = output
+        self.outputs = [output]
+
+
+def commandDeadline(command_timeout=None, run_deadline=None):
+    """Returns the time.monotonic() by which a command starting now has to be done: 'command_timeout' seconds from now
+    or the run's deadline (a time.time(), it may come from another process), whichever is first.  None for no limit."""
+    deadlines = []
+    if command_timeout:
+        deadlines.append(time.monotonic() + command_timeout)
+    if run_deadline:
+        deadlines.append(time.monotonic() + (run_deadline - time.time()))
+    return min(deadlines) if deadlines else None
+
+
+def failureReason(detail, auth_errors=()):
+    """Classifies the exception of a failed connection attempt (see ConnectionFailure)"""
+    if auth_errors and isinstance(detail, auth_errors):
+        return 'auth'
+    if isinstance(detail, HostKeyRejected):
+        return 'hostkey'
+    if isinstance(detail, socket.gaierror):
+        return 'dns'
+    # Only the asyncio engine raises asyncio.TimeoutError, and it has imported asyncio by then
+    asyncio = sys.modules.get('asyncio')
+    if isinstance(detail, (socket.timeout, asyncio.TimeoutError) if asyncio else socket.timeout):
+        return 'timeout'
+    if isinstance(detail, ConnectionRefusedError):
+        return 'refused'
+    if isinstance(detail, (OSError, EOFError)) or 'protocol banner' in str(detail):
+        # Includes sshd hanging up before its banner, which is what MaxStartups looks like from here
+        return 'network'
+    return 'ssh'
+
+
+class StreamSplitter(object):
+    """Turns raw chunks of channel data into output events as they arrive.
+    mode - 'line' emits one event per complete line, 'chunk' emits whatever was decoded from each chunk."""
+    def __init__(self, mode='line'):
+        self.mode = mode
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.partial = ''
+        self.total_bytes = 0
+
+    def feed(self, data):
+        """Returns the list of events made complete by 'data'"""
+        self.total_bytes += len(data)
+        text = self.decoder.decode(data)
+        if self.mode == 'chunk':
+            return [text] if text else []
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
+        return lines
+
+    def close(self):
+        """Returns whatever is left once the channel hit EOF"""
+        text = self.partial + self.decoder.decode(b'', final=True)
+        self.partial = ''
+        return [text] if text else []
+
+
 class Password(object):
     def __init__(self, s):
         self.password = s
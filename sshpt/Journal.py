@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Copyright 2011 Dan McDougall <YouKnowWho@YouKnowWhat.com>
+#       Copyright 2015 Jonghak Choi <haginara@gmail.com>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; Version 3 of the License
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, the license can be downloaded here:
+#
+#       http://www.gnu.org/licenses/gpl.html
+
+import os
+import json
+import hashlib
+import threading
+import logging
+
+logger = logging.getLogger("sshpt")
+
+
+def workHash(queueObj):
+    """Returns a short hash of the work a job does on its host (commands, file to copy and how), so that a journal
+    entry only counts for the same commands"""
+    work = [queueObj.get('commands') or [], queueObj.get('local_filepath'), queueObj.get('remote_filepath'),
+            bool(queueObj.get('execute')), bool(queueObj.get('remove')), queueObj.get('sudo') or False]
+    return hashlib.sha1(json.dumps(work, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def journalKey(queueObj):
+    return (queueObj['host'], str(queueObj.get('port', 22)), queueObj.get('work_hash') or workHash(queueObj))
+
+
+class Journal(object):
+    """
+    Append-only record of the hosts a run is done with, one "host<TAB>port<TAB>work hash<TAB>status" line per result.
+
+    It is a flush observer of the OutputThread, so a host is only journaled once the outfile was flushed with its
+    result (or once it was printed, without an outfile).  Each line is flushed as it is written: whatever the journal
+    holds survives Ctrl-C (or worse) and can be --resume'd.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'a', buffering=1)
+        if self.file.tell() and not self.endsWithNewline():
+            # The last run was cut short mid-line: don't glue our first line onto that half (loadJournal() skips it)
+            self.file.write("\n")
+
+    def endsWithNewline(self):
+        with open(self.path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def observe(self, queueObj):
+        if 'event' in queueObj or queueObj['connection_result'] == 'SKIPPED':
+            return # Skipped hosts (see Rollout) are still to do
+        host, port, work = journalKey(queueObj)
+        with self.lock:
+            if self.file is not None:
+                self.file.write(f"{host}\t{port}\t{work}\t{queueObj['connection_result']}\n")
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def loadJournal(path, successful_only=False):
+    """Returns the set of journalKey()s that 'path' lists as done ('successful_only': as done with SUCCESS).
+    A host journaled more than once counts with its last status.  A missing journal is an empty one."""
+    statuses = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if not line.endswith('\n') or len(fields) != 4:
+                    continue # Cut short by whatever interrupted the run
+                statuses[tuple(fields[:3])] = fields[3]
+    except FileNotFoundError:
+        logger.warning("Journal %s doesn't exist yet: nothing to resume", path)
+    return set(key for key, status in statuses.items() if status == 'SUCCESS' or not successful_only)
+
+
+def skipJournaled(jobs, done=()):
+    """Yields the jobs of 'jobs' whose journalKey() isn't in 'done', with their 'work_hash' set: the OutputThread
+    rewrites 'commands' for display before the Journal gets to see them"""
+    skipped = 0
+    for job in jobs:
+        job['work_hash'] = workHash(job)
+        if journalKey(job) in done:
+            skipped += 1
+            continue
+        yield job
+    if done:
+        logger.info("Skipped %d hosts the journal lists as done", skipped)
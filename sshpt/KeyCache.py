@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Copyright 2011 Dan McDougall <YouKnowWho@YouKnowWhat.com>
+#       Copyright 2015 Jonghak Choi <haginara@gmail.com>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; Version 3 of the License
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, the license can be downloaded here:
+#
+#       http://www.gnu.org/licenses/gpl.html
+
+import os
+import base64
+import struct
+import getpass
+import threading
+import logging
+
+logger = logging.getLogger("sshpt")
+
+# Private key files tried (in this order) when no -k/--key-file path is given
+DEFAULT_KEY_FILES = ['~/.ssh/id_ed25519', '~/.ssh/id_ecdsa', '~/.ssh/id_rsa']
+
+
+def defaultKeyFile():
+    """Returns the first of DEFAULT_KEY_FILES that exists (or ~/.ssh/id_rsa if none do)"""
+    for key_file in DEFAULT_KEY_FILES:
+        if os.path.exists(os.path.expanduser(key_file)):
+            return os.path.expanduser(key_file)
+    return os.path.expanduser(DEFAULT_KEY_FILES[-1])
+
+
+def loadParamikoKey(key_file, key_pass=None, prompt=True):
+    """Loads an Ed25519, ECDSA or RSA private key, working out which one it is from the file.
+    Prompts for the passphrase if the key needs one that wasn't given (and 'prompt' is set)."""
+    import paramiko
+    try:
+        return _paramikoKeyFromFile(paramiko, key_file, None)
+    except paramiko.PasswordRequiredException:
+        if not key_pass:
+            if not prompt:
+                raise
+            key_pass = getpass.getpass("Enter passphrase for %s: " % key_file)
+        return _paramikoKeyFromFile(paramiko, key_file, key_pass)
+
+
+def _paramikoKeyFromFile(paramiko, key_file, key_pass):
+    key_classes = [paramiko.Ed25519Key, paramiko.ECDSAKey, paramiko.RSAKey]
+    # Try the class the file says it is first so that an encrypted key only goes through its (slow) KDF once
+    key_type = detectKeyType(key_file)
+    key_classes.sort(key=lambda key_class: key_class.__name__ != KEY_CLASSES.get(key_type))
+    for key_class in key_classes:
+        try:
+            return key_class.from_private_key_file(key_file, password=key_pass)
+        except paramiko.PasswordRequiredException:
+            raise
+        except paramiko.SSHException:
+            continue
+    raise paramiko.SSHException("%s is not a supported private key (tried Ed25519, ECDSA and RSA)" % key_file)
+
+
+# Key type (as found by detectKeyType) -> paramiko class name
+KEY_CLASSES = {'ed25519': 'Ed25519Key', 'ecdsa': 'ECDSAKey', 'rsa': 'RSAKey'}
+
+
+def detectKeyType(key_file):
+    """Works out the type of a private key from its (unencrypted) header: 'ed25519', 'ecdsa', 'rsa' or None"""
+    try:
+        with open(key_file) as f:
+            lines = f.read().strip().splitlines()
+    except (IOError, UnicodeDecodeError):
+        return None
+    if not lines:
+        return None
+    if 'BEGIN RSA PRIVATE KEY' in lines[0]:
+        return 'rsa'
+    if 'BEGIN EC PRIVATE KEY' in lines[0]:
+        return 'ecdsa'
+    if 'BEGIN OPENSSH PRIVATE KEY' not in lines[0]:
+        return None
+    # openssh-key-v1: magic, then cipher/kdf/kdf options and the key count, then the public key whose first field is its type
+    try:
+        blob = base64.b64decode("".join(lines[1:-1]))
+        offset = len(b"openssh-key-v1\0")
+        for _ in range(3):
+            offset += 4 + struct.unpack(">I", blob[offset:offset + 4])[0]
+        offset += 4 + 4 # Number of keys, then the length of the public key blob
+        type_length = struct.unpack(">I", blob[offset:offset + 4])[0]
+        key_type = blob[offset + 4:offset + 4 + type_length].decode('ascii')
+    except (ValueError, struct.error, UnicodeDecodeError):
+        return None
+    if key_type == 'ssh-ed25519':
+        return 'ed25519'
+    if key_type.startswith('ecdsa-'):
+        return 'ecdsa'
+    if key_type == 'ssh-rsa':
+        return 'rsa'
+    return None
+
+
+class KeyCache(object):
+    """
+    Loads (and decrypts) each private key file once and hands the same key object to every worker.
+
+    loader - Callable: loader(key_file, key_pass) returning the key object for the engine in use.
+    """
+    def __init__(self, loader=loadParamikoKey):
+        self.loader = loader
+        self.lock = threading.Lock()
+        self.keys = {}
+        self.failures = {} # (path, passphrase): why loading failed, so that a wrong -K costs one KDF run (or prompt)
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, key_file, key_pass=None, **kwargs):
+        """Returns the key in 'key_file', loading it only the first time it is asked for.
+        A key that failed to load raises the same error again for the same passphrase without trying again."""
+        path = os.path.abspath(os.path.expanduser(key_file))
+        # One lock for all keys: only one thread ever prompts for (or runs the KDF of) a passphrase
+        with self.lock:
+            key = self.keys.get(path)
+            if key is not None:
+                self.hits += 1
+                return key
+            failure = self.failures.get((path, key_pass))
+            if failure is not None:
+                self.hits += 1
+                raise failure
+            self.misses += 1
+            logger.debug("Loading private key %s", path)
+            try:
+                key = self.loader(path, key_pass, **kwargs)
+            except Exception as detail:
+                self.failures[(path, key_pass)] = detail
+                raise
+            self.keys[path] = key
+            return key
+
+    def cached(self, key_file):
+        """Returns the key in 'key_file' if it is loaded already, None otherwise.
+        Doesn't take the lock (a dict lookup is atomic): it never waits for another key's KDF."""
+        return self.keys.get(os.path.abspath(os.path.expanduser(key_file)))
+
+    def stats(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, keys=len(self.keys))
+
+    def clear(self):
+        with self.lock:
+            self.keys.clear()
+            self.failures.clear()
+
+
+# Shared by every SSHThread of the process
+key_cache = KeyCache()
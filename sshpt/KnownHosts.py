@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Copyright 2011 Dan McDougall <YouKnowWho@YouKnowWhat.com>
+#       Copyright 2015 Jonghak Choi <haginara@gmail.com>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; Version 3 of the License
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, the license can be downloaded here:
+#
+#       http://www.gnu.org/licenses/gpl.html
+
+import os
+import hmac
+import base64
+import hashlib
+import fnmatch
+import threading
+import logging
+
+logger = logging.getLogger("sshpt")
+
+# --host-key-policy choices
+POLICIES = ('strict', 'accept-new', 'off')
+
+DEFAULT_PATH = "~/.ssh/known_hosts"
+
+# Hashed names with fewer distinct salts than this are cheap enough to look up whatever their layout
+MANY_SALTS = 1000
+
+# HMAC (RFC 2104) key paddings, as bytes.translate() tables
+_IPAD = bytes(byte ^ 0x36 for byte in range(256))
+_OPAD = bytes(byte ^ 0x5c for byte in range(256))
+
+
+def hmacStates(salt):
+    """Returns the SHA-1 states HMAC-SHA1 keyed with 'salt' starts its inner and outer hashes from.  Copying those
+    per lookup costs about half of copying an hmac object (and a third of a one-shot hmac.digest(), which keys again)."""
+    key = salt if len(salt) <= 64 else hashlib.sha1(salt).digest()
+    key = key.ljust(64, b'\0')
+    return hashlib.sha1(key.translate(_IPAD)), hashlib.sha1(key.translate(_OPAD))
+
+
+def hostKeyName(host, port=22):
+    """Returns how known_hosts names 'host': "host" on port 22, "[host]:port" otherwise"""
+    port = int(port or 22)
+    return host if port == 22 else f"[{host}]:{port}"
+
+
+class KnownHostsIndex(object):
+    """
+    A known_hosts file, read once and indexed in memory so that checking a host key costs a dict lookup
+    whatever the size of the file.  Every worker (thread or coroutine) of the process shares it.
+
+    Plain host names are looked up directly.  Hashed names (|1|salt|hash, ssh-keygen -H) can't be, so they are indexed
+    by salt: a lookup computes one HMAC per distinct salt, from SHA-1 states keyed once at load time (see hmacStates()).
+    ssh-keygen -H gives every line a salt of its own, so with such a file that is one HMAC per line and host (about
+    65ms per host for 50k lines): SSHPowerTool looks keys up ahead of dispatch (see lookupAhead()) and load() warns
+    about it.  Answers are memoized per host.  Keys learned with accept-new are written out in batches of 'batch' lines (and by flush()),
+    hashed with a single salt when the file already hashes its names.
+
+    path - String: The known_hosts file (it doesn't have to exist)
+    """
+    def __init__(self, path=DEFAULT_PATH, batch=1000):
+        self.path = os.path.expanduser(path)
+        self.batch = batch
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.plain = {} # name: {keytype: set(key blobs)}
+        self.hashed = {} # salt: (inner SHA-1 state, outer SHA-1 state, {digest: {keytype: set(key blobs)}})
+        self.hashed_names = 0
+        self.patterns = [] # ([patterns], {keytype: set(key blobs)}) of lines with wildcards or negations
+        self.revoked = set() # Key blobs of @revoked lines
+        self.memo = {}
+        self.pending = [] # Lines learned and not written yet
+        self.salt = None # For the names of learned keys, when the file hashes its names
+
+    def load(self):
+        with self.lock:
+            if self.loaded:
+                return
+            self.loaded = True
+            try:
+                with open(self.path) as f:
+                    for line in f:
+                        self.parseLine(line)
+            except FileNotFoundError:
+                logger.info("No known_hosts file at %s yet", self.path)
+            logger.debug("Loaded %s: %d names, %d salts, %d patterns", self.path, len(self.plain), len(self.hashed), len(self.patterns))
+            if len(self.hashed) >= MANY_SALTS and len(self.hashed) * 2 >= self.hashed_names:
+                logger.warning("%s hashes its %d names with %d different salts: checking a host key takes one HMAC per salt. "
+                               "For large runs, an unhashed known_hosts (see --known-hosts) is much faster",
+                               self.path, self.hashed_names, len(self.hashed))
+
+    def parseLine(self, line):
+        fields = line.split()
+        if not fields or fields[0].startswith('#'):
+            return
+        marker = fields.pop(0) if fields[0].startswith('@') else None
+        if len(fields) < 3:
+            return
+        names, keytype, key = fields[:3]
+        try:
+            blob = base64.b64decode(key)
+        except (ValueError, TypeError):
+            logger.debug("Skipping malformed known_hosts line: %s", line.rstrip())
+            return
+        if marker == '@revoked':
+            self.revoked.add(blob)
+            return
+        if marker is not None:
+            return # @cert-authority: host certificates aren't supported
+        if names.startswith('|1|'):
+            try:
+                salt, digest = (base64.b64decode(part) for part in names[3:].split('|'))
+            except (ValueError, TypeError):
+                return
+            if salt not in self.hashed:
+                self.hashed[salt] = hmacStates(salt) + ({},)
+                self.salt = self.salt or salt
+            self.hashed_names += 1
+            self.addKey(self.hashed[salt][2].setdefault(digest, {}), keytype, blob)
+            return
+        patterns = names.split(',')
+        if any(pattern[0] == '!' or '*' in pattern or '?' in pattern for pattern in patterns):
+            keys = {}
+            self.addKey(keys, keytype, blob)
+            self.patterns.append((patterns, keys))
+            return
+        for name in patterns:
+            self.addKey(self.plain.setdefault(name, {}), keytype, blob)
+
+    @staticmethod
+    def addKey(keys, keytype, blob):
+        keys.setdefault(keytype, set()).add(blob)
+
+    def lookup(self, name):
+        """Returns the {keytype: set(key blobs)} known for 'name' (see hostKeyName()), revoked keys left out"""
+        if not self.loaded:
+            self.load()
+        known = self.memo.get(name)
+        if known is not None:
+            return known
+        found = []
+        if name in self.plain:
+            found.append(self.plain[name])
+        encoded = name.encode('utf-8')
+        for inner, outer, digests in self.hashed.values():
+            mac = inner.copy()
+            mac.update(encoded)
+            final = outer.copy()
+            final.update(mac.digest())
+            keys = digests.get(final.digest())
+            if keys:
+                found.append(keys)
+        for patterns, keys in self.patterns:
+            matched = [not pattern.startswith('!') for pattern in patterns if fnmatch.fnmatch(name, pattern.lstrip('!'))]
+            if matched and all(matched):
+                found.append(keys)
+        known = {}
+        for keys in found:
+            for keytype, blobs in keys.items():
+                blobs = blobs - self.revoked
+                if blobs:
+                    known.setdefault(keytype, set()).update(blobs)
+        with self.lock:
+            self.memo[name] = known
+        return known
+
+    def isRevoked(self, blob):
+        if not self.loaded:
+            self.load()
+        return blob in self.revoked
+
+    def learn(self, name, keytype, blob):
+        """Adds a key seen for the first time (accept-new) to the index, and to the file with the next batch"""
+        if self.salt is not None:
+            digest = hmac.new(self.salt, name.encode('utf-8'), hashlib.sha1).digest()
+            written = f"|1|{base64.b64encode(self.salt).decode()}|{base64.b64encode(digest).decode()}"
+        else:
+            written = name
+        with self.lock:
+            self.addKey(self.plain.setdefault(name, {}), keytype, blob)
+            self.memo.pop(name, None)
+            self.pending.append(f"{written} {keytype} {base64.b64encode(blob).decode()}\n")
+            full = len(self.pending) >= self.batch
+        logger.warning("Permanently added '%s' (%s) to the list of known hosts", name, keytype)
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Appends the keys learned since the last flush to the file, in one write"""
+        with self.lock:
+            lines, self.pending = self.pending, []
+        if not lines:
+            return
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory, mode=0o700)
+            # O_APPEND and one write(): lines of concurrent runs (or worker processes) never interleave
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            try:
+                os.write(fd, "".join(lines).encode('utf-8'))
+            finally:
+                os.close(fd)
+        except OSError as detail:
+            logger.error("Could not add %d host keys to %s: %s", len(lines), self.path, detail)
+
+
+def lookupAhead(jobs):
+    """Yields 'jobs' with the keys known for their host added ('known_keys', see KnownHostsIndex.lookup()), so that
+    the HMACs of a hashed known_hosts are computed ahead of dispatch, not by the workers (or on an event loop, or
+    once more by each worker process)"""
+    for job in jobs:
+        if 'connection_result' not in job and job.get('host_key_policy', 'off') != 'off':
+            job['known_keys'] = knownHostsIndex(job.get('known_hosts')).lookup(hostKeyName(job['host'], job.get('port', 22)))
+        yield job
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def knownHostsIndex(path=None):
+    """Returns the process wide KnownHostsIndex of 'path' (default: ~/.ssh/known_hosts)"""
+    path = os.path.expanduser(path or DEFAULT_PATH)
+    with _indexes_lock:
+        index = _indexes.get(path)
+        if index is None:
+            index = _indexes[path] = KnownHostsIndex(path)
+        return index
+
+
+def flushKnownHosts():
+    """Writes out the keys every index learned (once the run is done, or interrupted)"""
+    with _indexes_lock:
+        indexes = list(_indexes.values())
+    for index in indexes:
+        index.flush()
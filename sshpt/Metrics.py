@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Copyright 2011 Dan McDougall <YouKnowWho@YouKnowWhat.com>
+#       Copyright 2015 Jonghak Choi <haginara@gmail.com>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; Version 3 of the License
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, the license can be downloaded here:
+#
+#       http://www.gnu.org/licenses/gpl.html
+
+import os
+import time
+import threading
+import logging
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger("sshpt")
+
+# Rates (per second) are averaged over this many seconds
+RATE_WINDOW = 10
+
+
+class RateCounter(object):
+    """A counter that also knows its rate over the last RATE_WINDOW seconds (kept as per-second buckets)"""
+    def __init__(self):
+        self.total = 0
+        self.buckets = deque()
+
+    def add(self, amount=1):
+        self.total += amount
+        second = int(time.monotonic())
+        if self.buckets and self.buckets[-1][0] == second:
+            self.buckets[-1][1] += amount
+        else:
+            self.buckets.append([second, amount])
+            self._expire(second)
+
+    def rate(self):
+        self._expire(int(time.monotonic()))
+        return sum(amount for second, amount in self.buckets) / float(RATE_WINDOW)
+
+    def _expire(self, now):
+        while self.buckets and self.buckets[0][0] <= now - RATE_WINDOW:
+            self.buckets.popleft()
+
+
+class RunMetrics(object):
+    """
+    Live counters of a run, rendered in the Prometheus text format.
+
+    The scheduler (SSHPowerTool.run) counts every host it dispatches with hostQueued().  Results (and --stream events)
+    are counted as the OutputThread writes them: RunMetrics is an output observer, which works the same whether the
+    workers are threads, an event loop or other processes.  Hosts in flight are the dispatched ones that are neither
+    finished nor still waiting in the engine's queue.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.engine = None # The engine's queue (anything with qsize()), set once the engine is started
+        self.concurrency = None # The AdaptiveLimiter with --adaptive
+        self.queued = 0
+        self.results = {}
+        self.failures = {}
+        self.connected = RateCounter() # Hosts that got connected, counted when their result comes in
+        self.output_bytes = RateCounter()
+
+    def hostQueued(self):
+        with self.lock:
+            self.queued += 1
+
+    def observe(self, queueObj):
+        with self.lock:
+            if 'event' in queueObj:
+                self.output_bytes.add(len(queueObj['data']))
+                return
+            status = queueObj['connection_result']
+            self.results[status] = self.results.get(status, 0) + 1
+            reason = queueObj.get('failure_reason')
+            if status != 'SUCCESS':
+                reason = reason or 'other'
+                self.failures[reason] = self.failures.get(reason, 0) + 1
+            if status == 'SUCCESS' or reason in ('command', 'command_timeout'):
+                self.connected.add()
+            if 'output_bytes' in queueObj:
+                self.output_bytes.add(queueObj['output_bytes'])
+            elif not queueObj.get('stream') and isinstance(queueObj['command_output'], str):
+                # Streamed output was already counted event by event
+                self.output_bytes.add(len(queueObj['command_output']))
+
+    def render(self):
+        """Returns the metrics in the Prometheus text exposition format"""
+        try:
+            waiting = self.engine.qsize() if self.engine is not None else 0
+        except NotImplementedError:
+            waiting = 0 # e.g. a multiprocessing.Queue on macOS
+        with self.lock:
+            finished = sum(self.results.values())
+            metrics = [
+                ('sshpt_hosts_queued_total', 'counter', 'Hosts dispatched to the engine', [('', self.queued)]),
+                ('sshpt_hosts_waiting', 'gauge', 'Hosts dispatched but waiting for a free worker', [('', waiting)]),
+                ('sshpt_hosts_in_flight', 'gauge', 'Hosts being connected to or running commands', [('', max(self.queued - finished - waiting, 0))]),
+                ('sshpt_hosts_completed_total', 'counter', 'Hosts done, by result',
+                 [(f'{{result="{status}"}}', count) for status, count in sorted(self.results.items())] or [('', 0)]),
+                ('sshpt_hosts_failed_total', 'counter', 'Failed hosts, by reason',
+                 [(f'{{reason="{reason}"}}', count) for reason, count in sorted(self.failures.items())] or [('', 0)]),
+                ('sshpt_hosts_connected_total', 'counter', 'Finished hosts that connected (their commands may have failed)', [('', self.connected.total)]),
+                ('sshpt_hosts_connected_per_second', 'gauge', f'Finished hosts that connected, per second over the last {RATE_WINDOW}s', [('', self.connected.rate())]),
+                ('sshpt_output_bytes_total', 'counter', 'Command output received', [('', self.output_bytes.total)]),
+                ('sshpt_output_bytes_per_second', 'gauge', f'Command output received per second over the last {RATE_WINDOW}s', [('', self.output_bytes.rate())]),
+                ('sshpt_run_seconds', 'gauge', 'Time since the run started', [('', round(time.time() - self.started, 3))]),
+            ]
+            if self.concurrency is not None:
+                metrics.append(('sshpt_concurrency_limit', 'gauge', 'Hosts allowed in flight at once (--adaptive)', [('', int(self.concurrency.limit))]))
+        lines = []
+        for name, kind, help_text, samples in metrics:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics: " + format, *args)
+
+
+class MetricsPublisher(object):
+    """
+    Publishes RunMetrics while the run goes on: over HTTP on localhost ('port', e.g. for Prometheus to scrape)
+    and/or by rewriting 'stats_file' every 'interval' seconds (e.g. for node_exporter's textfile collector).
+    """
+    def __init__(self, metrics, port=None, stats_file=None, interval=5.0):
+        self.metrics = metrics
+        self.stats_file = stats_file
+        self.interval = interval
+        self.server = None
+        self.stopping = threading.Event()
+        if port is not None:
+            self.server = HTTPServer(('127.0.0.1', port), MetricsHandler)
+            self.server.metrics = metrics
+            thread = threading.Thread(target=self.server.serve_forever, name="MetricsServer")
+            thread.daemon = True
+            thread.start()
+            logger.info("Serving metrics on http://127.0.0.1:%d/metrics", self.server.server_address[1])
+        if stats_file:
+            thread = threading.Thread(target=self.writeLoop, name="MetricsWriter")
+            thread.daemon = True
+            thread.start()
+
+    def writeLoop(self):
+        while not self.stopping.wait(self.interval):
+            self.writeStats()
+
+    def writeStats(self):
+        """Replaces the stats file in one go so that readers never see half of it"""
+        temp_path = f"{self.stats_file}.tmp"
+        try:
+            with open(temp_path, 'w') as f:
+                f.write(self.metrics.render())
+            os.replace(temp_path, self.stats_file)
+        except (IOError, OSError) as detail:
+            logger.warning("Could not write the stats file %s: %s", self.stats_file, detail)
+
+    def stop(self):
+        """Writes the final numbers to the stats file and stops serving"""
+        self.stopping.set()
+        if self.stats_file:
+            self.writeStats()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
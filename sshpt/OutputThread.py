@@ -20,10 +20,11 @@
 
 from __future__ import print_function
 from .Generic import GenericThread
+from .Spool import readSpool, removeSpool
+from .OutputWriter import openWriter, formatRecord
 
 import sys
 import pprint
-import json
 import datetime
 import threading
 if sys.version_info[0] == 3:
@@ -45,8 +46,11 @@ class OutputThread(GenericThread):
     output_queue: Queue.Queue(): The queue to use for incoming messages.
     verbose - Boolean: Whether or not we should output to stdout.
     outfile - String: Path to the file where we'll store results.
+    flush_policy - FlushPolicy(): When buffered outfile writes are flushed (see OutputWriter).
+    observers - List: Objects whose observe(queueObj) is called with every result (and --stream event) once it is written (e.g. RunSummary).
+    flush_observers - List: Objects whose observe(queueObj) is called with every result once the outfile was flushed with it (e.g. Journal).
     """
-    def __init__(self, output_queue, verbose=True, outfile=None, output_format='csv'):
+    def __init__(self, output_queue, verbose=True, outfile=None, output_format='csv', flush_policy=None, observers=None, flush_observers=None):
         """Name ourselves and assign the variables we were instanciated with."""
         super(OutputThread, self).__init__(name="OutputThread")
         self.output_queue = output_queue
@@ -54,19 +58,52 @@ class OutputThread(GenericThread):
         self.outfile = outfile
         self.quitting = False
         self.output_format = output_format
+        self.writer = openWriter(outfile, output_format, flush_policy) if outfile else None
+        self.observers = observers or []
+        self.flush_observers = flush_observers or []
+        self.unflushed = [] # Results written to the outfile, waiting on its next flush for the flush_observers
+        if self.writer and self.flush_observers:
+            self.writer.on_flush = self.flushed
 
-    def printToStdout(self, output):
+    def printToStdout(self, output, write_outfile=True):
         """Prints output if self.verbose is set to True"""
         if self.verbose is True:
-            if self.output_format == 'csv':
-                print(output)
-            elif self.output_format == 'json':
+            if self.output_format == 'json':
                 pprint.pprint(output, width=100)
-                output = json.dumps(output)
+            else:
+                # CSV, also used on stdout when the outfile is an SQLite database
+                print(formatRecord(output, 'csv'))
 
-        if self.outfile:
-            with open(self.outfile, 'a') as f:
-                f.write(f"{output}\n")
+        if self.writer and write_outfile:
+            self.writer.write(output)
+
+    def spilledOutput(self, outputs, files):
+        """Yields the complete command output of a record that went over --output-budget, reading spilled
+        commands back from their files piece by piece instead of loading them into memory"""
+        for index, output in enumerate(outputs):
+            if index:
+                yield "\n"
+            if len(outputs) > 1:
+                # Only prepend 'index: ' if we were passed more than one command
+                yield f"{index}: "
+            if index in files:
+                for text in readSpool(files[index]):
+                    yield text
+            else:
+                yield output
+
+    def writeEvent(self, queueObj):
+        """Write a streamed output event (see --stream) and give the host back its buffer credit"""
+        try:
+            if self.output_format != 'json':
+                output = {'host': queueObj['host'], 'event': "STREAM", 'timestamp': str(datetime.datetime.now()), 'command': queueObj['command'], 'data': queueObj['data']}
+            else:
+                output = {'host': queueObj['host'], 'event': queueObj['event'], 'timestamp': str(datetime.datetime.now()), 'command': queueObj['command'], 'data': queueObj['data']}
+            self.printToStdout(output)
+        finally:
+            # Events forwarded from worker processes already had their credit released
+            if queueObj.get('credit') is not None:
+                queueObj['credit'].release()
 
     def writeOut(self, queueObj):
         """Write relevant queueObj information to stdout and/or to the outfile (if one is set)"""
@@ -84,6 +121,8 @@ class OutputThread(GenericThread):
                 queueObj['commands'] = "\n".join([f"{index}: sudo -u {queueObj['sudo']} {command}" for index, command in enumerate(queueObj['commands'])])
             else:
                 queueObj['commands'] = f"sudo -u {queueObj['sudo']} {''.join(queueObj['commands'])}"
+        outputs = queueObj['command_output']
+        files = queueObj.get('command_output_files')
         if isinstance(queueObj['command_output'], str):
             # Since it is a string we'll assume it is already formatted properly
             pass
@@ -92,28 +131,69 @@ class OutputThread(GenericThread):
             queueObj['command_output'] = "\n".join([f"{index}: {command}" for index, command in enumerate(queueObj['command_output'])])
         else:
             queueObj['command_output'] = "\n".join(queueObj['command_output'])
-        if self.output_format == 'csv':
-            output = f"\"{queueObj['host']}\",\"{queueObj['connection_result']}\",\"{datetime.datetime.now()}\",\"{queueObj['commands']}\",\"{queueObj['command_output']}\""
-        elif self.output_format == 'json':
-            output = {'host': queueObj['host'], 'connection_result': queueObj['connection_result'], 'timestamp': str(datetime.datetime.now()), 'commands': queueObj['commands'], 'command_output': queueObj['command_output']}
+        output = {'host': queueObj['host'], 'connection_result': queueObj['connection_result'], 'timestamp': str(datetime.datetime.now()), 'commands': queueObj['commands'], 'command_output': queueObj['command_output']}
+        if queueObj.get('timings'):
+            output['timings'] = queueObj['timings']
 
-        self.printToStdout(output)
+        if not files:
+            self.printToStdout(output)
+            return
+        try:
+            # stdout gets the head/tail excerpt, the outfile gets the complete output
+            self.printToStdout(output, write_outfile=False)
+            if self.writer:
+                self.writer.writePieces(output, 'command_output', self.spilledOutput(outputs, files))
+        finally:
+            removeSpool(files)
 
     def run(self):
         while not self.quitting:
-            queueObj = self.output_queue.get()
+            try:
+                # Only wait until what is buffered is due for its --flush-interval flush
+                queueObj = self.output_queue.get(timeout=self.writer.flushDelay() if self.writer else None)
+            except Queue.Empty:
+                self.writer.flush()
+                continue
             if queueObj == "quit":
                 self.quit()
-            self.writeOut(queueObj)
+                if self.writer:
+                    # Before task_done(): whoever put 'quit' and join()s the queue finds the outfile complete
+                    self.writer.close()
+            else:
+                if 'event' in queueObj:
+                    self.writeEvent(queueObj)
+                else:
+                    self.writeOut(queueObj)
+                    if self.writer and self.flush_observers:
+                        # Even if writing it just flushed the outfile: it gets to the flush_observers with the next flush
+                        self.unflushed.append(queueObj)
+                    else:
+                        self.notify(self.flush_observers, queueObj)
+                self.notify(self.observers, queueObj)
             self.output_queue.task_done()
+        if self.writer:
+            self.writer.close()
+
+    def notify(self, observers, queueObj):
+        for observer in observers:
+            try:
+                observer.observe(queueObj)
+            except Exception as detail:
+                logger.error("Output observer %s failed: %s", observer, detail)
+
+    def flushed(self):
+        """The writer's on_flush: the results written so far are in the outfile, hand them to the flush_observers"""
+        unflushed, self.unflushed = self.unflushed, []
+        for queueObj in unflushed:
+            self.notify(self.flush_observers, queueObj)
 
 
-def startOutputThread(verbose, outfile, output_format):
+def startOutputThread(verbose, outfile, output_format, flush_policy=None, observers=None, flush_observers=None):
     """
     Starts up the OutputThread (which is used by SSHThreads to print/write out results).
     """
     output_queue = Queue.Queue()
-    output_thread = OutputThread(output_queue, verbose, outfile, output_format)
+    output_thread = OutputThread(output_queue, verbose, outfile, output_format, flush_policy, observers, flush_observers)
     output_thread.setDaemon(True)
     output_thread.start()
     return output_queue
@@ -126,4 +206,7 @@ def stopOutputThread():
     for t in threading.enumerate():
         if t.getName().startswith('OutputThread'):
             t.quit()
+            if t.writer:
+                # The thread may be blocked on the queue: don't leave buffered results behind
+                t.writer.close()
     return True
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Copyright 2011 Dan McDougall <YouKnowWho@YouKnowWhat.com>
+#       Copyright 2015 Jonghak Choi <haginara@gmail.com>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; Version 3 of the License
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, the license can be downloaded here:
+#
+#       http://www.gnu.org/licenses/gpl.html
+
+import io
+import os
+import csv
+import json
+import time
+import uuid
+import sqlite3
+import datetime
+import threading
+import logging
+
+logger = logging.getLogger("sshpt")
+
+# Size of the buffer between the outfile and the disk
+BUFFER_SIZE = 1024 * 1024
+
+
+def formatRecord(record, output_format):
+    """Encodes a record (an ordered dict of fields) as one CSV row (every field quoted) or one JSON Lines line,
+    without the trailing newline"""
+    if output_format == 'json':
+        return json.dumps(record)
+    line = io.StringIO()
+    csv.writer(line, quoting=csv.QUOTE_ALL, lineterminator='').writerow([formatValue(value) for value in record.values()])
+    return line.getvalue()
+
+
+def formatValue(value):
+    """Flattens a field for CSV: dicts (e.g. timings) become 'key=value key=value'"""
+    if isinstance(value, dict):
+        return " ".join(f"{key}={item:.6f}" if isinstance(item, float) else f"{key}={item}" for key, item in value.items())
+    return value
+
+
+class FlushPolicy(object):
+    """
+    When OutputWriter hands what it has buffered to the OS.  Whichever limit is reached first triggers a flush.
+    The interval holds even when no record comes in (see flushDelay()), so a 'tail -f' never waits longer than it.
+
+    records - Integer: Flush after this many records (None for no limit)
+    bytes - Integer: Flush after this many bytes of (UTF-8 encoded) output (None for no limit)
+    interval - Float: Flush when the last flush is this many seconds old (None for no limit)
+    fsync - Boolean: Also fsync() the outfile on every flush
+    """
+    def __init__(self, records=1000, bytes=BUFFER_SIZE, interval=1.0, fsync=False):
+        self.records = records
+        self.bytes = bytes
+        self.interval = interval
+        self.fsync = fsync
+
+    def due(self, records, written, last_flush):
+        if self.records is not None and records >= self.records:
+            return True
+        if self.bytes is not None and written >= self.bytes:
+            return True
+        return self.interval is not None and time.time() - last_flush >= self.interval
+
+
+class OutputWriter(object):
+    """
+    Keeps the outfile open for the whole run and writes records to it through a buffer, in CSV or JSON Lines.
+
+    path - String: The outfile (appended to)
+    output_format - 'csv' or 'json'
+    policy - FlushPolicy(): When to flush (the FlushPolicy() defaults if None)
+    """
+    def __init__(self, path, output_format='csv', policy=None):
+        self.path = path
+        self.output_format = output_format
+        self.policy = policy or FlushPolicy()
+        self.lock = threading.Lock()
+        self.file = open(path, 'a', buffering=BUFFER_SIZE, encoding='utf-8', newline='')
+        self.records = 0
+        self.written = 0
+        self.last_flush = time.time()
+        self.on_flush = None # Called (holding self.lock) once everything written so far was flushed
+
+    def write(self, record):
+        """Writes one record (an ordered dict of fields)"""
+        self.writePieces(record, None, None)
+
+    def writePieces(self, record, field, pieces):
+        """Writes a record whose field 'field' is too big to hold in memory: its value in 'record' is ignored and
+        its text is written from the 'pieces' iterable (e.g. readSpool()) instead, escaped as it goes"""
+        with self.lock:
+            if self.file.closed:
+                logger.warning("Dropped a record for %s written after the outfile was closed", self.path)
+                return
+            if pieces is None:
+                self._write(formatRecord(record, self.output_format))
+            elif self.output_format == 'json':
+                # The same layout as json.dumps(), with the big field written as a JSON string a piece at a time
+                self._write('{')
+                for position, (key, value) in enumerate(record.items()):
+                    self._write((', ' if position else '') + json.dumps(key) + ': ')
+                    if key == field:
+                        self._write('"')
+                        for text in pieces:
+                            self._write(json.dumps(text)[1:-1])
+                        self._write('"')
+                    else:
+                        self._write(json.dumps(value))
+                self._write('}')
+            else:
+                # The same quoting as formatRecord(), with the big field written as a quoted value a piece at a time
+                for position, (key, value) in enumerate(record.items()):
+                    if position:
+                        self._write(',')
+                    if key == field:
+                        self._write('"')
+                        for text in pieces:
+                            self._write(text.replace('"', '""'))
+                        self._write('"')
+                    else:
+                        self._write(formatRecord({key: value}, self.output_format))
+            self._write('\n')
+            self.records += 1
+            if self.policy.due(self.records, self.written, self.last_flush):
+                self._flush()
+
+    def _write(self, text):
+        self.file.write(text)
+        self.written += len(text.encode('utf-8'))
+
+    def flush(self):
+        """Flushes whatever is buffered"""
+        with self.lock:
+            if not self.file.closed and (self.records or self.written):
+                self._flush()
+
+    def flushDelay(self):
+        """Seconds until what is buffered is due for its interval flush (None: nothing is buffered, or no interval)"""
+        with self.lock:
+            if self.file.closed or not (self.records or self.written) or self.policy.interval is None:
+                return None
+            return max(0.0, self.last_flush + self.policy.interval - time.time())
+
+    def _flush(self):
+        self.file.flush()
+        if self.policy.fsync:
+            os.fsync(self.file.fileno())
+        self.records = 0
+        self.written = 0
+        self.last_flush = time.time()
+        if self.on_flush:
+            self.on_flush()
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self._flush()
+                self.file.close()
+
+
+class SQLiteWriter(object):
+    """
+    Writes results to an SQLite database (-O sqlite) so they can be queried across runs, e.g.:
+
+        SELECT host FROM results WHERE status = 'FAILED' AND run_id IN (SELECT run_id FROM runs ORDER BY started DESC LIMIT 3)
+
+    Every run gets a row in 'runs' and one row per host in 'results' (with its timings as a JSON object).  Rows are inserted in batches, one transaction
+    per flush, following the same FlushPolicy as OutputWriter.  Streamed output events (--stream) are not stored.
+
+    The output of a host that went over --output-budget is never held in memory whole: its row gets the excerpt
+    and the complete output goes to 'output_chunks', one row per piece, e.g.:
+
+        SELECT group_concat(data, '') FROM (SELECT data FROM output_chunks WHERE result_id = ? ORDER BY seq)
+
+    path - String: The database file (created if needed)
+    policy - FlushPolicy(): When to commit (the FlushPolicy() defaults if None)
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS runs (run_id TEXT PRIMARY KEY, started TEXT, finished TEXT);
+        CREATE TABLE IF NOT EXISTS results (id INTEGER PRIMARY KEY, run_id TEXT NOT NULL, host TEXT NOT NULL,
+            status TEXT, timestamp TEXT, commands TEXT, output TEXT, timings TEXT);
+        CREATE INDEX IF NOT EXISTS results_host ON results (host, timestamp);
+        CREATE INDEX IF NOT EXISTS results_run_id ON results (run_id, status);
+        CREATE INDEX IF NOT EXISTS results_status ON results (status);
+        CREATE INDEX IF NOT EXISTS results_timestamp ON results (timestamp);
+        CREATE TABLE IF NOT EXISTS output_chunks (result_id INTEGER NOT NULL REFERENCES results (id), seq INTEGER NOT NULL,
+            data TEXT, PRIMARY KEY (result_id, seq));
+    """
+    INSERT = "INSERT INTO results (run_id, host, status, timestamp, commands, output, timings) VALUES (?, ?, ?, ?, ?, ?, ?)"
+
+    def __init__(self, path, policy=None):
+        self.path = path
+        self.policy = policy or FlushPolicy()
+        self.lock = threading.Lock()
+        # Opened by the caller's thread, used by the OutputThread (all access goes through self.lock)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(self.SCHEMA)
+        columns = [column[1] for column in self.db.execute("PRAGMA table_info(results)")]
+        if 'timings' not in columns:
+            # Databases created before results had timings
+            self.db.execute("ALTER TABLE results ADD COLUMN timings TEXT")
+        self.run_id = uuid.uuid4().hex
+        self.db.execute("INSERT INTO runs (run_id, started) VALUES (?, ?)", (self.run_id, str(datetime.datetime.now())))
+        self.db.commit()
+        self.pending = []
+        self.written = 0
+        self.last_flush = time.time()
+        self.on_flush = None # Called (holding self.lock) once everything written so far was committed
+
+    def write(self, record):
+        """Queues one result record for the next batch insert"""
+        self.writePieces(record, None, None)
+
+    def writePieces(self, record, field, pieces):
+        """Like write() for a record whose command output (its 'field') comes from the 'pieces' iterable.
+        The row keeps the excerpt in record[field]; the pieces are inserted into output_chunks as they are read,
+        in the same transaction as the row (and the pending ones, to keep their order)."""
+        if 'connection_result' not in record:
+            # A --stream output event: only the final result of each host is stored
+            return
+        with self.lock:
+            if self.db is None:
+                logger.warning("Dropped a record for %s written after the database was closed", self.path)
+                return
+            timings = json.dumps(record['timings']) if record.get('timings') else None
+            row = (self.run_id, record['host'], record['connection_result'], record['timestamp'], record['commands'], record['command_output'], timings)
+            if pieces is None:
+                self.pending.append(row)
+                self.written += sum(len(value.encode('utf-8')) for value in row[1:] if value)
+                if self.policy.due(len(self.pending), self.written, self.last_flush):
+                    self._flush()
+                return
+            with self.db:
+                self.db.executemany(self.INSERT, self.pending)
+                result_id = self.db.execute(self.INSERT, row).lastrowid
+                self.db.executemany("INSERT INTO output_chunks (result_id, seq, data) VALUES (?, ?, ?)",
+                                    ((result_id, seq, text) for seq, text in enumerate(text for text in pieces if text)))
+            self.pending = []
+            self.written = 0
+            self.last_flush = time.time()
+            if self.on_flush:
+                self.on_flush()
+
+    def flush(self):
+        """Inserts the pending records in one transaction"""
+        with self.lock:
+            if self.db is not None and self.pending:
+                self._flush()
+
+    def flushDelay(self):
+        """Seconds until the pending records are due for their interval flush (None: none are pending, or no interval)"""
+        with self.lock:
+            if self.db is None or not self.pending or self.policy.interval is None:
+                return None
+            return max(0.0, self.last_flush + self.policy.interval - time.time())
+
+    def _flush(self):
+        with self.db:
+            self.db.executemany(self.INSERT, self.pending)
+        self.pending = []
+        self.written = 0
+        self.last_flush = time.time()
+        if self.on_flush:
+            self.on_flush()
+
+    def close(self):
+        with self.lock:
+            if self.db is None:
+                return
+            self._flush()
+            with self.db:
+                self.db.execute("UPDATE runs SET finished = ? WHERE run_id = ?", (str(datetime.datetime.now()), self.run_id))
+            self.db.close()
+            self.db = None
+
+
+def openWriter(path, output_format='csv', policy=None):
+    """Returns the writer for an outfile in 'output_format' ('csv', 'json' or 'sqlite')"""
+    if output_format == 'sqlite':
+        return SQLiteWriter(path, policy)
+    return OutputWriter(path, output_format, policy)
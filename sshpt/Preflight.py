@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Copyright 2011 Dan McDougall <YouKnowWho@YouKnowWhat.com>
+#       Copyright 2015 Jonghak Choi <haginara@gmail.com>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; Version 3 of the License
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, the license can be downloaded here:
+#
+#       http://www.gnu.org/licenses/gpl.html
+
+import os
+import sys
+import time
+import errno
+import socket
+import selectors
+import logging
+from concurrent.futures import ThreadPoolExecutor
+if sys.version_info[0] == 3:
+    import queue as Queue
+else:
+    import Queue
+
+from .Timing import PhaseTimer
+from .Resolver import dns_cache, RESOLVE_ERRORS
+
+logger = logging.getLogger("sshpt")
+
+# connect() errors that only mean "not connected yet"
+IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY)
+
+
+class Probe(object):
+    """
+    A host being swept: non-blocking connects to each of its addresses, the first one to succeed wins.
+
+    sockets - List: Sockets still connecting
+    error - Exception: Why the last address that failed did
+    """
+    def __init__(self, job, timeout):
+        self.job = job
+        self.timer = PhaseTimer()
+        self.deadline = None
+        self.timeout = timeout
+        self.sockets = []
+        self.error = None
+        self.resolving = None # When the resolver pool got the host
+
+    def start(self, selector, addresses):
+        """Starts connecting to all of the host's 'addresses' (getaddrinfo() entries).  Returns True once the host is known to be
+        reachable (a connect succeeded right away)."""
+        self.deadline = time.monotonic() + self.timeout
+        for family, socktype, proto, canonname, address in addresses:
+            sock = socket.socket(family, socktype, proto)
+            sock.setblocking(False)
+            result = sock.connect_ex(address)
+            if result == 0:
+                sock.close()
+                return True
+            if result in IN_PROGRESS:
+                self.sockets.append(sock)
+                selector.register(sock, selectors.EVENT_WRITE, self)
+            else:
+                sock.close()
+                self.error = OSError(result, os.strerror(result))
+        return False
+
+    def close(self, selector):
+        for sock in self.sockets:
+            selector.unregister(sock)
+            sock.close()
+        self.sockets = []
+
+    def failed(self, reason, detail):
+        """Returns the job as a FAILED result"""
+        self.timer.add('connect', max(0.0, time.monotonic() - (self.deadline - self.timeout)) if self.deadline else 0.0)
+        self.job.update(connection_result="FAILED", command_output=str(detail), failure_reason=reason, timings=self.timer.stop(), settled=True)
+        return self.job
+
+
+def sweep(jobs, timeout=3.0, window=512, cache=dns_cache, workers=16):
+    """
+    Checks that every host of 'jobs' accepts TCP connections on its SSH port before it is dispatched, with one
+    selector loop probing up to 'window' hosts at once.  Hosts that weren't resolved ahead (see resolveAhead())
+    are resolved through 'cache' by a pool of 'workers' threads: getaddrinfo() blocks, and in the loop it would
+    hold up every probe in flight.
+
+    Yields reachable jobs as soon as a connection to them succeeds (the probe connection is closed right away) and
+    the others, as soon as all of their addresses refused or 'timeout' seconds went by, as FAILED results:
+    connection_result, command_output, failure_reason ('unreachable', or 'dns' when the host doesn't resolve),
+    timings and settled (True) are already set on those.  Jobs using a ProxyCommand (and results settled
+    earlier, e.g. by resolveAhead()) are yielded as they are.
+    """
+    selector = selectors.DefaultSelector()
+    probes = {} # Probes still connecting, in the order they started (and so of their deadlines)
+    resolving = set() # Probes whose host the resolver pool has
+    resolved = Queue.Queue() # (probe, future) of the hosts it is done with
+    # The pool wakes the selector up through this pair whenever it is done with a host
+    wakeup, notify = socket.socketpair()
+    wakeup.setblocking(False)
+    selector.register(wakeup, selectors.EVENT_READ, None)
+    executor = None
+
+    def hostResolved(probe, future):
+        resolved.put((probe, future))
+        try:
+            notify.send(b"\0")
+        except OSError:
+            pass # The sweep is over
+
+    def launch(probe, addresses):
+        """Starts connecting: returns the job once it is settled (reachable, or refused everywhere), None while it connects"""
+        if probe.start(selector, addresses):
+            probe.close(selector)
+            return probe.job
+        if probe.sockets:
+            probes[probe] = None
+            return None
+        return probe.failed('unreachable', probe.error)
+
+    jobs = iter(jobs)
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(probes) + len(resolving) < window:
+                job = next(jobs, None)
+                if job is None:
+                    exhausted = True
+                    break
+                if job.get('proxycommand') or 'connection_result' in job:
+                    yield job
+                    continue
+                probe = Probe(job, timeout)
+                if job.get('addresses'):
+                    probe.timer.add('dns', job.get('dns_time') or 0.0)
+                    result = launch(probe, job['addresses'])
+                    if result is not None:
+                        yield result
+                    continue
+                if executor is None:
+                    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Resolver")
+                probe.resolving = time.monotonic()
+                resolving.add(probe)
+                future = executor.submit(cache.resolve, job['host'], job.get('port', 22))
+                future.add_done_callback(lambda future, probe=probe: hostResolved(probe, future))
+            if not probes and not resolving:
+                if exhausted:
+                    return
+                continue
+
+            # Only hosts being resolved: wait for the pool (it wakes us up)
+            events = selector.select(max(0.0, next(iter(probes)).deadline - time.monotonic()) if probes else None)
+            # Only expire what was due when we last looked: connections made while the consumer held us up still count
+            now = time.monotonic()
+            for key, _ in events:
+                if key.data is None:
+                    try:
+                        wakeup.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                probe, sock = key.data, key.fileobj
+                if probe not in probes:
+                    continue # Another of its addresses already settled it
+                error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                selector.unregister(sock)
+                sock.close()
+                probe.sockets.remove(sock)
+                if error == 0:
+                    probe.close(selector)
+                    del probes[probe]
+                    yield probe.job
+                elif not probe.sockets:
+                    del probes[probe]
+                    yield probe.failed('unreachable', OSError(error, os.strerror(error)))
+            while probes and next(iter(probes)).deadline <= now:
+                probe = next(iter(probes))
+                probe.close(selector)
+                del probes[probe]
+                yield probe.failed('unreachable', f"TCP connection to port {probe.job.get('port', 22)} timed out after {timeout}s")
+            while True:
+                try:
+                    probe, future = resolved.get_nowait()
+                except Queue.Empty:
+                    break
+                resolving.discard(probe)
+                probe.timer.add('dns', time.monotonic() - probe.resolving)
+                try:
+                    addresses = future.result()
+                except RESOLVE_ERRORS as detail:
+                    yield probe.failed('dns', detail)
+                    continue
+                result = launch(probe, addresses)
+                if result is not None:
+                    yield result
+    finally:
+        for probe in probes:
+            probe.close(selector)
+        selector.close()
+        if executor is not None:
+            executor.shutdown(wait=False)
+        wakeup.close()
+        notify.close()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Copyright 2011 Dan McDougall <YouKnowWho@YouKnowWhat.com>
+#       Copyright 2015 Jonghak Choi <haginara@gmail.com>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; Version 3 of the License
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, the license can be downloaded here:
+#
+#       http://www.gnu.org/licenses/gpl.html
+
+import os
+import sys
+import time
+import threading
+import multiprocessing
+import logging
+if sys.version_info[0] == 3:
+    import queue as Queue
+else:
+    import Queue
+
+logger = logging.getLogger("sshpt")
+
+
+def _forwardResults(local_output_queue, results, job_ids):
+    """Worker side: moves results from the engine's output queue to the parent, handing stream credits back
+    only once the event made it onto the (bounded) inter-process queue"""
+    while True:
+        queueObj = local_output_queue.get()
+        credit = queueObj.pop('credit', None)
+        results.put(('result', job_ids.pop(id(queueObj), None), queueObj))
+        if credit is not None:
+            credit.release()
+        local_output_queue.task_done()
+
+
+def _workerProcess(jobs, results, max_threads, engine):
+    """Entry point of a worker process: runs its own engine (thread pool or event loop) over its share of the jobs"""
+    local_output_queue = Queue.Queue()
+    if engine == 'asyncio':
+        from .AsyncQueue import startAsyncQueue
+        ssh_connect_queue = startAsyncQueue(local_output_queue, max_threads)
+    else:
+        from .SSHQueue import startSSHQueue
+        ssh_connect_queue = startSSHQueue(local_output_queue, max_threads)
+    job_ids = {} # id() of each job dict in flight: the parent's number for it
+    forwarder = threading.Thread(target=_forwardResults, args=(local_output_queue, results, job_ids), name="ResultForwarder")
+    forwarder.daemon = True
+    forwarder.start()
+    try:
+        while True:
+            job = jobs.get()
+            if job == 'quit':
+                break
+            job_id, queueObj = job
+            # Only tells the parent the job left the queue (see qsize()): it handed the job to this process already
+            results.put(('taken', job_id, os.getpid()))
+            job_ids[id(queueObj)] = job_id
+            ssh_connect_queue.put(queueObj)
+        ssh_connect_queue.join()
+        local_output_queue.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        from .KnownHosts import flushKnownHosts
+        flushKnownHosts()
+        results.put(('done', None, os.getpid()))
+
+
+class ProcessSSHQueue(object):
+    """Shards jobs across worker processes so that key exchange and cipher work isn't limited to the one core the GIL allows.
+    Each worker process runs its own thread pool (or event loop) of max_threads, fed from its own job queue by put():
+    whichever live worker holds the fewest jobs gets the next one.  Their results are merged back onto output_queue,
+    so one OutputThread still writes everything.
+    It quacks like the Queue.Queue() returned by startSSHQueue (put/qsize/join).
+
+    When a worker process dies, the jobs it was handed (running or still in its queue) are reported FAILED
+    (reason 'worker'); when none is left, so is every job put() after that.
+
+    output_queue          Queue.Queue() to output results
+    processes             Number of worker processes
+    max_threads           Number of threads (or concurrent hosts with the asyncio engine) per worker process
+    engine                'thread' or 'asyncio'
+    """
+    def __init__(self, output_queue, processes, max_threads, engine='thread'):
+        self.output_queue = output_queue
+        self.processes = processes
+        self.condition = threading.Condition()
+        self.sequence = 0
+        self.outstanding = {} # job id: job dict, for every job put() and not done yet
+        self.owners = {} # job id: pid of the worker it was handed to
+        self.taken = set() # ids of the jobs their worker got out of its queue
+        self.finished = set() # pids of the workers that are done (or dead)
+        # Jobs handed to a worker at once: the ones it runs and as many waiting in its queue
+        self.capacity = max_threads * 2
+        context = multiprocessing.get_context()
+        self.results = context.Queue(maxsize=processes * max_threads * 4)
+        self.workers = []
+        self.queues = {} # pid: the worker's job queue
+        self.load = {} # pid: number of jobs handed to the worker and not done yet
+        for process_num in range(processes):
+            jobs = context.Queue()
+            worker = context.Process(target=_workerProcess, args=(jobs, self.results, max_threads, engine),
+                                     name="SSHProcess-%d" % process_num)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+            self.queues[worker.pid] = jobs
+            self.load[worker.pid] = 0
+        self.collector = threading.Thread(target=self.collectResults, name="ResultCollector")
+        self.collector.daemon = True
+        self.collector.start()
+
+    def alive(self):
+        return len(self.finished) < len(self.workers)
+
+    def collectResults(self):
+        """Parent side: puts every worker's results on output_queue until all workers are done (or dead)"""
+        checked = time.monotonic()
+        while self.alive():
+            if time.monotonic() - checked >= 1.0:
+                self.checkWorkers()
+                checked = time.monotonic()
+            try:
+                kind, job_id, payload = self.results.get(timeout=1.0)
+            except Queue.Empty:
+                continue
+            if kind == 'done':
+                with self.condition:
+                    self.finished.add(payload)
+                    self.condition.notify_all()
+            elif kind == 'taken':
+                with self.condition:
+                    if job_id in self.outstanding:
+                        self.taken.add(job_id)
+            elif job_id is None:
+                self.output_queue.put(payload) # A --stream event
+            else:
+                self.output_queue.put(payload)
+                with self.condition:
+                    if self.outstanding.pop(job_id, None) is not None:
+                        self.settle(job_id)
+                    self.condition.notify_all()
+
+    def checkWorkers(self):
+        """Reports the jobs of worker processes that died (all outstanding jobs once none is left)"""
+        with self.condition:
+            for worker in self.workers:
+                if worker.pid in self.finished or worker.is_alive():
+                    continue
+                logger.error("Worker process %s died (exit code %s)", worker.name, worker.exitcode)
+                self.finished.add(worker.pid)
+                # Nobody reads its queue any more: don't wait on it at exit
+                self.queues[worker.pid].cancel_join_thread()
+                for job_id in [job_id for job_id, pid in self.owners.items() if pid == worker.pid]:
+                    self.failJob(job_id, f"sshpt worker process {worker.name} died (exit code {worker.exitcode})")
+            if not self.alive():
+                for job_id in list(self.outstanding):
+                    self.failJob(job_id, "sshpt worker processes all died")
+            self.condition.notify_all()
+
+    def settle(self, job_id):
+        """Forgets which worker held 'job_id' (done or failed)"""
+        pid = self.owners.pop(job_id, None)
+        if pid is not None:
+            self.load[pid] -= 1
+        self.taken.discard(job_id)
+
+    def failJob(self, job_id, reason):
+        queueObj = self.outstanding.pop(job_id)
+        self.settle(job_id)
+        queueObj.update(connection_result="FAILED", command_output=reason, failure_reason='worker', timings={})
+        self.output_queue.put(queueObj)
+
+    def put(self, queueObj):
+        """Hands a job to the live worker holding the fewest, blocking while every one of them is at capacity"""
+        with self.condition:
+            self.sequence += 1
+            job_id = self.sequence
+            self.outstanding[job_id] = queueObj
+            while True:
+                live = [pid for pid in self.load if pid not in self.finished]
+                if not live:
+                    self.failJob(job_id, "sshpt worker processes all died")
+                    return
+                pid = min(live, key=self.load.get)
+                if self.load[pid] < self.capacity:
+                    break
+                self.condition.wait(1.0)
+            # Owned before it is even queued: if the worker dies, whether or not it got the job, the job is reported
+            self.owners[job_id] = pid
+            self.load[pid] += 1
+            jobs = self.queues[pid]
+        jobs.put((job_id, queueObj))
+
+    def qsize(self):
+        """Jobs put() that no worker took yet (multiprocessing.Queue.qsize() isn't implemented on macOS)"""
+        with self.condition:
+            return len(self.outstanding) - len(self.taken)
+
+    def join(self):
+        with self.condition:
+            while self.outstanding and self.alive():
+                self.condition.wait(1.0)
+
+    def stop(self):
+        for worker in self.workers:
+            if worker.is_alive():
+                self.queues[worker.pid].put('quit')
+        for worker in self.workers:
+            worker.join()
+
+
+def startProcessQueue(output_queue, processes, max_threads, engine='thread'):
+    """Start 'processes' worker processes.  Must be passed a Queue (output_queue) for writing results."""
+    return ProcessSSHQueue(output_queue, processes, max_threads, engine)
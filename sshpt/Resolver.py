@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Copyright 2011 Dan McDougall <YouKnowWho@YouKnowWhat.com>
+#       Copyright 2015 Jonghak Choi <haginara@gmail.com>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; Version 3 of the License
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, the license can be downloaded here:
+#
+#       http://www.gnu.org/licenses/gpl.html
+
+import time
+import socket
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger("sshpt")
+
+# What getaddrinfo() raises for a host that doesn't resolve: socket.gaierror mostly, socket.herror, UnicodeError
+# for a name IDNA can't encode (e.g. an empty label), other OSErrors when the resolver itself fails
+RESOLVE_ERRORS = (socket.gaierror, socket.herror, UnicodeError, OSError)
+
+
+class DNSCache(object):
+    """
+    getaddrinfo() answers kept for 'ttl' seconds, and failures to resolve for 'negative_ttl' seconds.
+
+    getaddrinfo() doesn't tell what the records' TTLs are, so every answer gets the same one.
+    """
+    def __init__(self, ttl=300.0, negative_ttl=30.0):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.answers = {} # (host, port): (expires, addresses or the RESOLVE_ERRORS exception)
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, host, port):
+        """Returns getaddrinfo()'s (family, socktype, proto, canonname, address) list for 'host', raises one of RESOLVE_ERRORS"""
+        now = time.monotonic()
+        with self.lock:
+            expires, answer = self.answers.get((host, port), (0, None))
+            if expires > now:
+                self.hits += 1
+                if isinstance(answer, Exception):
+                    raise answer
+                return answer
+            self.misses += 1
+        # Resolve outside of the lock: the whole point is resolving many hosts at once
+        try:
+            answer = socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM)
+            ttl = self.ttl
+        except RESOLVE_ERRORS as detail:
+            answer = detail
+            ttl = self.negative_ttl
+        with self.lock:
+            self.answers[(host, port)] = (time.monotonic() + ttl, answer)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    def stats(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, hosts=len(self.answers))
+
+    def clear(self):
+        with self.lock:
+            self.answers.clear()
+
+
+# Shared by every run of the process
+dns_cache = DNSCache()
+
+
+def resolveJob(cache, job):
+    """Adds the host's 'addresses' (and the 'dns_time' it took) to 'job'.  A host that doesn't resolve is turned
+    into a FAILED result (reason 'dns') right away, like the ones the preflight sweep settles."""
+    started = time.monotonic()
+    try:
+        job['addresses'] = cache.resolve(job['host'], job['port'])
+    except RESOLVE_ERRORS as detail:
+        seconds = round(time.monotonic() - started, 6)
+        job.update(connection_result="FAILED", command_output=str(detail), failure_reason='dns',
+                   timings={'dns': seconds, 'total': seconds}, settled=True)
+        return job
+    job['dns_time'] = time.monotonic() - started
+    return job
+
+
+def resolveAhead(jobs, cache=dns_cache, workers=16, window=256):
+    """
+    Resolves the hosts of 'jobs' with a pool of 'workers' threads, up to 'window' hosts ahead of dispatch, and
+    yields each job as soon as its host is resolved (see resolveJob()).  Jobs using a ProxyCommand are yielded as
+    they are: the proxy resolves those.
+    """
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Resolver")
+    pending = set()
+    try:
+        for job in jobs:
+            if job.get('proxycommand'):
+                yield job
+                continue
+            pending.add(executor.submit(resolveJob, cache, job))
+            if len(pending) >= window:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            else:
+                done = set(future for future in pending if future.done())
+                pending -= done
+            for future in done:
+                yield future.result()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        executor.shutdown(wait=False)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Copyright 2011 Dan McDougall <YouKnowWho@YouKnowWhat.com>
+#       Copyright 2015 Jonghak Choi <haginara@gmail.com>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; Version 3 of the License
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, the license can be downloaded here:
+#
+#       http://www.gnu.org/licenses/gpl.html
+
+"""
+Using sshpt from Python:
+
+    import sshpt
+
+    for result in sshpt.run(['web1', 'web2'], ['uptime'], username='admin', password='secret', max_threads=50):
+        print(result['host'], result['connection_result'], result['command_output'])
+
+Results come in the order hosts finish.  Inside a coroutine, use 'async for' on the same object.  Call cancel()
+(or leave a 'with' block) to stop: hosts not started yet are skipped and no more results are yielded.
+"""
+
+import sys
+import asyncio
+import threading
+import logging
+from argparse import Namespace
+
+if sys.version_info[0] == 3:
+    import queue as Queue
+else:
+    import Queue
+
+from .sshpt import SSHPowerTool
+
+logger = logging.getLogger("sshpt")
+
+# What the results queue gets once the run is over
+_DONE = object()
+
+
+def defaultOptions(**settings):
+    """Returns the options of a run: the command line defaults, updated with 'settings' (by dest name, e.g. max_threads)"""
+    from .main import create_parser
+    parser = create_parser()
+    # String defaults go through their type like argparse does (e.g. --flush-bytes 1M)
+    options = Namespace(**{action.dest: action.type(action.default) if action.type and isinstance(action.default, str) else action.default
+                           for action in parser._actions if action.dest != 'help'})
+    # Library runs print nothing and don't read ~/.ssh/config or a default key unless asked to
+    options.verbose = False
+    options.keyfile = None
+    options.sshconfig = None
+    for name, value in settings.items():
+        if name not in vars(options):
+            raise TypeError(f"Unknown sshpt setting: {name}")
+        setattr(options, name, value)
+    return options
+
+
+class ResultIterator(object):
+    """
+    Runs an SSHPowerTool in the background and yields its result records (dicts, the same records the outfile
+    gets: host, connection_result, commands, command_output, timings...) as hosts finish.
+
+    tool - SSHPowerTool: The run, not started yet
+    """
+    def __init__(self, tool):
+        self.tool = tool
+        self.results = Queue.Queue()
+        self.cancelled = False
+        self.finished = False
+        self.error = None
+        tool.observers.append(self)
+        self.thread = threading.Thread(target=self.runTool, name="ResultIterator")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def runTool(self):
+        try:
+            output_queue = self.tool.run()
+            output_queue.join()
+            self.tool.stopOutput()
+        except Exception as detail:
+            # e.g. ImportError: the asyncio engine without asyncssh
+            logger.error("sshpt run failed: %s", detail)
+            self.error = detail
+            self.stopOutput()
+        except SystemExit as detail:
+            # Raised again in the caller's thread it would end their program: report it like any other failure
+            logger.error("sshpt run exited: %s", detail)
+            self.error = RuntimeError(f"sshpt run exited (status {detail.code})")
+            self.stopOutput()
+        finally:
+            self.tool.stopMetrics()
+            self.tool.closeJournal()
+            self.results.put(_DONE)
+
+    def stopOutput(self):
+        """Lets the run's OutputThread go after the run failed"""
+        if self.tool.observing:
+            self.tool.output_queue.put('quit')
+
+    def observe(self, queueObj):
+        if 'event' not in queueObj and not self.cancelled:
+            self.results.put(queueObj)
+
+    def cancel(self):
+        """Stops the run: hosts in flight finish in the background, the others are skipped, iteration ends"""
+        self.cancelled = True
+        self.tool.cancel()
+        self.results.put(_DONE)
+
+    def next(self, timeout=None):
+        """Returns the next result, or _DONE"""
+        if self.finished:
+            return _DONE
+        result = self.results.get(timeout=timeout)
+        if result is _DONE:
+            self.finished = True
+            if self.error is not None and not self.cancelled:
+                raise self.error
+        return result
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        result = self.next()
+        if result is _DONE:
+            raise StopIteration
+        return result
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        # Waiting on the queue happens in the default executor, so the event loop keeps running meanwhile
+        result = await asyncio.get_event_loop().run_in_executor(None, self.next)
+        if result is _DONE:
+            raise StopAsyncIteration
+        return result
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if not self.finished:
+            self.cancel()
+
+
+def run(hosts, commands=None, username=None, password=None, **settings):
+    """
+    Runs 'commands' (a list; just a connection test if there are none) on 'hosts' and returns a ResultIterator.
+
+    hosts - Iterable: Host names, or dicts with a 'host' and optionally 'port', 'username' and 'password'
+    settings - Any other option of the command line, by its dest name: max_threads=50, timeout=10.0, keyfile=...,
+               engine='asyncio', sudo='root', command_timeout=60.0, outfile='results.csv'...
+    """
+    options = defaultOptions(commands=list(commands or []), **settings)
+    if username is not None:
+        options.username = username
+    if password is not None:
+        options.password = password
+    options.hosts = ({'host': host} if isinstance(host, str) else host for host in hosts)
+    return ResultIterator(SSHPowerTool(options))
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Copyright 2011 Dan McDougall <YouKnowWho@YouKnowWhat.com>
+#       Copyright 2015 Jonghak Choi <haginara@gmail.com>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; Version 3 of the License
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, the license can be downloaded here:
+#
+#       http://www.gnu.org/licenses/gpl.html
+
+import math
+import time
+import threading
+import logging
+from collections import deque
+
+logger = logging.getLogger("sshpt")
+
+
+def batchSize(size, total=None):
+    """Turns a --batch-size ('50' or '10%', a percentage of 'total' hosts) into a number of hosts"""
+    if size is None:
+        return None
+    size = str(size).strip()
+    if size.endswith('%'):
+        return max(1, int(math.ceil(float(size[:-1]) / 100.0 * total)))
+    return max(1, int(size))
+
+
+class Rollout(object):
+    """
+    Dispatches hosts in batches and stops the run when too many of them fail.
+
+    The scheduler calls admit() before dispatching each host; results come back through observe() (it is an output
+    observer).  A 'canary' batch goes first and the rollout stops if any of its hosts fails.  Then hosts go out
+    'batch' at a time (None: all at once), each batch once the previous one is done and 'pause' seconds went by.
+    Whenever more than 'max_failure_rate' percent of the last 'window' results are failures, the rollout is aborted
+    (at the end of a batch that is checked even before 'window' results are in).
+
+    aborted - String: Why the rollout was aborted (None while it goes on)
+    """
+    def __init__(self, canary=0, batch=None, pause=0.0, window=20, max_failure_rate=None):
+        self.canary = canary
+        self.batch = batch
+        self.pause = pause
+        self.max_failure_rate = max_failure_rate
+        self.condition = threading.Condition()
+        self.recent = deque(maxlen=window) # Whether each of the last 'window' results failed
+        self.number = 0 # Of the current batch (0 is the canary)
+        self.size = canary or batch # Of the current batch (None: no batches)
+        self.dispatched = 0 # In the current batch
+        self.finished = 0 # In the current batch
+        self.failed = 0 # In the current batch
+        self.aborted = None
+
+    def setBatch(self, batch):
+        """Sets the batch size once it is known (e.g. a percentage of the host list)"""
+        with self.condition:
+            self.batch = batch
+            if self.number > 0 or not self.canary:
+                self.size = batch
+
+    def admit(self):
+        """Blocks until the next host may be dispatched.  Returns False once the rollout is aborted."""
+        with self.condition:
+            if self.aborted is None and self.size is not None and self.dispatched >= self.size:
+                self.nextBatch()
+            if self.aborted is not None:
+                return False
+            self.dispatched += 1
+            return True
+
+    def nextBatch(self):
+        # Let the current batch finish (or the breaker trip) first
+        while self.finished < self.dispatched and self.aborted is None:
+            self.condition.wait()
+        if self.aborted is not None:
+            return
+        if self.number == 0 and self.canary and self.failed:
+            self.abort(f"{self.failed} of {self.finished} canary hosts failed")
+            return
+        self.checkFailureRate(full_window=False)
+        if self.aborted is not None:
+            return
+        logger.info("Batch %d done (%d hosts, %d failed)", self.number, self.finished, self.failed)
+        deadline = time.monotonic() + self.pause
+        while self.aborted is None and time.monotonic() < deadline:
+            self.condition.wait(deadline - time.monotonic())
+        self.number += 1
+        self.size = self.batch
+        self.dispatched = self.finished = self.failed = 0
+
+    def observe(self, queueObj):
+        if 'event' in queueObj or queueObj.get('settled'):
+            return
+        failed = queueObj.get('connection_result') != 'SUCCESS'
+        with self.condition:
+            self.finished += 1
+            self.failed += failed
+            self.recent.append(failed)
+            self.checkFailureRate(full_window=True)
+            self.condition.notify_all()
+
+    def checkFailureRate(self, full_window=True):
+        if self.max_failure_rate is None or not self.recent:
+            return
+        if full_window and len(self.recent) < self.recent.maxlen:
+            return # Too few results yet to tell a trend from bad luck
+        rate = 100.0 * sum(self.recent) / len(self.recent)
+        if rate > self.max_failure_rate:
+            self.abort(f"{rate:.0f}% of the last {len(self.recent)} hosts failed (limit: {self.max_failure_rate:g}%)")
+
+    def abort(self, reason):
+        if self.aborted is None:
+            logger.error("Rollout aborted: %s", reason)
+            self.aborted = reason
+        self.condition.notify_all()
+
+    def skipped(self, job):
+        """Returns 'job' as the result of a host the aborted rollout never got to"""
+        job.update(connection_result="SKIPPED", command_output=f"Skipped: rollout aborted ({self.aborted})",
+                   failure_reason='skipped', settled=True)
+        return job
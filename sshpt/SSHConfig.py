@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Copyright 2011 Dan McDougall <YouKnowWho@YouKnowWhat.com>
+#       Copyright 2015 Jonghak Choi <haginara@gmail.com>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; Version 3 of the License
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, the license can be downloaded here:
+#
+#       http://www.gnu.org/licenses/gpl.html
+
+import os
+import re
+import fnmatch
+import threading
+import logging
+
+import paramiko
+
+logger = logging.getLogger("sshpt")
+
+
+def _compilePatterns(patterns):
+    """Compiles a list of ssh_config glob patterns into a single regex (None if there are none)"""
+    if not patterns:
+        return None
+    return re.compile("|".join(f"(?:{fnmatch.translate(pattern)})" for pattern in patterns))
+
+
+class CompiledSSHConfig(paramiko.SSHConfig):
+    """paramiko.SSHConfig that compiles the patterns of each Host line into one regex the first time they are matched,
+    instead of running fnmatch over every pattern of every Host block for every lookup.
+    Overrides SSHConfig._pattern_matches(), which paramiko has had since 2.7 (see newSSHConfig())."""
+    def __init__(self):
+        super(CompiledSSHConfig, self).__init__()
+        self.compiled_patterns = {}
+
+    def _pattern_matches(self, patterns, target):
+        if hasattr(patterns, "split"):
+            patterns = patterns.split(",")
+        key = tuple(patterns)
+        compiled = self.compiled_patterns.get(key)
+        if compiled is None:
+            negated = _compilePatterns([pattern[1:] for pattern in patterns if pattern.startswith("!")])
+            positive = _compilePatterns([pattern for pattern in patterns if not pattern.startswith("!")])
+            compiled = self.compiled_patterns[key] = (negated, positive)
+        negated, positive = compiled
+        # Same rules as paramiko: any negated match excludes the host, otherwise any match includes it
+        if negated is not None and negated.match(target):
+            return False
+        return positive is not None and positive.match(target) is not None
+
+
+def newSSHConfig():
+    """Returns a CompiledSSHConfig, or a plain paramiko.SSHConfig if this paramiko doesn't match patterns the way it expects"""
+    if callable(getattr(paramiko.SSHConfig, '_pattern_matches', None)):
+        return CompiledSSHConfig()
+    logger.debug("paramiko.SSHConfig has no _pattern_matches(): Host patterns are matched by paramiko")
+    return paramiko.SSHConfig()
+
+
+class SSHConfigResolver(object):
+    """
+    Resolves host aliases against an ssh_config file, once per alias.
+
+    resolve() returns a dict with the fields sshpt uses:
+        hostname - String: Always set (the alias itself if the config has no HostName)
+        port - Integer: Only if the config sets Port
+        user - String: Only if the config sets User
+        identityfile - String: The first IdentityFile that exists, if any
+        proxycommand - String: Only if the config sets a ProxyCommand (other than 'none')
+    """
+    def __init__(self, path):
+        self.config = newSSHConfig()
+        with open(path) as f:
+            self.config.parse(f)
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, alias):
+        with self.lock:
+            resolved = self.cache.get(alias)
+            if resolved is not None:
+                self.hits += 1
+                return resolved
+            self.misses += 1
+        host_lookup = self.config.lookup(alias)
+        logger.debug("host_lookup: %s", host_lookup)
+        resolved = dict(hostname=host_lookup.get('hostname', alias))
+        if 'port' in host_lookup:
+            resolved['port'] = int(host_lookup['port'])
+        if 'user' in host_lookup:
+            resolved['user'] = host_lookup['user']
+        for identityfile in host_lookup.get('identityfile', []):
+            identityfile = os.path.expanduser(identityfile)
+            if os.path.exists(identityfile):
+                resolved['identityfile'] = identityfile
+                break
+        proxycommand = host_lookup.get('proxycommand')
+        if proxycommand and proxycommand.lower() != 'none':
+            resolved['proxycommand'] = proxycommand
+        with self.lock:
+            self.cache[alias] = resolved
+        return resolved
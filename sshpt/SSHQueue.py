@@ -18,21 +18,30 @@
 #
 #       http://www.gnu.org/licenses/gpl.html
 
-from .Generic import GenericThread, normalizeString
+from .Generic import GenericThread, StreamSplitter, ConnectionFailure, CommandTimeout, HostKeyRejected, commandDeadline, failureReason, normalizeString
+from .Spool import OutputSpool, removeSpool
+from .KeyCache import key_cache
+from .KnownHosts import knownHostsIndex, hostKeyName
+from .Timing import PhaseTimer
 
 import sys
 import os
+import time
+import socket
 import threading
+from collections import deque
 if sys.version_info[0] == 3:
     import queue as Queue
     basestring = str
 else:
     import Queue
-import getpass
 import logging
 
 logger = logging.getLogger("sshpt")
 
+# How much channel data is read at a time when streaming output
+STREAM_CHUNK_SIZE = 32768
+
 # Import 3rd party modules
 try:
     import paramiko
@@ -43,12 +52,42 @@ except ImportError:
     sys.exit(1)
 #paramiko.util.log_to_file("debug.log")
 
+
+class KnownHostsPolicy(paramiko.MissingHostKeyPolicy):
+    """What to do with a host key the KnownHostsIndex doesn't know: reject it ('strict') or learn it ('accept-new').
+    Keys that don't match the known ones never get here: SSHClient raises BadHostKeyException for those."""
+    def __init__(self, index, policy):
+        self.index = index
+        self.policy = policy
+
+    def missing_host_key(self, client, hostname, key):
+        blob = key.asbytes()
+        if self.index.isRevoked(blob):
+            raise HostKeyRejected(f"Host key of {hostname} ({key.get_name()}) is revoked")
+        if self.policy == 'strict':
+            raise HostKeyRejected(f"No {key.get_name()} host key of {hostname} in {self.index.path}")
+        self.index.learn(hostname, key.get_name(), blob)
+
+
+class TimedSSHClient(paramiko.SSHClient):
+    """SSHClient noting when authentication starts, so that connect() can be split into key exchange and auth.
+    Hooks the private SSHClient._auth() (see setup.py for the paramiko versions it is known to work with): if a
+    paramiko stops calling it, auth_started stays None and the whole handshake is counted as key exchange."""
+    auth_started = None
+
+    def _auth(self, *args, **kwargs):
+        self.auth_started = time.monotonic()
+        return super(TimedSSHClient, self)._auth(*args, **kwargs)
+
+
 class SSHThread(GenericThread):
     """Connects to a host and optionally runs commands or copies a file over SFTP.
     Must be instanciated with:
       id                    A thread ID
       ssh_connect_queue     Queue.Queue() for receiving orders
       output_queue          Queue.Queue() to output results
+    And optionally:
+      connection_pool       ConnectionPool to reuse authenticated connections across runs
 
     Here's the list of variables that are added to the output queue before it is put():
         queueObj['host']
@@ -62,13 +101,20 @@ class SSHThread(GenericThread):
         queueObj['remove'] - Boolean
         queueObj['sudo'] - Boolean
         queueObj['passwordless'] - Boolean
-        queueObj['connection_result'] - String: 'SUCCESS'/'FAILED'
+        queueObj['connection_result'] - String: 'SUCCESS'/'FAILED', 'TIMEOUT' when a command ran past --command-timeout (or
+                                        the run's --deadline), 'SKIPPED' when the host wasn't even started before the deadline
         queueObj['command_output'] - String: Textual output of commands after execution
+        queueObj['command_output_files'] - Dict: {index: path} of temporary files holding the complete output of commands
+                                           that went over --output-budget (command_output then only has an excerpt)
+        queueObj['timings'] - Dict: Seconds spent in each phase (dns, connect, kex, auth, sftp, exec) and in 'total'
+        queueObj['failure_reason'] - String: Why a FAILED host failed ('dns', 'refused', 'timeout', 'network', 'auth', 'ssh' or 'command',
+                                     and 'unreachable' from the --preflight sweep, 'command_timeout', 'deadline')
     """
-    def __init__(self, id, ssh_connect_queue, output_queue):
+    def __init__(self, id, ssh_connect_queue, output_queue, connection_pool=None):
         super(SSHThread, self).__init__(name="SSHThread-%d" % (id))
         self.ssh_connect_queue = ssh_connect_queue
         self.output_queue = output_queue
+        self.connection_pool = connection_pool
         self.id = id
         self.quitting = False
 
@@ -78,49 +124,109 @@ class SSHThread(GenericThread):
                 queueObj = self.ssh_connect_queue.get()
                 if queueObj == 'quit':
                     self.quit()
-                success, command_output = self.attemptConnection(**queueObj)
-                queueObj['connection_result'] = "SUCCESS" if success else "FAILED"
+                    self.ssh_connect_queue.task_done()
+                    break
+                details = {}
+                timer = PhaseTimer()
+                success, command_output = self.attemptConnection(details=details, timer=timer, **queueObj)
+                queueObj.update(details)
+                queueObj['connection_result'] = "SUCCESS" if success else details.get('connection_result', "FAILED")
                 queueObj['command_output'] = command_output
+                queueObj['timings'] = timer.stop()
                 self.output_queue.put(queueObj)
                 self.ssh_connect_queue.task_done()
         except Exception as e:
             logger.error("Failed to run SSH Thread reason: %s" % e)
             self.quit()
 
-    def create_key(self, key_file, key_passwd):
-        try:
-            key = paramiko.RSAKey.from_private_key_file(key_file)
-        except paramiko.PasswordRequiredException:
-            if not key_passwd:
-                key_passwd = getpass.getpass("Enter passphrase for %s: " % key_file)
-            key = paramiko.RSAKey.from_private_key_file(key_file, password=key_passwd)
-        except Exception as detail:
-            logger.error("Error: Create_key: %s", detail)
-        return key
+    def create_key(self, key_file, key_passwd, prompt=True):
+        """Returns the (Ed25519, ECDSA or RSA) key in key_file, decrypted only once per process thanks to the key cache"""
+        return key_cache.load(key_file, key_passwd, prompt=prompt)
+
+    def openSocket(self, host, port, timeout, timer, addresses=None, dns_time=None):
+        """Resolves 'host' (unless its 'addresses' were resolved ahead of dispatch, in 'dns_time' seconds) and opens
+        a TCP connection to the first of its addresses that accepts one"""
+        if addresses:
+            timer.add('dns', dns_time or 0.0)
+        else:
+            with timer.phase('dns'):
+                addresses = socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM)
+        with timer.phase('connect'):
+            error = None
+            for family, socktype, proto, canonname, address in addresses:
+                sock = socket.socket(family, socktype, proto)
+                sock.settimeout(timeout)
+                try:
+                    sock.connect(address)
+                    return sock
+                except socket.error as detail:
+                    sock.close()
+                    error = detail
+            raise error
 
-    def paramikoConnect(self, host, username, password, timeout, port=22, key_file="", key_pass="", passwordless=False):
-        """Connects to 'host' and returns a Paramiko transport object to use in further communications"""
+    def paramikoConnect(self, host, username, password, timeout, port=22, key_file="", key_pass="", passwordless=False, proxycommand=None, timer=None,
+                        addresses=None, dns_time=None, host_key_policy='off', known_hosts=None, known_keys=None):
+        """Connects to 'host' and returns a Paramiko transport object to use in further communications.
+        The time spent in each phase of the connection is added to 'timer' (a PhaseTimer) if one is given.
+        Unless 'host_key_policy' is 'off', the host key is checked against the 'known_hosts' file's KnownHostsIndex
+        (or the 'known_keys' looked up in it ahead, see lookupAhead())."""
         # Uncomment this line to turn on Paramiko debugging (good for troubleshooting why some servers report connection failures)
         #paramiko.util.log_to_file('paramiko.log')
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        timer = timer or PhaseTimer()
+        ssh = TimedSSHClient()
+        if host_key_policy == 'off':
+            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        else:
+            # Only this host's entries go into the client: paramiko then compares (and negotiates) the known key types
+            index = knownHostsIndex(known_hosts)
+            name = hostKeyName(host, port)
+            for keytype, blobs in (index.lookup(name) if known_keys is None else known_keys).items():
+                for blob in blobs:
+                    try:
+                        ssh.get_host_keys().add(name, keytype, paramiko.PKey.from_type_string(keytype, blob))
+                    except (paramiko.SSHException, ValueError) as detail:
+                        logger.debug("Ignoring known %s key of %s: %s", keytype, name, detail)
+            ssh.set_missing_host_key_policy(KnownHostsPolicy(index, host_key_policy))
         logger.debug(f"paramikoConnect:connect, {username}@{host}")
 
         try:
+            key = None
             if key_file:
-                if passwordless:
-                    key = paramiko.RSAKey.from_private_key_file(key_file)
-                else:
-                    key = self.create_key(key_file, key_pass)
-                ssh.connect(host, port=port, username=username, timeout=timeout, pkey=key)
+                try:
+                    if passwordless:
+                        key = self.create_key(key_file, None, prompt=False)
+                    else:
+                        key = self.create_key(key_file, key_pass)
+                except Exception as detail:
+                    # e.g. an ssh_config IdentityFile we can't read: fall back to the password if we have one
+                    if not password:
+                        raise
+                    logger.warning("Could not use private key %s, using the password instead: %s", key_file, detail)
+            if proxycommand:
+                sock = paramiko.ProxyCommand(proxycommand)
             else:
-                ssh.connect(host, port=port, username=username, password=password, timeout=timeout)
+                sock = self.openSocket(host, port, float(timeout), timer, addresses, dns_time)
+            started = time.monotonic()
+            try:
+                ssh.connect(host, port=port, username=username, password=password, timeout=float(timeout), pkey=key, sock=sock)
+            finally:
+                if ssh.auth_started is None:
+                    timer.add('kex', time.monotonic() - started)
+                else:
+                    timer.add('kex', ssh.auth_started - started)
+                    timer.add('auth', time.monotonic() - ssh.auth_started)
+        except paramiko.BadHostKeyException as detail:
+            logger.error('Host key verification failed: %s', detail)
+            ssh = ConnectionFailure(str(detail), 'hostkey')
+        except HostKeyRejected as detail:
+            logger.error('Host key verification failed: %s', detail)
+            ssh = ConnectionFailure(str(detail), 'hostkey')
         except paramiko.SSHException as detail:
             logger.error('Could not read private key; bad password?, %s', detail)
-            ssh = str(detail)
+            ssh = ConnectionFailure(str(detail), failureReason(detail, paramiko.AuthenticationException))
         except Exception as detail:
             logger.error('Connecting failed (for whatever reason: %s)', detail)
-            ssh = str(detail)
+            ssh = ConnectionFailure(str(detail), failureReason(detail))
         return ssh
 
     def sftpPut(self, ssh, local_filepath, remote_filepath):
@@ -143,23 +249,108 @@ class SSHThread(GenericThread):
             stdin.flush()
         return stdout, stderr
 
-    def executeCommand(self, ssh, command, sudo, password=None):
-        """Executes the given command via the specified Paramiko transport object.  Will execute as sudo if passed the necessary variables (sudo=True, password, sudo).
-        Returns stdout (after command execution)"""
-        host = ssh.get_host_keys().keys()[0]
+    def startCommand(self, ssh, command, sudo, password=None):
+        """Starts the given command on its own session channel of the specified Paramiko transport object without waiting for it.
+        Returns stdout (to be read with readOutput())"""
         if sudo:
             stdout, stderr = self.sudoExecute(ssh=ssh, command=command, password=password, sudo=sudo)
         else:
             stdin, stdout, stderr = ssh.exec_command(command)
-        command_output = stdout.readlines()
-        command_output = "".join(command_output)
+        return stdout
+
+    def readOutput(self, stdout, emit=None, stream_mode='line', deadline=None):
+        """Waits for a command started with startCommand() and returns its output.
+        If 'emit' is given the output is handed to it in line (or chunk) sized pieces as it arrives instead of being buffered,
+        and only a short '[streamed N bytes]' marker is returned.
+        Past 'deadline' (a time.monotonic()) the channel is closed and CommandTimeout raised with the output read so far."""
+        if emit is None and deadline is None:
+            command_output = stdout.readlines()
+            command_output = "".join(command_output)
+            return command_output
+        pieces = None
+        if emit is None:
+            pieces = []
+            emit, stream_mode = pieces.append, 'chunk'
+        splitter = StreamSplitter(stream_mode)
+        channel = stdout.channel
+        started = time.monotonic()
+        try:
+            while True:
+                if deadline is not None:
+                    if deadline <= time.monotonic():
+                        raise socket.timeout()
+                    channel.settimeout(deadline - time.monotonic())
+                data = channel.recv(STREAM_CHUNK_SIZE)
+                if not data:
+                    break
+                for event in splitter.feed(data):
+                    emit(event)
+        except socket.timeout:
+            channel.close()
+            for event in splitter.close():
+                emit(event)
+            output = "".join(pieces) if pieces is not None else f"[streamed {splitter.total_bytes} bytes]"
+            raise CommandTimeout(output, round(time.monotonic() - started, 3))
+        for event in splitter.close():
+            emit(event)
+        if pieces is not None:
+            return "".join(pieces)
+        return f"[streamed {splitter.total_bytes} bytes]"
+
+    def executeCommand(self, ssh, command, sudo, password=None, command_timeout=None, run_deadline=None):
+        """Executes the given command via the specified Paramiko transport object.  Will execute as sudo if passed the necessary variables (sudo=True, password, sudo).
+        Raises CommandTimeout once it ran for 'command_timeout' seconds or past 'run_deadline' (see commandDeadline()).
+        Returns stdout (after command execution)"""
+        deadline = commandDeadline(command_timeout, run_deadline)
+        return self.readOutput(self.startCommand(ssh, command=command, sudo=sudo, password=password), deadline=deadline)
+
+    def executeCommands(self, ssh, commands, sudo, password=None, max_channels=1, stream=None, stream_mode='line', command_timeout=None, run_deadline=None):
+        """Executes 'commands' with up to 'max_channels' of them running at once over multiplexed channels of the same transport.
+        'stream' is an optional callable(index, command) returning the emit function readOutput() should stream that command's output to.
+        Each command gets 'command_timeout' seconds from when it starts, none of them past 'run_deadline'.
+        Returns the output of each command, in the same order as 'commands'"""
+        outputs = []
+        running = deque()
+
+        def read(index, command, stdout, deadline):
+            emit = stream(index, command) if stream else None
+            try:
+                return self.readOutput(stdout, emit=emit, stream_mode=stream_mode, deadline=deadline)
+            except CommandTimeout as detail:
+                detail.outputs = outputs + [detail.output]
+                raise
 
-        return command_output
+        for index, command in enumerate(commands):
+            if len(running) >= max_channels:
+                outputs.append(read(*running.popleft()))
+            deadline = commandDeadline(command_timeout, run_deadline)
+            running.append((index, command, self.startCommand(ssh, command=command, sudo=sudo, password=password), deadline))
+        while running:
+            outputs.append(read(*running.popleft()))
+        return outputs
+
+    def streamTo(self, host, port, stream_buffer):
+        """Returns a stream callable for executeCommands() that forwards output events to the output_queue.
+        At most 'stream_buffer' events per host can be waiting on the OutputThread; past that the reader blocks, which
+        stops draining the channel and lets SSH flow control push back on the remote command."""
+        credit = threading.BoundedSemaphore(stream_buffer)
+
+        def stream(index, command):
+            def emit(data):
+                credit.acquire()
+                self.output_queue.put(dict(event='output', host=host, port=port, index=index, command=command,
+                                           data=data, credit=credit))
+            return emit
+        return stream
 
     def attemptConnection(self, host, username="", password="", keyfile="", keypass="", timeout=30, commands=[],
-        local_filepath=False, remote_filepath='/tmp', execute=False, remove=False, sudo=False, passwordless=False, port=22):
+        local_filepath=False, remote_filepath='/tmp', execute=False, remove=False, sudo=False, passwordless=False, port=22,
+        parallel_commands=1, stream=None, stream_buffer=64, output_budget=None, proxycommand=None, addresses=None, dns_time=None,
+        work_hash=None, command_timeout=None, run_deadline=None, host_key_policy='off', known_hosts=None, known_keys=None, details=None, timer=None):
         """Attempt to login to 'host' using 'username'/'password' and execute 'commands'.
         Will excute commands via sudo if 'sudo' is set to True (as root by default) and optionally as a given user (sudo).
+        Extra fields for the result record (e.g. command_output_files) are added to the 'details' dict if one is given.
+        The time spent in each phase is added to 'timer' (a PhaseTimer) if one is given.
         Returns connection_result as a boolean and command_output as a string."""
         # Connection timeout
         # Either False for no commnads or a list
@@ -170,14 +361,39 @@ class SSHThread(GenericThread):
         # Whether or not sudo should be used for commands and file operations
         # User to become when using sudo
         # Port to use when connecting
+        # How many of 'commands' may run at the same time on the transport
+        # None to buffer command output, or 'line'/'chunk' to stream it to the output_queue as it arrives
+        # How many streamed events of this host may wait on the output_queue
+        # Bytes of command output kept in memory before spilling to a temporary file (None for no limit)
+        # Command (from ssh_config) whose stdin/stdout to use instead of a direct TCP connection
+        # getaddrinfo() answers for the host when it was resolved ahead of dispatch, and how long that took
+        # What --journal records the commands as (see Journal.workHash())
+        # Seconds each command may run for, and the time.time() by which the whole run has to be done
 
         connection_result = True
         command_output = []
-        ssh = self.paramikoConnect(host, username, password=password, timeout=timeout, port=port, key_file=keyfile, key_pass=keypass, passwordless=passwordless)
+        timer = timer or PhaseTimer()
+        if run_deadline:
+            if time.time() >= run_deadline:
+                # Still waiting for a worker when the run ran out of time
+                if details is not None:
+                    details.update(connection_result="SKIPPED", failure_reason='deadline')
+                return False, "Skipped: the run's --deadline passed"
+            timeout = min(float(timeout), run_deadline - time.time())
+        limits = dict(command_timeout=command_timeout, run_deadline=run_deadline)
+        # Reused only under the host key checking it was opened with: a connection made with 'off' proves nothing to a strict job
+        pool_key = (host, port, username, host_key_policy, knownHostsIndex(known_hosts).path if host_key_policy != 'off' else None)
+        ssh = self.connection_pool.get(pool_key) if self.connection_pool else None
+        if ssh is None:
+            ssh = self.paramikoConnect(host, username, password=password, timeout=timeout, port=port, key_file=keyfile, key_pass=keypass, passwordless=passwordless,
+                                       proxycommand=proxycommand, timer=timer, addresses=addresses, dns_time=dns_time,
+                                       host_key_policy=host_key_policy, known_hosts=known_hosts, known_keys=known_keys)
         if isinstance(ssh, basestring):
             # If ssh is a string that means the connection failed and 'ssh' is the details as to why
+            if details is not None:
+                details['failure_reason'] = getattr(ssh, 'reason', 'ssh')
             connection_result = False
-            command_output = ssh
+            command_output = str(ssh)
             return connection_result, command_output
 
         if local_filepath:
@@ -188,16 +404,20 @@ class SSHThread(GenericThread):
                 if sudo:
                     temp_path = os.path.join('/tmp', local_short_filename)
                     logger.info("Put the file temp first %s to %s", local_filepath, temp_path)
-                    self.sftpPut(ssh, local_filepath, temp_path)
+                    with timer.phase('sftp'):
+                        self.sftpPut(ssh, local_filepath, temp_path)
                     command = f"mv {temp_path} {remote_fullpath}"
-                    command_output.append(self.executeCommand(ssh, command=command, sudo=sudo, password=password))
+                    with timer.phase('exec'):
+                        command_output.append(self.executeCommand(ssh, command=command, sudo=sudo, password=password, **limits))
                 else:
-                    self.sftpPut(ssh, local_filepath, remote_fullpath)
+                    with timer.phase('sftp'):
+                        self.sftpPut(ssh, local_filepath, remote_fullpath)
 
                 if execute:
                     # Make it executable (a+x in case we run as another user via sudo)
-                    chmod_command = f"chmod a+x {remote_filepath}"
-                    self.executeCommand(ssh=ssh, command=chmod_command, sudo=sudo, password=password)
+                    chmod_command = f"chmod a+x {remote_fullpath}"
+                    with timer.phase('exec'):
+                        self.executeCommand(ssh=ssh, command=chmod_command, sudo=sudo, password=password, **limits)
                     # The command to execute is now the uploaded file
                     commands = [remote_fullpath, ]
                 else:
@@ -208,35 +428,72 @@ class SSHThread(GenericThread):
                 # Make sure the error is included in the command output
                 command_output.append(str(details))
         try:
-            if commands:
-                for command in commands:
+            with timer.phase('exec'):
+                if commands:
                     # This makes a list of lists (each line of output in command_output is it's own item in the list)
-                    command_output.append(self.executeCommand(ssh=ssh, command=command, sudo=sudo, password=password))
-            if local_filepath is False and commands is False and execute is False:
-                # If we're not given anything to execute run the uptime command to make sure that we can execute *something*
-                command_output = self.executeCommand(ssh=ssh, command='uptime', sudo=sudo, password=password)
-            if local_filepath and remove:
-                # Clean up/remove the file we just uploaded and executed
-                rm_command = f"rm -f {remote_fullpath}"
-                self.executeCommand(ssh=ssh, command=rm_command, sudo=sudo, password=password)
+                    if stream:
+                        command_output.extend(self.executeCommands(ssh=ssh, commands=commands, sudo=sudo, password=password, max_channels=parallel_commands,
+                            stream=self.streamTo(host, port, stream_buffer), stream_mode=stream, **limits))
+                    elif output_budget:
+                        spool = OutputSpool(output_budget)
+                        try:
+                            self.executeCommands(ssh=ssh, commands=commands, sudo=sudo, password=password, max_channels=parallel_commands,
+                                stream=lambda index, command: spool.section(index).write, stream_mode='chunk', **limits)
+                        except CommandTimeout as detail:
+                            # What the spool holds is the best partial output there is
+                            spooled_output, spooled_files = spool.results()
+                            removeSpool(spooled_files)
+                            detail.outputs = spooled_output
+                            raise
+                        except Exception:
+                            removeSpool(spool.results()[1])
+                            raise
+                        spooled_output, spooled_files = spool.results()
+                        if details is not None:
+                            details['command_output_files'] = {len(command_output) + index: path for index, path in spooled_files.items()}
+                            details['output_bytes'] = spool.total_bytes
+                        command_output.extend(spooled_output)
+                    else:
+                        command_output.extend(self.executeCommands(ssh=ssh, commands=commands, sudo=sudo, password=password, max_channels=parallel_commands, **limits))
+                if local_filepath is False and commands is False and execute is False:
+                    # If we're not given anything to execute run the uptime command to make sure that we can execute *something*
+                    command_output = self.executeCommand(ssh=ssh, command='uptime', sudo=sudo, password=password, **limits)
+                if local_filepath and remove:
+                    # Clean up/remove the file we just uploaded and executed
+                    rm_command = f"rm -f {remote_fullpath}"
+                    self.executeCommand(ssh=ssh, command=rm_command, sudo=sudo, password=password, **limits)
             command_output = [normalizeString(output) for output in command_output]
+        except CommandTimeout as detail:
+            # Keep what the commands printed until then, and say where it stopped
+            connection_result = False
+            command_output = [normalizeString(output) for output in list(command_output) + detail.outputs] or [""]
+            command_output[-1] += f"\n[{detail}]"
+            if details is not None:
+                details.update(connection_result="TIMEOUT", failure_reason='command_timeout')
         except Exception as detail:
             # Connection failed
             print (sys.exc_info())
             print(f"Exception: {detail}")
             connection_result = False
-            command_output = detail
+            command_output = str(detail)
+            if details is not None:
+                details['failure_reason'] = 'command'
         finally:
-            if not isinstance(ssh, basestring):
+            if self.connection_pool and connection_result:
+                # Keep the connection open for the next run
+                self.connection_pool.put(pool_key, ssh)
+            elif not isinstance(ssh, basestring):
                 ssh.close()
         return connection_result, command_output
 
 
-def startSSHQueue(output_queue, max_threads):
-    """Setup concurrent threads for testing SSH connectivity.  Must be passed a Queue (output_queue) for writing results."""
-    ssh_connect_queue = Queue.Queue()
+def startSSHQueue(output_queue, max_threads, connection_pool=None):
+    """Setup concurrent threads for testing SSH connectivity.  Must be passed a Queue (output_queue) for writing results.
+    If a ConnectionPool is given the threads will reuse (and return) connections from it instead of always reconnecting.
+    The queue is bounded to max_threads waiting jobs: put() blocks until a thread is free to take one."""
+    ssh_connect_queue = Queue.Queue(maxsize=max_threads)
     for thread_num in range(max_threads):
-        ssh_thread = SSHThread(thread_num, ssh_connect_queue, output_queue)
+        ssh_thread = SSHThread(thread_num, ssh_connect_queue, output_queue, connection_pool)
         ssh_thread.setDaemon(True)
         ssh_thread.start()
     return ssh_connect_queue
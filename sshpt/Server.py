@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Copyright 2011 Dan McDougall <YouKnowWho@YouKnowWhat.com>
+#       Copyright 2015 Jonghak Choi <haginara@gmail.com>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; Version 3 of the License
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, the license can be downloaded here:
+#
+#       http://www.gnu.org/licenses/gpl.html
+
+"""
+'sshpt serve': a long-running sshpt that keeps authenticated connections, decrypted keys and DNS answers between
+jobs, and takes its jobs over a Unix domain socket (only the user running it can connect).
+
+The protocol is JSON Lines.  The client sends one request:
+
+    {"hosts": ["web1", {"host": "web2", "port": 2222}], "commands": ["uptime"], "settings": {"timeout": 5}}
+
+'settings' are command line options by their dest name (see sshpt.run()); the ones left out are the daemon's.
+The daemon answers with one line per host as it finishes (the fields the outfile gets), then {"done": <hosts>},
+or a single {"error": "..."}.  A client that goes away cancels the rest of its job.
+
+'sshpt --server <socket> ...' is such a client: it sends the hosts and commands of its command line and prints the
+results like a local run would.
+"""
+
+import os
+import sys
+import json
+import socket
+import signal
+import datetime
+import pprint
+import logging
+import socketserver
+from argparse import ArgumentParser
+
+from .ConnectionPool import ConnectionPool
+from .KeyCache import key_cache, defaultKeyFile
+from .Generic import Password
+from .OutputWriter import openWriter, formatRecord
+
+logger = logging.getLogger("sshpt")
+
+# Options of 'sshpt --server' that go along with the job (when not left at their default): the others only
+# matter to the client (where hosts come from, how results are printed) or are the daemon's (engine, -T, keys...)
+JOB_SETTINGS = ('username', 'password', 'keypass', 'port', 'timeout', 'command_timeout', 'deadline', 'sudo', 'passwordless',
+                'keyfile', 'sshconfig', 'local_filepath', 'remote_filepath', 'execute', 'remove', 'parallel_commands',
+                'output_budget', 'preflight', 'preflight_timeout', 'preflight_window', 'resolve_ahead', 'canary',
+                'batch_size', 'batch_pause', 'max_failure_rate', 'failure_window', 'journal', 'resume', 'retry_failed',
+                'host_key_policy', 'known_hosts')
+
+# Settings naming files: made absolute by the client, the daemon has a working directory of its own
+PATH_SETTINGS = ('keyfile', 'sshconfig', 'local_filepath', 'journal', 'resume', 'known_hosts')
+
+# Settings a job may not change: the daemon's engine is what keeps connections warm
+DAEMON_SETTINGS = ('engine', 'processes', 'max_threads', 'metrics_port', 'stats_file', 'verbose')
+
+
+def resultRecord(queueObj):
+    """Returns the fields of a result that go back to the client, in the outfile's order"""
+    record = {'host': queueObj['host'], 'connection_result': queueObj['connection_result'], 'timestamp': str(datetime.datetime.now()),
+              'commands': queueObj['commands'], 'command_output': queueObj['command_output']}
+    if queueObj.get('timings'):
+        record['timings'] = queueObj['timings']
+    return record
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """Runs the job of one connection and streams its results back"""
+    def handle(self):
+        from .Results import defaultOptions, ResultIterator
+        from .sshpt import SSHPowerTool
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8') or 'null')
+            if not isinstance(request, dict) or not isinstance(request.get('hosts'), list):
+                raise ValueError("expected a JSON object with a list of 'hosts'")
+            settings = dict(request.get('settings') or {})
+            refused = [name for name in settings if name in DAEMON_SETTINGS]
+            if refused:
+                raise ValueError(f"settings of the daemon, not of a job: {', '.join(refused)}")
+            settings = dict(self.server.settings, **settings)
+            settings['commands'] = list(request.get('commands') or [])
+            options = defaultOptions(**settings)
+            options.hosts = ({'host': host} if isinstance(host, str) else host for host in request['hosts'])
+            if options.keyfile and not options.passwordless and not options.keypass:
+                checkKeyPassphrase(options.keyfile)
+            # Settings the tool can't work with (e.g. a --batch-size that isn't one) fail here: tell the client why
+            tool = SSHPowerTool(options)
+        except Exception as detail:
+            self.reply({'error': str(detail)})
+            return
+        tool.connection_pool = self.server.pool
+        results = ResultIterator(tool)
+        count = 0
+        try:
+            for queueObj in results:
+                self.reply(resultRecord(queueObj))
+                count += 1
+            self.reply({'done': count})
+        except (IOError, OSError) as detail:
+            logger.info("Client went away (%s): cancelling its job", detail)
+            results.cancel()
+        except Exception as detail:
+            logger.error("Job failed: %s", detail)
+            self.reply({'error': str(detail)})
+
+    def reply(self, message):
+        self.wfile.write(json.dumps(message).encode('utf-8') + b"\n")
+        self.wfile.flush()
+
+
+def checkKeyPassphrase(keyfile):
+    """Raises ValueError if the private key 'keyfile' can't be used without a passphrase: loading it would ask for
+    one on the daemon's terminal, holding up every job's keys meanwhile"""
+    import paramiko
+    try:
+        key_cache.load(keyfile, None, prompt=False)
+    except paramiko.PasswordRequiredException:
+        raise ValueError(f"private key {keyfile} needs its passphrase: send it along (-K)")
+    except Exception:
+        pass # e.g. no such file: the job reports it like a local run would
+
+
+class JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves jobs on the Unix socket 'path' (one thread per connection), all sharing one ConnectionPool.
+
+    settings - Dict: The daemon's options by dest name, the defaults of every job
+    pool - ConnectionPool: Authenticated connections kept open between jobs
+    """
+    daemon_threads = True
+
+    def __init__(self, path, settings, pool):
+        self.path = path
+        self.settings = settings
+        self.pool = pool
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX)
+            try:
+                probe.connect(path)
+                raise OSError(f"{path} is in use: is another 'sshpt serve' running?")
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.unlink(path) # Left behind by a daemon that didn't shut down cleanly
+            finally:
+                probe.close()
+        # The socket gets the user's permissions only: whoever can connect runs commands with the daemon's keys
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(self, path, JobHandler)
+        finally:
+            os.umask(umask)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def createServeParser():
+    parser = ArgumentParser(prog="sshpt serve", usage="sshpt serve [options]",
+        description="Keep connections, keys and workers warm and run jobs sent over a Unix socket (e.g. by 'sshpt --server <socket> ...').")
+    parser.add_argument("--socket", dest="socket", default=os.path.expanduser("~/.sshpt.sock"), metavar="<path>",
+        help="The Unix socket to listen on [default: ~/.sshpt.sock].")
+    parser.add_argument("--pool-size", dest="pool_size", type=int, default=1000, metavar="<int>",
+        help="Maximum number of idle connections kept open between jobs [default: 1000].")
+    parser.add_argument("--idle-timeout", dest="idle_timeout", type=float, default=300.0, metavar="<seconds>",
+        help="Close connections that were idle this long [default: 300].")
+    parser.add_argument("-T", "--threads", dest="max_threads", type=int, default=10, metavar="<int>",
+        help="Number of threads each job gets for simultaneous connection attempts [default: 10].")
+    parser.add_argument("-k", "--key-file", dest="keyfile", default="-", metavar="<file>", nargs="?",
+        help="Private key file used by jobs that don't name one.  If provided without a value, defaults to the first of ~/.ssh/id_ed25519, ~/.ssh/id_ecdsa and ~/.ssh/id_rsa that exists")
+    parser.add_argument("-K", "--key-pass", dest="keypass", metavar="<password>", default=None,
+        help="The password of the private key file (asked for once at startup otherwise).")
+    parser.add_argument("-X", "--passwordless", action="store_true", dest="passwordless", default=False,
+        help="Use ssh keys without a password")
+    parser.add_argument("-u", "--username", dest="username", default=None, metavar="<username>",
+        help="The username jobs connect with unless they (or the ssh config file) say otherwise [default: the current user].")
+    parser.add_argument("-t", "--timeout", dest="timeout", type=float, default=30.0, metavar="<seconds>",
+        help="Timeout (in seconds) before giving up on an SSH connection (default: 30)")
+    parser.add_argument("--debug", dest="debug_level", choices=['err', 'warn', 'info', 'debug'], default="warn",
+        help="Level of debug messages, defaults to [warn]")
+    return parser
+
+
+def serveMain(argv=None):
+    """'sshpt serve': runs the daemon until it is interrupted"""
+    from .main import DEBUG_LEVEL
+    options = createServeParser().parse_args(argv)
+    logging.basicConfig(level=DEBUG_LEVEL[options.debug_level])
+    keyfile = defaultKeyFile() if options.keyfile is None else (None if options.keyfile == '-' else options.keyfile)
+    settings = dict(username=options.username, timeout=options.timeout, max_threads=options.max_threads,
+                    keyfile=keyfile, passwordless=options.passwordless)
+    if keyfile:
+        # Decrypted once now (asking for the passphrase while there still is a terminal), then shared by every job
+        try:
+            key_cache.load(keyfile, None if options.passwordless else options.keypass, prompt=not options.passwordless)
+        except Exception as detail:
+            print(f"Could not load private key {keyfile}: {detail}", file=sys.stderr)
+            return 2
+    try:
+        server = JobServer(options.socket, settings, ConnectionPool(options.pool_size, options.idle_timeout))
+    except OSError as detail:
+        print(f"Error: {detail}", file=sys.stderr)
+        return 2
+    logger.warning("sshpt serving on %s", options.socket)
+    # Stopped by a service manager: still remove the socket and close the connections on the way out
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.pool.close()
+    return 0
+
+
+def jobRequest(options):
+    """Returns the request 'sshpt --server' sends for its command line 'options'"""
+    from .Results import defaultOptions
+    defaults = defaultOptions()
+    settings = {}
+    for name in JOB_SETTINGS:
+        value = getattr(options, name, None)
+        if value != getattr(defaults, name):
+            if name in PATH_SETTINGS and isinstance(value, str):
+                value = os.path.abspath(os.path.expanduser(value))
+            settings[name] = str(value) if isinstance(value, Password) else value
+    hosts = []
+    for host in options.hosts:
+        if host.get('password') is not None:
+            host = dict(host, password=str(host['password']))
+        hosts.append(host if set(host) != {'host'} else host['host'])
+    return {'hosts': hosts, 'commands': list(options.commands or []), 'settings': settings}
+
+
+def submitJob(options):
+    """'sshpt --server <socket> ...': runs the job on the daemon and prints its results.  Returns the exit code."""
+    client = socket.socket(socket.AF_UNIX)
+    try:
+        client.connect(options.server)
+    except OSError as detail:
+        print(f"Error: could not connect to the sshpt daemon on {options.server}: {detail}", file=sys.stderr)
+        return 2
+    writer = openWriter(options.outfile, options.output_format) if options.outfile else None
+    try:
+        client.sendall(json.dumps(jobRequest(options)).encode('utf-8') + b"\n")
+        for line in client.makefile('rb'):
+            message = json.loads(line.decode('utf-8'))
+            if 'error' in message:
+                print(f"Error: {message['error']}", file=sys.stderr)
+                return 2
+            if 'done' in message:
+                return 0
+            if options.verbose:
+                if options.output_format == 'json':
+                    pprint.pprint(message, width=100)
+                else:
+                    print(formatRecord(message, 'csv'))
+            if writer:
+                writer.write(message)
+        print("Error: the sshpt daemon went away before the job was done", file=sys.stderr)
+        return 2
+    finally:
+        client.close()
+        if writer:
+            writer.close()
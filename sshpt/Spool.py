@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Copyright 2011 Dan McDougall <YouKnowWho@YouKnowWhat.com>
+#       Copyright 2015 Jonghak Choi <haginara@gmail.com>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; Version 3 of the License
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, the license can be downloaded here:
+#
+#       http://www.gnu.org/licenses/gpl.html
+
+import os
+import mmap
+import codecs
+import tempfile
+import logging
+
+logger = logging.getLogger("sshpt")
+
+# How much of a spilled file is decoded at a time when it is read back
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+class OutputSpool(object):
+    """
+    Collects the command output of one host within a memory budget (in bytes).
+
+    While the host's output fits in the budget everything stays in memory.  Once it doesn't, the command currently
+    being written is spilled to a temporary file and only a head and a tail excerpt of it are kept in memory.
+    Use section(index).write(text) to add the output of each command, then results() once the host is done.
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.excerpt_size = max(budget // 4, 1)
+        self.in_memory = 0
+        self.total_bytes = 0
+        self.sections = {}
+
+    def section(self, index):
+        """Returns the SpoolSection collecting the output of command number 'index'"""
+        if index not in self.sections:
+            self.sections[index] = SpoolSection(self)
+        return self.sections[index]
+
+    def results(self):
+        """Returns (command_output, command_output_files): the per-command outputs (excerpts for spilled ones)
+        and a {index: path} dict of the temporary files holding the complete output of spilled commands."""
+        command_output = []
+        command_output_files = {}
+        for index in sorted(self.sections):
+            section = self.sections[index]
+            section.close()
+            command_output.append(section.getvalue())
+            if section.path:
+                command_output_files[index] = section.path
+        return command_output, command_output_files
+
+
+class SpoolSection(object):
+    """The output of a single command within an OutputSpool"""
+    def __init__(self, spool):
+        self.spool = spool
+        self.memory = bytearray()
+        self.head = b''
+        self.tail = bytearray()
+        self.file = None
+        self.path = None
+        self.total_bytes = 0
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.total_bytes += len(data)
+        self.spool.total_bytes += len(data)
+        if self.file is None:
+            self.memory.extend(data)
+            self.spool.in_memory += len(data)
+            if self.spool.in_memory > self.spool.budget:
+                self.spill()
+            return
+        self.file.write(data)
+        self.tail.extend(data)
+        del self.tail[:-self.spool.excerpt_size]
+
+    def spill(self):
+        """Moves this command's output to a temporary file, keeping only the head and the tail in memory"""
+        excerpt_size = self.spool.excerpt_size
+        fd, self.path = tempfile.mkstemp(prefix='sshpt-', suffix='.out')
+        self.file = os.fdopen(fd, 'wb')
+        self.file.write(self.memory)
+        self.head = bytes(self.memory[:excerpt_size])
+        self.tail = bytearray(self.memory[-excerpt_size:])
+        self.spool.in_memory -= len(self.memory) - len(self.head) - len(self.tail)
+        self.memory = bytearray()
+        logger.debug("Spilled command output over budget to %s", self.path)
+
+    def close(self):
+        if self.file is not None and not self.file.closed:
+            self.file.close()
+
+    def getvalue(self):
+        if self.path is None:
+            return self.memory.decode('utf-8', 'replace')
+        omitted = self.total_bytes - len(self.head) - len(self.tail)
+        head = self.head.decode('utf-8', 'replace')
+        tail = bytes(self.tail).decode('utf-8', 'replace')
+        return f"{head}\n... [{omitted} bytes omitted, {self.total_bytes} bytes in total] ...\n{tail}"
+
+
+def readSpool(path):
+    """Yields the text of a spilled output file in pieces, reading it through a memory map"""
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for offset in range(0, len(mapped), READ_CHUNK_SIZE):
+                yield decoder.decode(mapped[offset:offset + READ_CHUNK_SIZE])
+    yield decoder.decode(b'', final=True)
+
+
+def removeSpool(command_output_files):
+    """Deletes the temporary files of a record once it has been written out"""
+    for path in (command_output_files or {}).values():
+        try:
+            os.remove(path)
+        except OSError as detail:
+            logger.warning("Could not remove spilled output %s: %s", path, detail)
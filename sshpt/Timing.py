@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Copyright 2011 Dan McDougall <YouKnowWho@YouKnowWhat.com>
+#       Copyright 2015 Jonghak Choi <haginara@gmail.com>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; Version 3 of the License
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, the license can be downloaded here:
+#
+#       http://www.gnu.org/licenses/gpl.html
+
+import time
+import math
+import heapq
+import threading
+from contextlib import contextmanager
+
+# Phases in the order they happen to a host (a host only has the ones it went through)
+PHASES = ['dns', 'connect', 'kex', 'auth', 'sftp', 'exec']
+
+
+class PhaseTimer(object):
+    """
+    Measures how long each phase of a host's job takes, using time.monotonic().
+
+    timings - Dict: {phase: seconds}.  Phases that happen more than once (e.g. several sftp puts) add up.
+    """
+    def __init__(self):
+        self.started = time.monotonic()
+        self.timings = {}
+
+    @contextmanager
+    def phase(self, name):
+        """Times the body of a 'with' block as (part of) phase 'name'"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - started)
+
+    def add(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def stop(self):
+        """Returns the timings, rounded to the microsecond, along with the 'total' time since the timer was created"""
+        timings = {name: round(self.timings[name], 6) for name in PHASES if name in self.timings}
+        timings['total'] = round(time.monotonic() - self.started, 6)
+        return timings
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return None
+    return values[max(0, min(len(values) - 1, int(math.ceil(percent / 100.0 * len(values))) - 1))]
+
+
+class RunSummary(object):
+    """
+    Output observer that collects the timings of every result and reports, once the run is done,
+    the p50/p95/p99 of each phase and the 'slowest' hosts.
+
+    concurrency - AdaptiveLimiter: With --adaptive, whose report of the concurrency over time ends the summary
+    """
+    def __init__(self, slowest=10):
+        self.slowest = slowest
+        self.concurrency = None
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.hosts = [] # Heap of the slowest (total, host, sequence, timings)
+        self.results = {}
+        self.sequence = 0 # Tie-breaker, so that timings dicts never get compared
+
+    def observe(self, queueObj):
+        if 'event' in queueObj:
+            return
+        timings = queueObj.get('timings')
+        with self.lock:
+            status = queueObj.get('connection_result')
+            self.results[status] = self.results.get(status, 0) + 1
+            if not timings:
+                return
+            for name, seconds in timings.items():
+                self.phases.setdefault(name, []).append(seconds)
+            self.sequence += 1
+            entry = (timings['total'], queueObj['host'], self.sequence, timings)
+            if len(self.hosts) < self.slowest:
+                heapq.heappush(self.hosts, entry)
+            elif entry[:3] > self.hosts[0][:3]:
+                heapq.heapreplace(self.hosts, entry)
+
+    def percentiles(self, name='total'):
+        """Returns the (p50, p95, p99) of phase 'name' (or of the total time per host), None if no host went through it"""
+        with self.lock:
+            values = sorted(self.phases.get(name, []))
+        if not values:
+            return None
+        return tuple(percentile(values, percent) for percent in (50, 95, 99))
+
+    def report(self):
+        """Returns the summary as text"""
+        with self.lock:
+            lines = ["Results: " + ", ".join(f"{count} {status}" for status, count in sorted(self.results.items()))]
+            lines.append(f"{'phase':<8} {'hosts':>7} {'p50':>10} {'p95':>10} {'p99':>10}")
+            for name in PHASES + ['total']:
+                if name not in self.phases:
+                    continue
+                values = sorted(self.phases[name])
+                lines.append(f"{name:<8} {len(values):>7} " + " ".join(f"{percentile(values, percent):>10.4f}" for percent in (50, 95, 99)))
+            if self.hosts:
+                lines.append(f"Slowest {len(self.hosts)} hosts:")
+                for total, host, sequence, timings in sorted(self.hosts, key=lambda entry: entry[:3], reverse=True):
+                    phases = " ".join(f"{name}={timings[name]:.4f}" for name in PHASES if name in timings)
+                    lines.append(f"  {host:<30} {total:>10.4f}  {phases}")
+        if self.concurrency is not None:
+            lines.append(self.concurrency.report())
+        return "\n".join(lines)
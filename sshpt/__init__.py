@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import types
+
+__all__ = ['run', 'ResultIterator', 'SSHPowerTool']
+
+
+class _LazyModule(types.ModuleType):
+    """The sshpt package, importing its library API on first use: 'sshpt -v' and 'sshpt --help' (which import
+    sshpt.main) never load paramiko.  A module level __getattr__ (PEP 562) would do the same from Python 3.7 on."""
+    def __getattr__(self, name):
+        if name in ('run', 'ResultIterator'):
+            from . import Results
+            return getattr(Results, name)
+        if name == 'SSHPowerTool':
+            from .sshpt import SSHPowerTool
+            return SSHPowerTool
+        raise AttributeError(f"module 'sshpt' has no attribute {name!r}")
+
+
+sys.modules[__name__].__class__ = _LazyModule
@@ -24,16 +24,13 @@ from __future__ import print_function
 import sys
 import select
 import getpass
-from configparser import SafeConfigParser
-from argparse import ArgumentParser
+import importlib.util
+from argparse import ArgumentParser, ArgumentTypeError
 import logging
 
 from . import version
-from .sshpt import SSHPowerTool
-from .SSHQueue import stopSSHQueue
-from .OutputThread import stopOutputThread
-
 from .Generic import Password
+from .KeyCache import defaultKeyFile
 
 # map the debug_level choices to the python logging levels
 DEBUG_LEVEL = { 'err': logging.ERROR,
@@ -49,13 +46,65 @@ def _parse_hostfile(host):
     return hosts
 
 
+def _iter_host_lines(hosts):
+    """Yields the non-empty, non-comment host entries of 'hosts' one at a time.
+    'hosts' can be a string or any iterable of lines (a list, an open file, sys.stdin...)."""
+    if isinstance(hosts, str):
+        hosts = hosts.splitlines()
+    for host in hosts:
+        host = host.strip()
+        if host and not host.startswith("#"):
+            yield host
+
+
 def _normalize_hosts(hosts):
+    """Lazily turns the host entries into host dicts, so huge inventories never have to be held in memory"""
     if hosts is None:
-        return []
-    if isinstance(hosts, str):
-        hosts = filter(lambda h: (not h.startswith("#") and h != ""), hosts.splitlines())
-        hosts = [host.strip() for host in hosts]
-    return [_parse_hostfile(host) if ':' in host else {'host': host} for host in hosts]
+        return
+    for host in _iter_host_lines(hosts):
+        yield _parse_hostfile(host) if ':' in host else {'host': host}
+
+
+def _parse_size(size):
+    """Parses a byte count with an optional K/M/G suffix (e.g. '512K', '10M')"""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def _positive_int(value):
+    """argparse type: an integer of at least 1"""
+    number = int(value)
+    if number < 1:
+        raise ArgumentTypeError(f"{value} is not 1 or more")
+    return number
+
+
+def _non_negative_int(value):
+    """argparse type: an integer of 0 or more"""
+    number = int(value)
+    if number < 0:
+        raise ArgumentTypeError(f"{value} is not 0 or more")
+    return number
+
+
+def _batch_size(value):
+    """argparse type of --batch-size: a number of hosts (1 or more) or a percentage of them ('10%', over 0 and up to 100)"""
+    value = value.strip()
+    if not value.endswith('%'):
+        try:
+            return _positive_int(value)
+        except ValueError:
+            raise ArgumentTypeError(f"{value} is neither a number of hosts nor a percentage (e.g. 10%)")
+    try:
+        percent = float(value[:-1])
+    except ValueError:
+        raise ArgumentTypeError(f"{value} is neither a number of hosts nor a percentage (e.g. 10%)")
+    if not 0 < percent <= 100:
+        raise ArgumentTypeError(f"{value} is not a percentage over 0 and up to 100")
+    return value
 
 
 def option_parse(options):
@@ -63,11 +112,15 @@ def option_parse(options):
         print("Error: You have not specified any mechanism to output results.")
         print("Please don't use quite mode (-q) without an output file (-o <file>).")
         return 2
+    if options.output_format == 'sqlite' and options.outfile is None:
+        print("Error: -O sqlite needs the database to write to (-o <file>).")
+        return 2
     return 0
 
 
-def create_argument():
-    usage = 'usage: sshpt [options] "[command1]" "[command2]" ...'
+def create_parser():
+    """Returns the ArgumentParser of the command line (also where the library API gets its defaults from)"""
+    usage = 'usage: sshpt [options] "[command1]" "[command2]" ...\n       sshpt serve [options]'
 
     default_username=getpass.getuser()
     parser = ArgumentParser(usage=usage)
@@ -84,9 +137,10 @@ def create_argument():
         help="Configuration file with INI Format. ex)--ini-file path, server")
     host_group.add_argument("-j", "--json", default=None, nargs=2,
         help="Configuration file with JSON Format. ex)--json path, server")
+    # -k/--key-file uses the same "-" default as -C/--ssh-config below
     parser.add_argument("-k", "--key-file", dest="keyfile", default="-", metavar="<file>", nargs="?",
-        help="""Location of the private key file.  If provided without a value, defaults to
-        /home/<username>/.ssh/id_rsa""")
+        help="""Location of the private key file (Ed25519, ECDSA or RSA).  If provided without a value, defaults to
+        the first of ~/.ssh/id_ed25519, ~/.ssh/id_ecdsa and ~/.ssh/id_rsa that exists""")
     parser.add_argument("-K", "--key-pass", dest="keypass", metavar="<password>", default=None,
         help="The password to be used when use the private key file).")
     parser.add_argument("-o", "--outfile", dest="outfile", default=None, metavar="<file>",
@@ -95,10 +149,80 @@ def create_argument():
         help='Location of the file containing the credentials to be used for connections (format is "username:password").')
     parser.add_argument("-T", "--threads", dest="max_threads", type=int, default=10, metavar="<int>",
         help="Number of threads to spawn for simultaneous connection attempts [default: 10].")
-    parser.add_argument("-P", "--port", dest="port", type=int, default=22, metavar="<port>",
-        help="The port to be used when connecting.  Defaults to 22.")
-    parser.add_argument("-u", "--username", dest="username", default=default_username, metavar="<username>",
-        help=f"The username to be used when connecting.  Defaults to the currently logged-in user [{default_username}].")
+    parser.add_argument("--adaptive", dest="adaptive", action="store_true", default=False,
+        help="Grow and shrink the number of hosts worked on at once between --min-threads and -T (times --processes): up while hosts keep succeeding, halved when connections time out, get refused or handshakes slow down (e.g. sshd's MaxStartups).")
+    parser.add_argument("--min-threads", dest="min_threads", type=_positive_int, default=2, metavar="<int>",
+        help="With --adaptive, the number of hosts worked on at once to start from and never go below [default: 2].")
+    parser.add_argument("--preflight", dest="preflight", action="store_true", default=False,
+        help="Before connecting, check that every host accepts TCP connections on its SSH port (many hosts at once, from a single thread). Hosts that don't are reported FAILED (reason: unreachable) right away instead of tying up a worker until -t.")
+    parser.add_argument("--preflight-timeout", dest="preflight_timeout", type=float, default=3.0, metavar="<seconds>",
+        help="With --preflight, how long a host has to accept the TCP connection [default: 3].")
+    parser.add_argument("--preflight-window", dest="preflight_window", type=_positive_int, default=512, metavar="<int>",
+        help="With --preflight, how many hosts are probed at once (each probe holds a file descriptor) [default: 512].")
+    parser.add_argument("--resolve-ahead", dest="resolve_ahead", action="store_true", default=False,
+        help="Resolve hostnames ahead of dispatch with a pool of --dns-workers threads and cache the answers, so that workers never wait on DNS. Hosts that don't resolve are reported FAILED (reason: dns) right away.")
+    parser.add_argument("--dns-workers", dest="dns_workers", type=_positive_int, default=16, metavar="<int>",
+        help="With --resolve-ahead (or --preflight), how many hostnames are resolved at once [default: 16].")
+    parser.add_argument("--dns-ttl", dest="dns_ttl", type=float, default=300.0, metavar="<seconds>",
+        help="With --resolve-ahead, how long an answer is reused [default: 300].")
+    parser.add_argument("--dns-negative-ttl", dest="dns_negative_ttl", type=float, default=30.0, metavar="<seconds>",
+        help="With --resolve-ahead, how long a failure to resolve is remembered [default: 30].")
+    parser.add_argument("--engine", dest="engine", choices=['thread', 'asyncio'], default="thread",
+        help="Execution engine: one thread per -T slot, or a single asyncio event loop running -T hosts at once (requires asyncssh) [default: thread].")
+    parser.add_argument("--processes", dest="processes", type=_positive_int, default=1, metavar="<int>",
+        help="Spread hosts over this many worker processes, each running -T threads (or -T hosts with --engine asyncio), to use more than one core [default: 1].")
+    parser.add_argument("--parallel-commands", dest="parallel_commands", type=_positive_int, default=1, metavar="<int>",
+        help="Run up to this many of the given commands at the same time on each host, over separate channels of the same connection. Keep it at or below the server's MaxSessions (sshd default: 10) [default: 1].")
+    parser.add_argument("--stream", dest="stream", action="store_true", default=False,
+        help="Print command output as it arrives instead of once each host is done.")
+    parser.add_argument("--stream-mode", dest="stream_mode", choices=['line', 'chunk'], default="line",
+        help="With --stream, write one record per line of output or one per chunk read from the channel [default: line].")
+    parser.add_argument("--stream-buffer", dest="stream_buffer", type=_positive_int, default=64, metavar="<int>",
+        help="With --stream, how many records per host may wait to be written before reading from that host pauses [default: 64].")
+    parser.add_argument("--output-budget", dest="output_budget", type=_parse_size, default=None, metavar="<bytes>",
+        help="Keep at most this much command output per host in memory (e.g. 512K, 10M). Output past it is spilled to a temporary file; results show the head and tail and the outfile gets everything.")
+    parser.add_argument("--flush-records", dest="flush_records", type=int, default=1000, metavar="<int>",
+        help="Flush the outfile after this many results (or once --flush-interval passed, whichever comes first) [default: 1000].")
+    parser.add_argument("--flush-bytes", dest="flush_bytes", type=_parse_size, default="1M", metavar="<bytes>",
+        help="Flush the outfile after this much output (e.g. 64K, 1M) [default: 1M].")
+    parser.add_argument("--flush-interval", dest="flush_interval", type=float, default=1.0, metavar="<seconds>",
+        help="Flush the outfile at least this often, whether or not more results come in [default: 1.0].")
+    parser.add_argument("--fsync", dest="fsync", action="store_true", default=False,
+        help="fsync() the outfile on every flush.")
+    parser.add_argument("--aggregate", dest="aggregate", action="store_true", default=False,
+        help="Instead of one record per host, print each distinct result once the run is done, with the hosts that returned it folded into ranges (e.g. web[01-40,42]), outliers first. An outfile (-o) still gets every record.")
+    parser.add_argument("--summary", dest="summary", action="store_true", default=False,
+        help="Once the run is done, print the p50/p95/p99 time of each phase (dns, connect, kex, auth, sftp, exec) and the slowest hosts to stderr.")
+    parser.add_argument("--slowest", dest="slowest", type=int, default=10, metavar="<int>",
+        help="How many of the slowest hosts --summary lists [default: 10].")
+    parser.add_argument("--canary", dest="canary", type=_non_negative_int, default=0, metavar="<int>",
+        help="Run on this many hosts first, and stop (reporting the other hosts SKIPPED) if any of them fails.")
+    parser.add_argument("--batch-size", dest="batch_size", type=_batch_size, default=None, metavar="<int>|<percent>%",
+        help="Dispatch hosts this many (or this percentage of all hosts) at a time, each batch once the previous one is done.")
+    parser.add_argument("--batch-pause", dest="batch_pause", type=float, default=0.0, metavar="<seconds>",
+        help="With --canary/--batch-size, how long to wait between batches [default: 0].")
+    parser.add_argument("--max-failure-rate", dest="max_failure_rate", type=float, default=None, metavar="<percent>",
+        help="Stop dispatching (the hosts in flight finish, the others are reported SKIPPED) once more than this percentage of the last --failure-window hosts (or of a whole batch) failed.")
+    parser.add_argument("--failure-window", dest="failure_window", type=int, default=20, metavar="<int>",
+        help="How many of the most recent results --max-failure-rate looks at [default: 20].")
+    parser.add_argument("--journal", dest="journal", default=None, metavar="<file>",
+        help="Append every host done (host, port, hash of the commands, result) to this journal as results come in, for --resume.")
+    parser.add_argument("--resume", dest="resume", default=None, metavar="<journal>",
+        help="Skip the hosts this journal lists as done with the same commands, and keep appending to it (unless --journal says otherwise).")
+    parser.add_argument("--retry-failed", dest="retry_failed", action="store_true", default=False,
+        help="With --resume, only skip the hosts that succeeded: the failed ones are tried again.")
+    parser.add_argument("--metrics-port", dest="metrics_port", type=int, default=None, metavar="<port>",
+        help="Serve live run metrics (Prometheus text format) on http://127.0.0.1:<port>/metrics.")
+    parser.add_argument("--stats-file", dest="stats_file", default=None, metavar="<file>",
+        help="Rewrite this file with the live run metrics (Prometheus text format) every --stats-interval seconds.")
+    parser.add_argument("--stats-interval", dest="stats_interval", type=float, default=5.0, metavar="<seconds>",
+        help="How often --stats-file is rewritten [default: 5].")
+    parser.add_argument("--server", dest="server", default=None, metavar="<socket>",
+        help="Send the job to the 'sshpt serve' daemon listening on this Unix socket (which keeps connections to the hosts open between jobs) and print the results it streams back.  Credentials not given are the daemon's.")
+    parser.add_argument("-P", "--port", dest="port", type=int, default=None, metavar="<port>",
+        help="The port to be used when connecting (wins over the ssh config file's Port).  Defaults to 22.")
+    parser.add_argument("-u", "--username", dest="username", default=None, metavar="<username>",
+        help=f"The username to be used when connecting (wins over the ssh config file's User).  Defaults to the currently logged-in user [{default_username}].")
     parser.add_argument("-p", "--password", dest="password", default=None, metavar="<password>",
         help="The password to be used when connecting (not recommended--use an authfile unless the username and password are transient).")
     parser.add_argument("-q", "--quiet", action="store_false", dest="verbose", default=True,
@@ -109,15 +233,23 @@ def create_argument():
         help="Execute the copied file (just like executing a given command).")
     parser.add_argument("-r", "--remove", action="store_true", dest="remove", default=False,
         help="Remove (clean up) the SFTP'd file after execution.")
-    parser.add_argument("-t", "--timeout", dest="timeout", default=30, metavar="<seconds>",
+    parser.add_argument("-t", "--timeout", dest="timeout", type=float, default=30.0, metavar="<seconds>",
         help="Timeout (in seconds) before giving up on an SSH connection (default: 30)")
+    parser.add_argument("--command-timeout", dest="command_timeout", type=float, default=None, metavar="<seconds>",
+        help="Close a command's channel once it ran this long; the host is reported TIMEOUT with the output it printed until then.")
+    parser.add_argument("--deadline", dest="deadline", type=float, default=None, metavar="<seconds>",
+        help="End the whole run this many seconds after it started: running commands are cut short (TIMEOUT) and hosts not started yet are reported SKIPPED.")
+    parser.add_argument("--host-key-policy", dest="host_key_policy", choices=['strict', 'accept-new', 'off'], default="off",
+        help="Check host keys against --known-hosts: 'strict' only connects to hosts whose key is known, 'accept-new' also adds the keys of hosts seen for the first time (a changed key is refused either way), 'off' accepts any key [default: off].")
+    parser.add_argument("--known-hosts", dest="known_hosts", default=None, metavar="<file>",
+        help="The known_hosts file --host-key-policy uses (plain and hashed entries, @revoked) [default: ~/.ssh/known_hosts].")
     parser.add_argument("-s", "--sudo", nargs="?", action="store", dest="sudo", default=False,
         help="Use sudo to execute the command (default: as root).")
     parser.add_argument("-X", "--passwordless", action="store_true", dest="passwordless", default=False,
         help="Use ssh keys without a password")
     parser.add_argument("-O", "--output-format", dest="output_format",
-        choices=['csv', 'json'], default="csv",
-        help="Ouptut format")
+        choices=['csv', 'json', 'sqlite'], default="csv",
+        help="Ouptut format.  With sqlite, -o is an SQLite database that results of every run are added to (stdout stays CSV)")
     parser.add_argument("--debug", dest="debug_level",
         choices=['err', 'warn', 'info', 'debug'], default="warn",
         help="Level of debug messages, defaults to [warn]")
@@ -128,7 +260,7 @@ def create_argument():
     #    None     = -C passed with no arg, set to default .sshconfig relative user
     #    anything = <anything> passed as the arg
     parser.add_argument("-C", "--ssh-config", dest="sshconfig", default="-", metavar="<file>", nargs="?",
-        help=f"use ssh config file for hosts.  Defaults to /home/{default_username}/.ssh/config")
+        help=f"use ssh config file for hosts (HostName, Port, User, IdentityFile and ProxyCommand are applied; host file entries still win).  Defaults to /home/{default_username}/.ssh/config")
 
     action_group = parser.add_mutually_exclusive_group(required=True)
     action_group.add_argument("-c", "--copy-file", dest="local_filepath", default=None, metavar="<file>",
@@ -136,25 +268,32 @@ def create_argument():
     action_group.add_argument('commands', metavar='Commands', type=str, nargs='*', default=False,
         help='Commands')
 
-    options = parser.parse_args()
+    return parser
+
+
+def create_argument(argv=None):
+    """Parses the command line (or 'argv', a list of arguments without the program name) into the run's options"""
+    options = create_parser().parse_args(argv)
 
     logging.basicConfig(level=DEBUG_LEVEL[options.debug_level])
 
+    # Host sources are left as iterables and parsed one line at a time while the run dispatches them
     if options.hostfile:
-        options.hosts = options.hostfile.read()
+        options.hosts = options.hostfile
     elif options.stdin:
         # if stdin wasn't piped in, prompt the user for it now
         if not select.select([sys.stdin, ], [], [], 0.0)[0]:
             sys.stdout.write("Enter list of hosts (one entry per line). ")
             sys.stdout.write("Ctrl-D to end input.\n")
         # in either case, read data from stdin
-        options.hosts = sys.stdin.read()
+        options.hosts = sys.stdin
     elif options.hosts:
         options.hosts = options.hosts.split(":")
     elif options.ini_file:
+        from configparser import SafeConfigParser
         ini_config = SafeConfigParser(allow_no_value=True)
         ini_config.read(options.ini_file[0])
-        options.hosts = [server[1] for server in ini_config.items(options.ini_file[1])]
+        options.hosts = (server[1] for server in ini_config.items(options.ini_file[1]))
         if ini_config.has_section('Commands'):
             for command in ini_config.items("Commands"):
                 if options.commands == command[0]:
@@ -170,11 +309,17 @@ def create_argument():
         options.password = Password(options.password.rstrip('\n'))
     options.sudo = 'root' if options.sudo is None else options.sudo
 
-    # Get the username and password to use when checking hosts
-    if options.username is None:
-        options.username = input('Username: ')
-    if options.keyfile and options.keypass is None and not options.passwordless:
-        options.keypass = Password(getpass.getpass('Passphrase: '))
+    if options.keyfile is None:
+        options.keyfile = defaultKeyFile()
+    elif options.keyfile == '-':
+        options.keyfile = None
+
+    # Get the password to use when checking hosts (the username defaults to the ssh config file's, then the current user)
+    if options.server and not options.keyfile:
+        pass # The daemon has its own key (or the password given here)
+    elif options.keyfile:
+        if options.keypass is None and not options.passwordless:
+            options.keypass = Password(getpass.getpass('Passphrase: '))
     elif options.password is None and not options.passwordless:
         options.password = Password(getpass.getpass('Password: '))
         if options.password == '':
@@ -184,7 +329,7 @@ def create_argument():
     # if sshconfig is None, use the default relative to username
     # if it's "-", set it to None
     if options.sshconfig is None:
-        options.sshconfig = f"/home/{options.username}/.ssh/config"
+        options.sshconfig = f"/home/{options.username or getpass.getuser()}/.ssh/config"
         print(f"using default ssh-config file: {options.sshconfig}")
     elif options.sshconfig == '-':
         options.sshconfig = None
@@ -196,10 +341,24 @@ def create_argument():
 def main():
     """Main program function:  Grabs command-line arguments, starts up threads, and runs the program.
     """
+    if sys.argv[1:2] == ['serve']:
+        from .Server import serveMain
+        return serveMain(sys.argv[2:])
     # Grab command line arguments and the command to run (if any)
     options = create_argument()
     if 0 != option_parse(options):
         return 2
+    if options.server:
+        from .Server import submitJob
+        return submitJob(options)
+    # The engines (and paramiko with them) are only imported once the command line checks out
+    if options.engine == 'asyncio' and importlib.util.find_spec('asyncssh') is None:
+        print("ERROR: The asyncssh module is required to use the asyncio engine.  Install it with: pip install sshpt[asyncio]")
+        return 1
+    from .sshpt import SSHPowerTool
+    from .SSHQueue import stopSSHQueue
+    from .OutputThread import stopOutputThread
+    from .KnownHosts import flushKnownHosts
     sshpt = SSHPowerTool(options)
     # This wierd little sequence of loops allows us to hit control-C
     # in the middle of program execution and get immediate results
@@ -207,12 +366,26 @@ def main():
         output_queue = sshpt()
         # Just to be safe we wait for the OutputThread to finish before moving on
         output_queue.join()
+        sshpt.stopOutput()
+        sshpt.stopMetrics()
+        sshpt.closeJournal()
+        if sshpt.aggregator and options.verbose:
+            print(sshpt.aggregator.report())
+        if sshpt.summary:
+            print(sshpt.summary.report(), file=sys.stderr)
+        if sshpt.rollout and sshpt.rollout.aborted:
+            print(f"Rollout aborted: {sshpt.rollout.aborted}", file=sys.stderr)
+            return 3
     except KeyboardInterrupt:
         print ('caught KeyboardInterrupt, exiting...')
         # Return code should be 1 if the user issues a SIGINT (control-C)
         # Clean up
         stopSSHQueue()
         stopOutputThread()
+        # The stats file gets the counts of the interrupted run and the metrics port is closed
+        sshpt.stopMetrics()
+        sshpt.closeJournal()
+        flushKnownHosts()
         return 1
     return 0
 
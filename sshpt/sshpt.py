@@ -34,25 +34,32 @@ This program is meant for situations where shared keys are not an option.  If al
 
 # Import built-in Python modules
 from __future__ import absolute_import
-import sys
+import time
+import getpass
 
-from time import sleep
 import logging
 
-try:
-    import paramiko
-    logging.getLogger("paramiko").setLevel(logging.WARNING)
-except ImportError:
-    print("ERROR: The Paramiko module required to use sshpt.")
-    print("Download it here: http://www.lag.net/paramiko/")
-    sys.exit(1)
-
 # Import Internal
-from .OutputThread import startOutputThread, stopOutputThread
-from .SSHQueue import startSSHQueue, stopSSHQueue
+from .OutputThread import startOutputThread
+from .OutputWriter import FlushPolicy
+from .Timing import RunSummary
+from .Metrics import RunMetrics, MetricsPublisher
+from .Adaptive import AdaptiveLimiter
+from .Preflight import sweep
+from .Resolver import resolveAhead, dns_cache
+from .Journal import Journal, loadJournal, skipJournaled
+from .Rollout import Rollout, batchSize
+from .Aggregate import OutputAggregator
+from .KeyCache import key_cache
+from .KnownHosts import flushKnownHosts, lookupAhead
+from .SSHConfig import SSHConfigResolver
+from .Generic import prefetch
 
 logger = logging.getLogger("sshpt")
 
+# How many resolved jobs may be waiting ahead of dispatch
+PREFETCH_SIZE = 256
+
 
 class SSHPowerTool(object):
     #def __init__(self, **kwargs):
@@ -60,56 +67,208 @@ class SSHPowerTool(object):
         self.options = options
         self.output_queue = None # Queue.Queue() where connection results should be put().  If none is given it will use the OutputThread default (output_queue)
         self.ssh_connect_queue = None
+        self.connection_pool = None # ConnectionPool() to keep connections open between runs (thread engine only)
+        self.summary = RunSummary(getattr(options, 'slowest', 10)) if getattr(options, 'summary', False) else None
+        self.metrics = None
+        self.metrics_publisher = None
+        if getattr(options, 'metrics_port', None) is not None or getattr(options, 'stats_file', None):
+            self.metrics = RunMetrics()
+        self.journal = None # Journal() of the hosts done, with --journal/--resume
+        self.aggregator = OutputAggregator() if getattr(options, 'aggregate', False) else None
+        self.run_deadline = None # time.time() by which the current run has to be done (--deadline)
+        self.rollout = None # Rollout() dispatching hosts in batches and aborting when too many fail
+        batch = getattr(options, 'batch_size', None)
+        if getattr(options, 'canary', 0) or batch or getattr(options, 'max_failure_rate', None) is not None:
+            self.rollout = Rollout(getattr(options, 'canary', 0), None if str(batch).endswith('%') else batchSize(batch),
+                                   getattr(options, 'batch_pause', 0.0), getattr(options, 'failure_window', 20), getattr(options, 'max_failure_rate', None))
+        self.observing = False # Whether results go through our own OutputThread (and so reach the observers)
+        self.observers = [] # Extra output observers, called after the built-in ones (e.g. the library's ResultIterator)
+        self.cancelled = False # Set by cancel(): hosts not dispatched yet are skipped
+        self.limiter = None # AdaptiveLimiter() deciding how many of the engine's workers are used (--adaptive)
+        if getattr(options, 'adaptive', False):
+            # -T (times --processes) workers are started either way: the limiter decides how many get a host
+            workers = options.max_threads * (getattr(options, 'processes', 1) or 1)
+            self.limiter = AdaptiveLimiter(getattr(options, 'min_threads', 2), workers)
+            if self.summary:
+                self.summary.concurrency = self.limiter
+            if self.metrics:
+                self.metrics.concurrency = self.limiter
 
     def __call__(self):
         return self.run()
 
-    def run(self):
-        if self.output_queue is None:
-            self.output_queue = startOutputThread(self.options.verbose, self.options.outfile, self.options.output_format)
-        # Start up the Output and SSH threads
-        self.ssh_connect_queue = startSSHQueue(self.output_queue, self.options.max_threads)
-        if not self.options.commands and not self.options.local_filepath:
-            # Assume we're just doing a connection test
-            self.options.commands = ['echo CONNECTION TEST', ]
+    def startEngine(self):
+        """Start up the SSH threads (or the event loop when using the asyncio engine, or worker processes running either)"""
+        engine = getattr(self.options, 'engine', 'thread')
+        processes = getattr(self.options, 'processes', 1) or 1
+        if engine == 'asyncio':
+            # Raises ImportError without asyncssh: here, rather than in every worker process
+            from .AsyncQueue import startAsyncQueue
+        if processes > 1:
+            from .ProcessQueue import startProcessQueue
+            return startProcessQueue(self.output_queue, processes, self.options.max_threads, engine)
+        if engine == 'asyncio':
+            return startAsyncQueue(self.output_queue, self.options.max_threads)
+        # paramiko is only imported once a run starts, so that --help and friends don't pay for it
+        from .SSHQueue import startSSHQueue
+        return startSSHQueue(self.output_queue, self.options.max_threads, self.connection_pool)
 
-        if self.options.sshconfig:
-            ssh_config = paramiko.SSHConfig()
-            ssh_config.parse(open(self.options.sshconfig))
+    def cancel(self):
+        """Stop dispatching: the hosts in flight finish, the others are reported SKIPPED"""
+        self.cancelled = True
+
+    def stopEngine(self):
+        """Let this run's workers go so that repeated runs don't pile up idle threads"""
+        if hasattr(self.ssh_connect_queue, 'stop'):
+            self.ssh_connect_queue.stop()
         else:
-            ssh_config = None
+            for _ in range(self.options.max_threads):
+                self.ssh_connect_queue.put('quit')
 
+    def stopMetrics(self):
+        """Write the final stats file and stop serving metrics (call once the output_queue is done)"""
+        if self.metrics_publisher:
+            self.metrics_publisher.stop()
+            self.metrics_publisher = None
 
-        for host in self.options.hosts:
-            while self.ssh_connect_queue.qsize() > self.options.max_threads:
-                sleep(0.1)
+    def stopOutput(self):
+        """Stop our OutputThread (call once the output_queue is done): the outfile is flushed and closed when this returns"""
+        if self.observing:
+            self.output_queue.put('quit')
+            self.output_queue.join()
+
+    def closeJournal(self):
+        """Close the journal (once the output_queue is done, or the run was interrupted)"""
+        if self.journal:
+            self.journal.close()
+            self.journal = None
 
+    def jobs(self, keypass=None):
+        """Yields one job (queueObj) per host of options.hosts, resolved against the ssh_config file if there is one.
+        Per-host values win over -u/-P, which win over ssh_config ones, which win over the defaults (current user, port 22)."""
+        resolver = SSHConfigResolver(self.options.sshconfig) if self.options.sshconfig else None
+        default_username = getpass.getuser()
+        # options.hosts may be a generator: hosts are pulled one at a time and put() blocks while the workers are busy
+        for host in self.options.hosts:
             if self.options.passwordless:
                 password = None
             else:
-                password = host.get('password', self.options.password).password
-
-            if ssh_config:
-                host_lookup = ssh_config.lookup(host['host'])
-                logger.debug("host_lookup: %s", host_lookup)
-                if host_lookup['hostname'] != host['host']:
-                    logger.debug("found hostname in ssh config file: substituing %s for %s",
-                                 host_lookup['hostname'], host['host'])
-                    host['host'] = host_lookup['hostname']
-
-            queueObj = dict(
-                host=host.get('host'),
-                username=host.get('username', self.options.username),
+                # Either a Password() or a plain string (-p, library callers), None when using a key
+                password = host.get('password', self.options.password)
+                password = str(password) if password is not None else None
+
+            resolved = resolver.resolve(host['host']) if resolver else {}
+            if resolved.get('hostname', host['host']) != host['host']:
+                logger.debug("found hostname in ssh config file: substituing %s for %s",
+                             resolved['hostname'], host['host'])
+
+            yield dict(
+                host=resolved.get('hostname', host['host']),
+                username=host.get('username') or self.options.username or resolved.get('user') or default_username,
                 password=password,
-                keyfile=self.options.keyfile, keypass=self.options.keypass,
+                keyfile=self.options.keyfile or resolved.get('identityfile'), keypass=keypass,
                 timeout=self.options.timeout,
                 commands=self.options.commands,
                 passwordless=self.options.passwordless,
                 local_filepath=self.options.local_filepath, remote_filepath=self.options.remote_filepath,
-                execute=self.options.execute, remove=self.options.remove, sudo=self.options.sudo, port=self.options.port)
-            self.ssh_connect_queue.put(queueObj)
-            #sleep(0.1)
+                execute=self.options.execute, remove=self.options.remove, sudo=self.options.sudo,
+                port=host.get('port') or self.options.port or resolved.get('port') or 22, proxycommand=resolved.get('proxycommand'),
+                parallel_commands=getattr(self.options, 'parallel_commands', 1),
+                stream=getattr(self.options, 'stream_mode', 'line') if getattr(self.options, 'stream', False) else None, stream_buffer=getattr(self.options, 'stream_buffer', 64),
+                output_budget=getattr(self.options, 'output_budget', None),
+                command_timeout=getattr(self.options, 'command_timeout', None), run_deadline=self.run_deadline,
+                host_key_policy=getattr(self.options, 'host_key_policy', 'off'), known_hosts=getattr(self.options, 'known_hosts', None))
+
+    def run(self):
+        if getattr(self.options, 'deadline', None):
+            self.run_deadline = time.time() + self.options.deadline
+        if self.output_queue is None:
+            flush_policy = FlushPolicy(records=getattr(self.options, 'flush_records', 1000), bytes=getattr(self.options, 'flush_bytes', 1024 * 1024),
+                                       interval=getattr(self.options, 'flush_interval', 1.0), fsync=getattr(self.options, 'fsync', False))
+            journal_path = getattr(self.options, 'journal', None) or getattr(self.options, 'resume', None)
+            if journal_path and self.journal is None:
+                self.journal = Journal(journal_path)
+            observers = [observer for observer in (self.summary, self.metrics, self.limiter, self.rollout, self.aggregator) if observer] + self.observers
+            # With --aggregate, stdout only gets the grouped report once the run is done
+            verbose = self.options.verbose and not self.aggregator
+            # A host is only journaled once its result is in the outfile: --resume never skips a host the outfile lacks
+            self.output_queue = startOutputThread(verbose, self.options.outfile, self.options.output_format, flush_policy, observers,
+                                                  [self.journal] if self.journal else None)
+            self.observing = True
+        if self.limiter and not self.observing:
+            # The limiter learns about finished hosts from the OutputThread: without it, it would never let go
+            logger.warning("--adaptive needs sshpt's own output queue: using all %d workers", self.limiter.maximum)
+            self.limiter = None
+        if self.rollout and not self.observing:
+            logger.warning("Batches and --max-failure-rate need sshpt's own output queue: dispatching every host")
+            self.rollout = None
+        keypass = str(self.options.keypass) if self.options.keypass else None
+        if self.options.keyfile and getattr(self.options, 'engine', 'thread') == 'thread':
+            # Decrypt the key once up front: every SSHThread (and every forked worker process) then shares it
+            try:
+                key_cache.load(self.options.keyfile, None if self.options.passwordless else keypass,
+                               prompt=not self.options.passwordless)
+            except Exception as detail:
+                logger.error("Could not load private key %s: %s", self.options.keyfile, detail)
+
+        self.ssh_connect_queue = self.startEngine()
+        if self.metrics:
+            self.metrics.engine = self.ssh_connect_queue
+            if self.metrics_publisher is None:
+                self.metrics_publisher = MetricsPublisher(self.metrics, getattr(self.options, 'metrics_port', None),
+                                                          getattr(self.options, 'stats_file', None), getattr(self.options, 'stats_interval', 5.0))
+        if not self.options.commands and not self.options.local_filepath:
+            # Assume we're just doing a connection test
+            self.options.commands = ['echo CONNECTION TEST', ]
+
+        jobs = self.jobs(keypass)
+        if getattr(self.options, 'resume', None):
+            # Skip what an earlier (interrupted) run journaled, before any work is spent on those hosts
+            jobs = skipJournaled(jobs, loadJournal(self.options.resume, getattr(self.options, 'retry_failed', False)))
+        elif self.journal:
+            jobs = skipJournaled(jobs)
+        if self.rollout and str(getattr(self.options, 'batch_size', None)).endswith('%'):
+            # A percentage of the hosts: all of them have to be known up front
+            jobs = list(jobs)
+            self.rollout.setBatch(batchSize(self.options.batch_size, len(jobs)))
+        if self.options.sshconfig:
+            # Resolve ssh_config ahead of dispatch so that it's never what the workers are waiting on
+            jobs = prefetch(jobs, PREFETCH_SIZE)
+        if getattr(self.options, 'resolve_ahead', False):
+            # Resolve hosts with a pool of their own so that slow resolvers never hold up a worker
+            dns_cache.ttl = getattr(self.options, 'dns_ttl', dns_cache.ttl)
+            dns_cache.negative_ttl = getattr(self.options, 'dns_negative_ttl', dns_cache.negative_ttl)
+            jobs = resolveAhead(jobs, dns_cache, getattr(self.options, 'dns_workers', 16), PREFETCH_SIZE)
+        if getattr(self.options, 'preflight', False):
+            # Probe the SSH port of every host first so that dead ones never hold a worker for the whole --timeout
+            jobs = prefetch(sweep(jobs, getattr(self.options, 'preflight_timeout', 3.0), getattr(self.options, 'preflight_window', 512),
+                                  dns_cache, getattr(self.options, 'dns_workers', 16)), PREFETCH_SIZE)
+        if getattr(self.options, 'host_key_policy', 'off') != 'off':
+            # Look host keys up ahead of dispatch: with a hashed known_hosts that's an HMAC per salt for every host
+            jobs = prefetch(lookupAhead(jobs), PREFETCH_SIZE)
+        for queueObj in jobs:
+            if 'connection_result' not in queueObj and self.cancelled:
+                queueObj.update(connection_result="SKIPPED", command_output="Skipped: the run was cancelled",
+                                failure_reason='cancelled', settled=True)
+            if 'connection_result' not in queueObj and self.run_deadline and time.time() >= self.run_deadline:
+                queueObj.update(connection_result="SKIPPED", command_output="Skipped: the run's --deadline passed",
+                                failure_reason='deadline', settled=True)
+            if 'connection_result' not in queueObj and self.rollout and not self.rollout.admit():
+                # Aborted: the hosts dispatched so far finish, the others are reported SKIPPED
+                queueObj = self.rollout.skipped(queueObj)
+            if 'connection_result' in queueObj:
+                # Settled ahead of dispatch (host doesn't resolve, is unreachable or skipped): straight to the output
+                self.output_queue.put(queueObj)
+            else:
+                if self.limiter:
+                    self.limiter.acquire()
+                self.ssh_connect_queue.put(queueObj)
+            if self.metrics:
+                self.metrics.hostQueued()
         # Wait until all jobs are done before exiting
         self.ssh_connect_queue.join()
+        self.stopEngine()
+        # Keys learned with --host-key-policy accept-new
+        flushKnownHosts()
 
         return self.output_queue